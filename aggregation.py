@@ -0,0 +1,176 @@
+"""Agrégation des indicateurs communaux vers n'importe quel regroupement de communes.
+
+Chaque indicateur est agrégé à partir de composantes communales selon sa nature :
+    - stock (population, effectifs) : somme ;
+    - ratio (densité, indice de jeunesse) : somme des numérateurs / somme des dénominateurs ;
+    - part (ménages pauvres, logements sociaux) : 100 × somme des numérateurs / somme
+      des dénominateurs, effectifs stockés comme composantes du cube (ménages pauvres,
+      ménages occupant un logement social, ménages) ;
+    - autres taux, ou valeur non additive (médiane) : moyenne pondérée (par la
+      population, qui est le dénominateur des parts de population, ou un effectif dédié).
+
+Les réductions sont vectorisées (np.bincount) : un passage sur les ~35 000 communes
+suffit pour tous les groupes d'un niveau. Les cellules couvertes par le secret
+statistique (NaN) sont exclues ; la couverture de chaque valeur agrégée (part du
+poids total effectivement renseignée) est calculée et une valeur dont la couverture
+est inférieure à `min_coverage` est rendue manquante. Une somme partielle n'étant pas
+un total, un stock n'est publié que si toutes les communes du groupe sont renseignées.
+
+Benchmark à l'échelle nationale :
+    python aggregation.py --bench
+"""
+import argparse
+import time
+
+import numpy as np
+
+# Règles d'agrégation : (mode, colonnes) ; les colonnes « _… » sont des composantes du cube
+SUM = "sum"
+RATIO = "ratio"
+SHARE = "share"
+WEIGHTED_MEAN = "wmean"
+
+DEFAULT_WEIGHT = "_population"
+
+RULES = {
+    "Population municipale": (SUM, ()),
+    "Population municipale (femme)": (SUM, ()),
+    "Population municipale (homme)": (SUM, ()),
+    "Nombre d'individus au sens fiscal": (SUM, ()),
+    "Nombre de ménages fiscaux": (SUM, ()),
+    "Densité de population (hab/km²)": (RATIO, ("_population", "_surface_km2")),
+    "Indice de jeunesse": (RATIO, ("_jeunes", "_ages")),
+    # Parts FILOSOFI : effectifs de ménages (composantes calculées par build_cube.py)
+    "Part des ménages pauvres (%)": (SHARE, ("_menages_pauvres", "_menages")),
+    "Part des logements sociaux (%)": (SHARE, ("_logements_sociaux", "_menages")),
+    # Médiane : non additive, approchée par la moyenne des médianes pondérée par les individus
+    "Niveau de vie des individus (€)": (WEIGHTED_MEAN, ("Nombre d'individus au sens fiscal",)),
+}
+
+
+def rule_for(name):
+    """Règle d'agrégation d'une colonne (composantes : somme ; défaut : moyenne pondérée par la population)."""
+    if name.startswith("_"):
+        return SUM, ()
+    return RULES.get(name, (WEIGHTED_MEAN, (DEFAULT_WEIGHT,)))
+
+
+def group_sum(values, group_ids, n_groups):
+    """Somme par groupe en ignorant les NaN ; retourne (sommes, nombre de valeurs renseignées)."""
+    ok = (group_ids >= 0) & ~np.isnan(values)
+    totals = np.bincount(group_ids[ok], weights=values[ok], minlength=n_groups)
+    counts = np.bincount(group_ids[ok], minlength=n_groups)
+    return totals, counts
+
+
+def _coverage(mask_weights, weights, group_ids, n_groups):
+    """Part du poids de chaque groupe portée par les communes renseignées."""
+    covered, _ = group_sum(np.where(mask_weights, weights, 0.0), group_ids, n_groups)
+    total, _ = group_sum(weights, group_ids, n_groups)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(total > 0, covered / total, np.nan)
+
+
+def aggregate(columns, values, group_ids, n_groups, min_coverage=0.5):
+    """Agrège une matrice (colonnes × communes) en (colonnes × groupes).
+
+    `group_ids` donne pour chaque commune l'indice de son groupe (-1 : hors
+    regroupement). Retourne (valeurs float32, couverture float32).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    group_ids = np.asarray(group_ids, dtype=np.int64)
+    row = {name: i for i, name in enumerate(columns)}
+    out = np.full((len(columns), n_groups), np.nan, dtype=np.float64)
+    coverage = np.full((len(columns), n_groups), np.nan, dtype=np.float64)
+    population = values[row[DEFAULT_WEIGHT]] if DEFAULT_WEIGHT in row else np.ones(values.shape[1])
+    members = np.bincount(group_ids[group_ids >= 0], minlength=n_groups)
+
+    for j, name in enumerate(columns):
+        v = values[j]
+        mode, operands = rule_for(name)
+        if mode in (RATIO, SHARE):
+            if not all(o in row for o in operands):
+                continue  # composantes absentes (cube d'une version antérieure) : pas de valeur
+            num, den = values[row[operands[0]]], values[row[operands[1]]]
+            both = ~np.isnan(num) & ~np.isnan(den)
+            num_sum, _ = group_sum(np.where(both, num, np.nan), group_ids, n_groups)
+            den_sum, _ = group_sum(np.where(both, den, np.nan), group_ids, n_groups)
+            scale = 100.0 if mode == SHARE else 1.0
+            with np.errstate(divide="ignore", invalid="ignore"):
+                out[j] = np.where(den_sum > 0, scale * num_sum / den_sum, np.nan)
+            coverage[j] = _coverage(both, np.nan_to_num(population, nan=0.0), group_ids, n_groups)
+        elif mode == WEIGHTED_MEAN:
+            weights = values[row[operands[0]]] if operands and operands[0] in row else population
+            ok = ~np.isnan(v) & ~np.isnan(weights)
+            num, _ = group_sum(np.where(ok, v * weights, np.nan), group_ids, n_groups)
+            den, _ = group_sum(np.where(ok, weights, np.nan), group_ids, n_groups)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                out[j] = np.where(den > 0, num / den, np.nan)
+            coverage[j] = _coverage(ok, np.nan_to_num(weights, nan=0.0), group_ids, n_groups)
+        else:
+            totals, counts = group_sum(v, group_ids, n_groups)
+            # Stock publié : total seulement si chaque commune du groupe est renseignée
+            complete = counts == members if not name.startswith("_") else counts > 0
+            out[j] = np.where(complete & (counts > 0), totals, np.nan)
+            coverage[j] = _coverage(~np.isnan(v), np.nan_to_num(population, nan=0.0), group_ids, n_groups)
+
+    # Secret statistique : une valeur calculée sur une trop faible part du groupe n'est pas publiée
+    out[coverage < min_coverage] = np.nan
+    return out.astype(np.float32), coverage.astype(np.float32)
+
+
+def aggregate_custom(cube, codes, min_coverage=0.5):
+    """Indicateurs agrégés d'un ensemble quelconque de communes, lus dans le cube.
+
+    Retourne ({indicateur: valeur}, {indicateur: couverture}) pour les indicateurs publiés.
+    """
+    codes = list(codes)
+    columns = cube.columns
+    values = np.vstack([cube.slice(name, codes) for name in columns])
+    out, coverage = aggregate(columns, values, np.zeros(len(codes), dtype=np.int64), 1, min_coverage)
+    result, cover = {}, {}
+    for name, v, c in zip(columns, out[:, 0], coverage[:, 0]):
+        if name.startswith("_") or np.isnan(v):
+            continue
+        result[name] = float(v)
+        cover[name] = float(c)
+    return result, cover
+
+
+def _bench(n_communes=35000, n_indicators=40, secret_ratio=0.05, repeat=5, seed=0):
+    """Agrégation de toutes les communes vers ~1 250 EPCI, 100 départements et 18 régions."""
+    rng = np.random.default_rng(seed)
+    columns = ["_population", "_surface_km2", "_jeunes", "_ages", "_menages", "_menages_pauvres",
+               "Densité de population (hab/km²)", "Indice de jeunesse", "Nombre d'individus au sens fiscal",
+               "Part des ménages pauvres (%)"]
+    columns += [f"Indicateur {i} (%)" for i in range(n_indicators - len(columns))]
+    values = rng.uniform(0, 100, size=(len(columns), n_communes))
+    values[0] = rng.lognormal(6, 1.5, n_communes).round()
+    values[rng.random(values.shape) < secret_ratio] = np.nan
+    values[0] = np.nan_to_num(values[0], nan=100.0)
+    levels = {"EPCI": 1250, "départements": 100, "régions": 18}
+    for label, n_groups in levels.items():
+        group_ids = rng.integers(0, n_groups, n_communes)
+        timings = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            aggregate(columns, values, group_ids, n_groups)
+            timings.append(time.perf_counter() - t0)
+        print(f"{label:>13} : {n_communes} communes × {len(columns)} indicateurs → {n_groups} groupes "
+              f"en {min(timings) * 1000:.1f} ms (meilleur de {repeat})")
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        aggregate(columns, values[:, :500], np.zeros(500, dtype=np.int64), 1)
+    print(f"{'sélection':>13} : 500 communes → 1 groupe en {(time.perf_counter() - t0) / repeat * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Moteur d'agrégation des indicateurs communaux.")
+    parser.add_argument("--bench", action="store_true", help="Benchmark à l'échelle nationale (données synthétiques)")
+    parser.add_argument("--communes", type=int, default=35000)
+    parser.add_argument("--indicators", type=int, default=40)
+    args = parser.parse_args()
+    if args.bench:
+        _bench(args.communes, args.indicators)
+    else:
+        parser.print_help()
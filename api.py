@@ -0,0 +1,186 @@
+"""API JSON du dossier territorial (ASGI / Starlette).
+
+Expose les mêmes fonctions de récupération et le même cache que l'application
+Streamlit, sans le coût d'une réexécution complète du script à chaque requête.
+
+Sert aussi de proxy aux tuiles IGN des cartes, avec cache disque (voir ign_tiles.py :
+IGN_TILE_PROXY_URL=http://<hôte>:8000/tuiles/ign côté application).
+
+Lancement :
+    uvicorn api:app --host 0.0.0.0 --port 8000 --workers 4
+"""
+import math
+import os
+
+import numpy as np
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+from insee_data import (
+    INDICATORS_CONFIG, INSEE_KEY, fetch_demographic_data, fetch_pdf_data, get_communes_of_territory,
+    get_indicator_series, get_search_index, get_territory_indicators,
+)
+from ign_tiles import LAYERS, TILE_TTL_DAYS, get_tile_cache, valid_tile
+from insee_pdf import LABEL_TO_KIND, generate_insee_pdf, report_job
+from pdf_jobs import get_pdf_jobs
+from sirene_index import get_legal_units
+from syntheses import get_synthesis
+import telemetry
+
+KIND_TO_LABEL = {kind: label for label, kind in LABEL_TO_KIND.items()}
+# Niveaux dont on peut lister les communes (séries d'indicateurs)
+PARENT_KINDS = ("departements", "intercommunalites", "EPCI")
+ALL_INDICATORS = [i for group in INDICATORS_CONFIG.values() for i in group]
+# Attente maximale d'un rapport en cours de génération (secondes)
+PDF_API_TIMEOUT_S = float(os.getenv("PDF_API_TIMEOUT_S", "120"))
+
+
+def _clean(value):
+    """Convertit les types numpy / NaN en valeurs JSON."""
+    if isinstance(value, dict):
+        return {k: _clean(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_clean(v) for v in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def _error(status, message):
+    return JSONResponse({"erreur": message}, status_code=status)
+
+
+def _check_kind(kind):
+    return kind in KIND_TO_LABEL or kind == "EPCI"
+
+
+@telemetry.cache_resource(show_spinner=False)
+def territory_titles(kind):
+    """Libellés officiels des territoires d'un type (code -> libellé), indexés une fois par processus."""
+    index = get_search_index("intercommunalites" if kind == "EPCI" else kind)
+    return {} if index is None else dict(zip(index["CODE"], index["TITLE"]))
+
+
+async def _resolve(kind, code):
+    """(libellé du territoire, None) ou (None, réponse d'erreur) : type inconnu, code inconnu, liste indisponible."""
+    if not _check_kind(kind):
+        return None, _error(404, f"Type de territoire inconnu : {kind}")
+    titles = await run_in_threadpool(territory_titles, kind)
+    if not titles:
+        return None, _error(503, f"Liste des territoires ({kind}) indisponible.")
+    if code not in titles:
+        return None, _error(404, f"Territoire inconnu : {kind} {code}")
+    return titles[code], None
+
+
+def build_snapshot(code, kind, title):
+    """Instantané complet d'un territoire : indicateurs clés, FILOSOFI étendu, démographie, synthèse IA."""
+    synthesis = get_synthesis(code, kind)
+    return {
+        "code": code,
+        "type": kind,
+        "nom": title,
+        "indicateurs": get_territory_indicators(code, kind),
+        "donnees_etendues": fetch_pdf_data(code, kind, INSEE_KEY),
+        "demographie": fetch_demographic_data(code, kind),
+        "synthese": synthesis["texte"] if synthesis else None,
+        "unites_legales": get_legal_units(code, kind),
+    }
+
+
+def build_series(code, kind, indicator):
+    """Valeurs d'un indicateur pour les communes du territoire parent (None si indisponible)."""
+    gdf = get_communes_of_territory(code, kind)
+    if gdf is None:
+        return None
+    gdf = get_indicator_series(gdf, indicator)
+    if gdf is None:
+        return None
+    return [
+        {"code": c, "nom": n, "valeur": v}
+        for c, n, v in zip(gdf["code"], gdf["nom"], gdf["valeur"])
+    ]
+
+
+async def health(request):
+    return JSONResponse({"statut": "ok"})
+
+
+async def indicators(request):
+    return JSONResponse(INDICATORS_CONFIG)
+
+
+async def snapshot(request):
+    kind, code = request.path_params["kind"], request.path_params["code"]
+    title, error = await _resolve(kind, code)
+    if error is not None:
+        return error
+    data = await run_in_threadpool(build_snapshot, code, kind, title)
+    return JSONResponse(_clean(data))
+
+
+async def series(request):
+    kind, code = request.path_params["kind"], request.path_params["code"]
+    indicator = request.query_params.get("indicateur")
+    if kind not in PARENT_KINDS:
+        return _error(400, "Les séries ne sont disponibles que pour un département ou un EPCI.")
+    if indicator not in ALL_INDICATORS:
+        return _error(400, "Paramètre 'indicateur' manquant ou inconnu (voir /indicateurs).")
+    _, error = await _resolve(kind, code)
+    if error is not None:
+        return error
+    rows = await run_in_threadpool(build_series, code, kind, indicator)
+    if rows is None:
+        return _error(503, f"Indicateur '{indicator}' non disponible pour ce territoire.")
+    return JSONResponse(_clean({"code": code, "type": kind, "indicateur": indicator, "communes": rows}))
+
+
+async def pdf(request):
+    kind, code = request.path_params["kind"], request.path_params["code"]
+    title, error = await _resolve(kind, code)
+    if error is not None:
+        return error
+    jobs = get_pdf_jobs()
+
+    def _submit():
+        indicators_data = get_territory_indicators(code, kind)
+        type_label = KIND_TO_LABEL.get(kind, "EPCI (Intercommunalités)")
+        key, kwargs = report_job(code, title, type_label,
+                                 indicators_data.get("URL Dossier INSEE", ""), indicators_data)
+        # Même pool et même cache que l'application : requêtes identiques dédupliquées
+        return jobs.submit(key, code, generate_insee_pdf, kwargs)
+
+    job = await run_in_threadpool(_submit)
+    if not await run_in_threadpool(job.wait, PDF_API_TIMEOUT_S):
+        return _error(504, "Rapport toujours en cours de génération : réessayez plus tard.")
+    content = None if job.error else await run_in_threadpool(jobs.result, job)
+    if content is None:
+        return _error(503, f"Rapport indisponible : {job.error}" if job.error else "Rapport indisponible.")
+    return Response(content, media_type="application/pdf",
+                    headers={"Content-Disposition": f'attachment; filename="dossier_insee_{code}.pdf"'})
+
+
+async def ign_tile(request):
+    layer = request.path_params["layer"]
+    z, x, y = (request.path_params[k] for k in ("z", "x", "y"))
+    if not valid_tile(layer, z, x, y):
+        return _error(404, f"Tuile inconnue : {layer}/{z}/{x}/{y}")
+    content = await run_in_threadpool(get_tile_cache().get, layer, z, x, y)
+    if content is None:
+        return _error(404, "Tuile indisponible.")
+    return Response(content, media_type=LAYERS[layer][1],
+                    headers={"Cache-Control": f"public, max-age={int(TILE_TTL_DAYS * 86400)}"})
+
+
+app = Starlette(routes=[
+    Route("/sante", health),
+    Route("/indicateurs", indicators),
+    Route("/territoires/{kind}/{code}", snapshot),
+    Route("/territoires/{kind}/{code}/indicateurs", series),
+    Route("/territoires/{kind}/{code}/pdf", pdf),
+    Route("/tuiles/ign/{layer}/{z:int}/{x:int}/{y:int}", ign_tile),
+])
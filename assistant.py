@@ -0,0 +1,208 @@
+"""Assistant IA : configuration du modèle Gemini, cache, file d'attente et construction des prompts."""
+import os
+import time
+import uuid
+
+import streamlit as st
+
+from insee_data import INSEE_KEY, fetch_demographic_data, fetch_pdf_data
+from llm_cache import ResponseCache
+from llm_queue import FakeModel, LLMQueue, QueueFullError, is_rate_limit_error
+from llm_context import build_conversation_window, format_history, format_indicator_table, merge_indicators
+import telemetry
+
+# Configuration Gemini
+GEMINI_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_MODEL = "gemini-3-flash-preview"
+# Modèle factice local (tests hors ligne, tests de charge)
+LLM_FAKE = os.getenv("LLM_FAKE") == "1"
+
+
+def model_configured():
+    """Vrai si un modèle est disponible (modèle factice ou clé Gemini), sans le construire."""
+    return LLM_FAKE or bool(GEMINI_KEY)
+
+
+@telemetry.cache_resource(show_spinner=False)
+def get_model():
+    """Client du modèle, construit une fois par processus au premier appel (None sans configuration).
+
+    google.generativeai n'est importé qu'ici : son import (~0,7 s) ne pèse pas sur
+    le démarrage de l'application ni sur les sessions qui n'utilisent pas l'assistant.
+    """
+    if LLM_FAKE:
+        return FakeModel(latency=float(os.getenv("LLM_FAKE_LATENCY", "0.5")),
+                         rate_limit_ratio=float(os.getenv("LLM_FAKE_429_RATIO", "0")))
+    if not GEMINI_KEY:
+        return None
+    import google.generativeai as genai
+
+    genai.configure(api_key=GEMINI_KEY)
+    return genai.GenerativeModel(GEMINI_MODEL)
+
+
+@st.cache_resource
+def get_response_cache():
+    """Cache des réponses IA partagé entre toutes les sessions."""
+    return ResponseCache(
+        ttl=int(os.getenv("LLM_CACHE_TTL", "86400")),
+        max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "512")),
+        semantic=os.getenv("LLM_CACHE_SEMANTIC", "0") == "1",
+    )
+
+
+@st.cache_resource
+def get_llm_queue():
+    """File d'attente des appels LLM partagée par tout le processus."""
+    return LLMQueue(
+        concurrency=int(os.getenv("LLM_CONCURRENCY", "4")),
+        max_pending=int(os.getenv("LLM_MAX_PENDING", "64")),
+        max_pending_per_user=int(os.getenv("LLM_MAX_PENDING_PER_USER", "2")),
+        max_retries=int(os.getenv("LLM_MAX_RETRIES", "3")),
+    )
+
+
+def session_user_id():
+    """Identifiant de la session courante, utilisé pour l'équité de la file LLM."""
+    if "llm_user_id" not in st.session_state:
+        st.session_state.llm_user_id = uuid.uuid4().hex
+    return st.session_state.llm_user_id
+
+
+def llm_error_message(error):
+    """Message utilisateur pour une erreur d'appel LLM."""
+    if isinstance(error, QueueFullError):
+        return "⏳ L'assistant est très sollicité en ce moment. Merci de réessayer dans quelques instants."
+    if is_rate_limit_error(error):
+        return "⏳ Le quota du service IA est momentanément atteint. Merci de réessayer dans une minute."
+    return f"Erreur lors de la génération : {error}"
+
+
+def build_ai_context(code, kind, indicators):
+    """Contexte chiffré de l'assistant : indicateurs clés, FILOSOFI étendu et démographie, dédupliqués."""
+    return merge_indicators(
+        indicators,
+        fetch_pdf_data(code, kind, INSEE_KEY),
+        fetch_demographic_data(code, kind),
+    )
+
+
+def conversation_history(history):
+    """Fenêtre de conversation bornée en tokens (anciens tours résumés)."""
+    if not history:
+        return ""
+    summary, recent = build_conversation_window(
+        history,
+        max_tokens=int(os.getenv("LLM_HISTORY_TOKENS", "1500")),
+        summary_tokens=int(os.getenv("LLM_SUMMARY_TOKENS", "300")),
+    )
+    return format_history(summary, recent)
+
+
+def build_gemini_prompt(prompt, context_data, territory_name, history_str=""):
+    """Construit le prompt complet envoyé à Gemini avec le contexte du territoire."""
+    context_str = format_indicator_table(context_data)
+    history_block = f"\n{history_str}\n" if history_str else ""
+    return f"""Tu es un expert en démographie et géographie française, spécialisé dans l'analyse des données INSEE.
+Tu assistes un utilisateur qui consulte le dossier de la collectivité : {territory_name}.
+
+Voici les données clés (issues des bases officielles INSEE / FILOSOFI) pour ce territoire (indicateur | valeur) :
+{context_str}
+{history_block}
+L'utilisateur demande : {prompt}
+
+Instructions :
+1. Utilise les données chiffrées fournies ci-dessus (Pauvreté, Niveau de vie, Population) en priorité absolue.
+2. Si la question porte sur une précision géographique très fine (quartier, rue, carreaux de 200m), mentionne que l'utilisateur peut afficher le carroyage FILOSOFI (carreaux de 200 m ou 1 km) dans l'onglet "Analyse Cartographique" pour visualiser les données à l'échelle infra-communale.
+3. Si tu n'as pas de réponse à la question (que ce soit via les données fournies ou tes connaissances générales), réponds exactement : "je ne peux répondre à votre question".
+4. Analyse les indicateurs de pauvreté et de niveau de vie pour donner un contexte social précis.
+5. Donne des réponses précises, analytiques et polies.
+"""
+
+
+def ask_gemini(prompt, context_data, territory_name, territory_code=None, user_id="batch"):
+    """Interroge Gemini avec le contexte du territoire."""
+    if not model_configured():
+        return "Erreur : Clé API Gemini non configurée."
+
+    cache = get_response_cache()
+    cache_code = territory_code or territory_name
+    cached = cache.get(prompt, cache_code, context_data)
+    if cached is not None:
+        return cached
+
+    full_prompt = build_gemini_prompt(prompt, context_data, territory_name)
+    with telemetry.span("gemini.generate", "llm", prompt_chars=len(full_prompt)) as s:
+        try:
+            response = get_llm_queue().call(user_id, get_model().generate_content, full_prompt)
+            cache.set(prompt, cache_code, context_data, response.text)
+            s.attributes["chars"] = len(response.text)
+            return response.text
+        except Exception as e:
+            telemetry.record_error(f"Gemini error: {e}")
+            return llm_error_message(e)
+
+
+def ask_gemini_stream(prompt, context_data, territory_name, territory_code, history=None):
+    """Interroge Gemini en streaming et renvoie les morceaux de texte au fil de l'eau.
+
+    `history` est la liste des messages précédents : seule une fenêtre bornée en
+    tokens est envoyée, les anciens tours étant résumés.
+    Le temps d'accès au premier token est enregistré dans st.session_state.last_ttft.
+    Une interaction pendant la génération (changement de territoire...) interrompt le
+    script au morceau suivant ; l'appelant ferme alors le générateur (contextlib.closing),
+    ce qui annule la requête dans la file LLM.
+    """
+    if not model_configured():
+        yield "Erreur : Clé API Gemini non configurée."
+        return
+
+    st.session_state.last_ttft = None
+    t_start = time.perf_counter()
+
+    # Réponse déjà connue pour cette question, ce territoire, ces données et cet historique
+    history_str = conversation_history(history)
+    cache_context = {**context_data, "__historique__": history_str} if history_str else context_data
+    cache = get_response_cache()
+    with telemetry.span("gemini.cache", "llm") as s:
+        cached = cache.get(prompt, territory_code, cache_context)
+        s.attributes["cache"] = "hit" if cached is not None else "miss"
+    st.session_state.last_cache_hit = cached is not None
+    if cached is not None:
+        st.session_state.last_ttft = time.perf_counter() - t_start
+        yield cached
+        return
+
+    full_prompt = build_gemini_prompt(prompt, context_data, territory_name, history_str)
+    parts = []
+    with telemetry.span("gemini.stream", "llm", prompt_chars=len(full_prompt)) as s:
+        chunks = get_llm_queue().stream(session_user_id(), lambda: get_model().generate_content(full_prompt, stream=True))
+        try:
+            for chunk in chunks:
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # Morceau sans texte (ex: métadonnées de sécurité)
+                    continue
+                if not text:
+                    continue
+                if st.session_state.last_ttft is None:
+                    st.session_state.last_ttft = time.perf_counter() - t_start
+                    s.attributes["ttft_s"] = round(st.session_state.last_ttft, 3)
+                parts.append(text)
+                yield text
+        except GeneratorExit:
+            # Générateur fermé avant la fin : rerun demandé pendant la génération
+            s.attributes["cancelled"] = True
+            raise
+        except Exception as e:
+            telemetry.record_error(f"Gemini error: {e}")
+            yield llm_error_message(e)
+            return
+        finally:
+            # Libère la place dans la file si la lecture s'arrête avant la fin
+            chunks.close()
+            s.attributes.update(chunks=len(parts), chars=sum(len(p) for p in parts))
+    # On ne met en cache que les réponses complètes
+    if parts:
+        cache.set(prompt, territory_code, cache_context, "".join(parts))
@@ -0,0 +1,33 @@
+"""Accès aux données : contours, communes d'un territoire, indicateurs pynsee et indicateurs clés."""
+import pytest
+
+import synthetic
+from insee_data import get_communes_of_territory, get_geo, get_pynsee_indicators, get_territory_indicators
+
+INDICATORS = ["Niveau de vie des individus (€)", "Indice de jeunesse", "Part des résidences principales (%)"]
+
+
+def test_get_geo(measure, scale):
+    code, kind, name, _ = synthetic.SCALES[scale]
+    gdf = measure(get_geo, code, kind, name)
+    assert gdf is not None and not gdf.empty
+
+
+@pytest.mark.parametrize("scale", ["epci", "departement"])
+def test_get_communes_of_territory(measure, scale):
+    code, kind, _, size = synthetic.SCALES[scale]
+    gdf = measure(get_communes_of_territory, code, kind)
+    assert len(gdf) == size
+
+
+@pytest.mark.parametrize("indicator", INDICATORS)
+def test_get_pynsee_indicators(measure, scale, indicator):
+    codes = synthetic.territory_gdf(scale)["code"].tolist()
+    df = measure(get_pynsee_indicators, codes, indicator)
+    assert df is not None and df["CODEGEO"].nunique() == len(codes)
+
+
+def test_get_territory_indicators(measure, scale):
+    code, kind, _, _ = synthetic.SCALES[scale]
+    indicators = measure(get_territory_indicators, code, kind)
+    assert indicators.get("Population", 0) > 0
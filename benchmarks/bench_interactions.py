@@ -0,0 +1,127 @@
+"""Interactions sur un dossier affiché : rerun de toute la page ou de la seule section (st.fragment).
+
+Pour chaque interaction (indicateur de la carte thématique, question à l'assistant,
+export PDF), deux mesures du temps serveur :
+    - page : rerun complet du script, comportement avant le découpage en fragments
+      (et celui d'un widget hors fragment) ;
+    - fragment : rerun limité à la section du widget, comme le demande le navigateur.
+
+AppTest ne rejoue que des reruns complets : la fixture `fragment_rerun` ajoute à la
+demande de rerun l'identifiant du fragment qui contient le widget, relevé dans les
+messages du rendu précédent. Un rerun complet (non mesuré) précède chaque tour et
+rétablit l'arbre complet de la page.
+
+L'export PDF passe par le pool de fond (pdf_jobs) : `test_pdf_export` mesure le délai
+jusqu'au bouton de téléchargement, rapport à générer ou déjà en cache.
+"""
+import dataclasses
+import shutil
+
+import pytest
+
+
+def _widget_label(element):
+    widget = getattr(element, element.WhichOneof("type") or "", None)
+    return getattr(widget, "label", None) or getattr(widget, "placeholder", None)
+
+
+@pytest.fixture
+def fragment_rerun(monkeypatch):
+    """`rerun(at, libellé)` : rerun de `at` limité au fragment du widget `libellé` (libellé contenu)."""
+    from streamlit.testing.v1.local_script_runner import LocalScriptRunner
+
+    state = {"queue": [], "messages": []}
+    request_rerun = LocalScriptRunner.request_rerun
+    forward_msgs = LocalScriptRunner.forward_msgs
+
+    def scoped_request(runner, rerun_data):
+        accepted = request_rerun(runner, rerun_data)
+        if state["queue"]:
+            # Chaque run d'AppTest crée son ScriptRunner, dont la demande initiale (rerun complet)
+            # absorberait celle-ci : le fragment est donc ajouté à la demande fusionnée.
+            requests = runner._requests
+            requests._rerun_data = dataclasses.replace(requests._rerun_data, fragment_id_queue=list(state["queue"]))
+        return accepted
+
+    def recorded_msgs(runner):
+        messages = forward_msgs(runner)
+        state["messages"] = list(messages)
+        return messages
+
+    monkeypatch.setattr(LocalScriptRunner, "request_rerun", scoped_request)
+    monkeypatch.setattr(LocalScriptRunner, "forward_msgs", recorded_msgs)
+
+    def rerun(at, label):
+        fragment_id = next((m.delta.fragment_id for m in state["messages"]
+                            if m.HasField("delta") and m.delta.HasField("new_element")
+                            and label in (_widget_label(m.delta.new_element) or "")), "")
+        assert fragment_id, f"widget « {label} » hors fragment"
+        state["queue"] = [fragment_id]
+        try:
+            return at.run()
+        finally:
+            state["queue"] = []
+    return rerun
+
+
+def _next_indicator(at):
+    box = next(s for s in at.selectbox if s.label == "Indicateur à afficher")
+    box.select(next(o for o in box.options if o != box.value))
+    return "Indicateur à afficher"
+
+
+def _ask_assistant(at):
+    at.chat_input[0].set_value("Quel est le taux de pauvreté ?")
+    return "Question sur"
+
+
+def _export_pdf(at):
+    next(b for b in at.button if "PDF" in b.label).click()
+    return "PDF"
+
+
+INTERACTIONS = {"indicateur": _next_indicator, "assistant": _ask_assistant, "pdf": _export_pdf}
+
+
+@pytest.mark.parametrize("scope", ["page", "fragment"])
+@pytest.mark.parametrize("interaction", list(INTERACTIONS))
+def test_interaction(measure, open_territory, fragment_rerun, interaction, scope):
+    at = open_territory("epci")
+    act = INTERACTIONS[interaction]
+
+    def interact():
+        label = act(at)
+        result = at.run() if scope == "page" else fragment_rerun(at, label)
+        # Vérifié à chaque tour : un indicateur ou un rerun en erreur ne doit pas passer inaperçu
+        assert not at.exception, [e.value for e in at.exception]
+        return result
+
+    # Rerun complet entre deux tours : arbre de la page entier pour l'interaction suivante
+    measure(interact, cold=False, rounds=5, setup=at.run)
+    if scope == "fragment":
+        # Rerun réellement partiel : la section a ouvert sa propre trace (telemetry.fragment)
+        assert "_fragment_traces" in at.session_state
+
+
+@pytest.mark.parametrize("cache", ["miss", "hit"])
+def test_pdf_export(measure, open_territory, monkeypatch, tmp_path, cache):
+    from pdf_jobs import get_pdf_jobs
+
+    at = open_territory("epci")
+    monkeypatch.setattr(get_pdf_jobs().store, "root", str(tmp_path / "pdf"))
+
+    def forget():
+        if cache == "miss":
+            shutil.rmtree(tmp_path / "pdf", ignore_errors=True)
+
+    def export():
+        _export_pdf(at)
+        at.run()
+        # Rerun de la page une fois la tâche terminée (ce que déclenche la section de progression)
+        at.session_state.pdf_job.wait(60)
+        return at.run()
+
+    measure(export, cold=False, rounds=3, setup=forget)
+    assert not at.exception
+    assert at.session_state.pdf_job.cached == (cache == "hit")
+    assert [e for e in at.get("download_button") if "Télécharger" in e.proto.label]
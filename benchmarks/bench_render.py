@@ -0,0 +1,63 @@
+"""Rendu : GeoJSON des cartes, tuiles IGN du proxy, image de carte et rapport PDF."""
+import os
+
+import numpy as np
+import pytest
+
+import synthetic
+from ign_tiles import TileCache
+from insee_pdf import generate_insee_pdf, generate_map_image
+from maps import build_choropleth, build_overview_map
+
+PDF_LABELS = {"commune": "Communes", "epci": "EPCI (Intercommunalités)", "departement": "Départements",
+              "region": "Régions"}
+
+
+def _with_values(scale):
+    gdf = synthetic.territory_gdf(scale)[["code", "nom", "population", "geometry"]]
+    return gdf.assign(valeur=np.linspace(5, 35, len(gdf)))
+
+
+def test_build_choropleth(measure, scale):
+    gdf = _with_values(scale)
+    # Sérialisation complète (GeoJSON + HTML folium), celle que fait st_folium à chaque rendu
+    html = measure(lambda: build_choropleth(gdf, "Part des résidences principales (%)", "Résidences (%)")
+                   .get_root().render(), cold=False)
+    assert gdf["code"].iloc[-1] in html
+
+
+def test_build_overview_map(measure, scale):
+    gdf = synthetic.territory_gdf(scale).dissolve()
+    # Construite une fois par territoire : le changement de fond se fait ensuite dans le navigateur
+    html = measure(lambda: build_overview_map(gdf, 11).get_root().render(), cold=False)
+    assert "baselayerchange" in html
+
+
+@pytest.mark.parametrize("cache", ["miss", "hit"])
+def test_ign_tile_cache(measure, tmp_path, cache):
+    tiles = TileCache(str(tmp_path), max_bytes=2**20, ttl_s=86400)
+    path = tiles.path("plan", 12, 2048, 1400)
+
+    def forget():
+        # Miss : tuile retirée du disque avant chaque tour, redemandée au WMTS (simulé)
+        if cache == "miss" and os.path.exists(path):
+            os.remove(path)
+
+    tile = measure(tiles.get, "plan", 12, 2048, 1400, cold=False, rounds=5, setup=forget)
+    assert tile and tiles.metrics()["misses" if cache == "miss" else "hits"] >= 5
+
+
+def test_generate_map_image(measure, scale):
+    code, kind, name, _ = synthetic.SCALES[scale]
+    image = measure(generate_map_image, code, kind, name, gdf=synthetic.territory_gdf(scale))
+    assert image is not None and image.getbuffer().nbytes > 0
+
+
+def test_generate_insee_pdf(measure, scale):
+    code, kind, name, _ = synthetic.SCALES[scale]
+    communes = [{"nom": r.nom, "code": r.code, "population": int(r.population)}
+                for r in synthetic.territory_gdf(scale).itertuples()]
+    indicators = {"Population": sum(c["population"] for c in communes), "Surface (ha)": 12000.0}
+    pdf = measure(generate_insee_pdf, name, code, PDF_LABELS[scale], "https://www.insee.fr/", indicators,
+                  communes=communes if kind != "communes" else None)
+    assert bytes(pdf)[:4] == b"%PDF"
@@ -0,0 +1,77 @@
+"""Démarrage de l'application : premier rendu dans un processus neuf, coût d'un rerun.
+
+Le premier rendu se mesure dans un interpréteur lancé pour l'occasion (ce fichier
+exécuté en sonde) : les modules déjà importés par les autres benchmarks ne doivent
+pas le flatter. Le rerun (interaction sans changement de territoire) se mesure en
+processus, territoire déjà affiché.
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(os.path.dirname(BENCH_DIR), "app.py")
+
+# Modules lourds qui ne doivent pas être chargés avant la première carte / question / requête
+LAZY_MODULES = ["folium", "streamlit_folium", "google.generativeai", "matplotlib", "contextily", "fpdf"]
+
+
+def probe():
+    """Sonde exécutée dans un processus neuf : durées d'import et de premier rendu, modules chargés."""
+    t0 = time.perf_counter()
+    sys.path.insert(0, os.path.dirname(BENCH_DIR))
+    import synthetic
+    from cassette import Cassette
+    from streamlit.testing.v1 import AppTest
+
+    Cassette(os.path.join(BENCH_DIR, "cassettes"), fallback=synthetic.respond,
+             pynsee_fallback={"get_local_data": synthetic.get_local_data,
+                              "get_population": synthetic.get_population}).install()
+    t1 = time.perf_counter()
+    at = AppTest.from_file(APP_PATH, default_timeout=120)
+    at.run()
+    t2 = time.perf_counter()
+    print(json.dumps({
+        "harnais_s": t1 - t0,
+        "premier_rendu_s": t2 - t1,
+        "exceptions": [e.value for e in at.exception],
+        "modules_paresseux_charges": [m for m in LAZY_MODULES if m in sys.modules],
+    }))
+
+
+def _first_render():
+    out = subprocess.run([sys.executable, __file__], capture_output=True, text=True, check=True,
+                         env={**os.environ, "PYTHONPATH": BENCH_DIR})
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def test_first_render(measure, benchmark):
+    report = measure(_first_render, cold=False)
+    benchmark.extra_info.update(report)
+    assert not report["exceptions"]
+    assert not report["modules_paresseux_charges"]
+
+
+def test_rerun_home(measure):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP_PATH, default_timeout=120)
+    at.run()
+    measure(at.run, cold=False, rounds=5)
+    assert not at.exception
+
+
+@pytest.mark.parametrize("scale", ["commune", "epci"])
+def test_rerun(measure, open_territory, scale):
+    at = open_territory(scale)
+    assert not at.exception
+    measure(at.run, cold=False, rounds=5)
+    assert not at.exception
+
+
+if __name__ == "__main__":
+    probe()
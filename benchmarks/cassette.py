@@ -0,0 +1,152 @@
+"""Enregistrement / rejeu des appels amont (HTTP et pynsee), à la manière de VCR.
+
+En rejeu (défaut), chaque requête est servie depuis la cassette, puis à défaut
+par l'amont simulé (synthetic.py) ; une requête que ni l'un ni l'autre ne
+couvre lève une erreur : aucun benchmark ne touche le réseau sans le dire.
+En enregistrement (BENCH_RECORD=1), les appels partent réellement et leurs
+réponses sont écrites dans la cassette, pour rejouer ensuite des volumes réels.
+
+Disposition :
+    <cassette>/index.json   clé (méthode + URL sans en-têtes, ou appel pynsee) -> entrée
+    <cassette>/<sha1>.bin   corps HTTP
+    <cassette>/<sha1>.parquet  résultat pynsee
+"""
+import hashlib
+import json
+import os
+import threading
+
+import pandas as pd
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+class OfflineError(RuntimeError):
+    """Appel amont absent de la cassette et de l'amont simulé."""
+
+
+def _digest(key):
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def _response(method, url, status, content_type, body):
+    response = requests.Response()
+    response.status_code = status
+    response._content = body
+    response.headers = CaseInsensitiveDict({"Content-Type": content_type, "Content-Length": str(len(body))})
+    response.url = url
+    response.encoding = "utf-8"
+    response.request = requests.Request(method, url).prepare()
+    return response
+
+
+class Cassette:
+    """Cassette d'un jeu de benchmarks ; `install()` / `uninstall()` posent et retirent les interceptions."""
+
+    def __init__(self, path, record=False, fallback=None, pynsee_fallback=None):
+        self.path = path
+        self.record = record
+        self.fallback = fallback
+        self.pynsee_fallback = pynsee_fallback or {}
+        self.hits = {"cassette": 0, "synthetic": 0, "recorded": 0}
+        self._lock = threading.Lock()
+        self._index = {}
+        index_path = os.path.join(path, "index.json")
+        if os.path.exists(index_path):
+            with open(index_path, encoding="utf-8") as f:
+                self._index = json.load(f)
+        self._patched = []
+
+    @property
+    def mode(self):
+        """Origine des réponses amont : "record" (réseau), "cassette" (rejeu) ou "synthetic" (cassette vide)."""
+        if self.record:
+            return "record"
+        return "cassette" if self._index else "synthetic"
+
+    # --- HTTP ---------------------------------------------------------------
+
+    def request(self, session, method, url, params=None, **kwargs):
+        method = method.upper()
+        full_url = requests.Request(method, url, params=params).prepare().url
+        key = f"{method} {full_url}"
+        entry = self._index.get(key)
+        if entry is not None and not self.record:
+            with open(os.path.join(self.path, entry["file"]), "rb") as f:
+                body = f.read()
+            self.hits["cassette"] += 1
+            return _response(method, full_url, entry["status"], entry["content_type"], body)
+        if self.record:
+            response = self._original_request(session, method, url, params=params, **kwargs)
+            self._store(key, response.content, ".bin", status=response.status_code,
+                        content_type=response.headers.get("Content-Type", ""))
+            self.hits["recorded"] += 1
+            return response
+        simulated = self.fallback(method, full_url) if self.fallback else None
+        if simulated is None:
+            raise OfflineError(f"Requête hors cassette : {key}")
+        self.hits["synthetic"] += 1
+        return _response(method, full_url, *simulated)
+
+    # --- pynsee -------------------------------------------------------------
+
+    def pynsee_call(self, name, original, *args, **kwargs):
+        key = f"pynsee.{name} " + json.dumps([args, kwargs], sort_keys=True, default=str)
+        entry = self._index.get(key)
+        if entry is not None and not self.record:
+            self.hits["cassette"] += 1
+            return pd.read_parquet(os.path.join(self.path, entry["file"]))
+        if self.record:
+            frame = original(*args, **kwargs)
+            if frame is not None:
+                self._store(key, frame, ".parquet")
+            self.hits["recorded"] += 1
+            return frame
+        if name not in self.pynsee_fallback:
+            raise OfflineError(f"Appel pynsee hors cassette : {key[:200]}")
+        self.hits["synthetic"] += 1
+        return self.pynsee_fallback[name](*args, **kwargs)
+
+    def _store(self, key, payload, suffix, **meta):
+        file_name = _digest(key) + suffix
+        os.makedirs(self.path, exist_ok=True)
+        if suffix == ".parquet":
+            payload.to_parquet(os.path.join(self.path, file_name))
+        else:
+            with open(os.path.join(self.path, file_name), "wb") as f:
+                f.write(payload)
+        with self._lock:
+            self._index[key] = {"file": file_name, **meta}
+
+    def save(self):
+        if not self.record:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, "index.json"), "w", encoding="utf-8") as f:
+            json.dump(self._index, f, ensure_ascii=False, indent=1, sort_keys=True)
+
+    # --- installation -------------------------------------------------------
+
+    def install(self):
+        import pynsee
+
+        self._original_request = requests.sessions.Session.request
+        cassette = self
+
+        def request(session, method, url, *args, **kwargs):
+            if args:
+                kwargs["params"] = args[0]
+            return cassette.request(session, method, url, **kwargs)
+
+        self._patched.append((requests.sessions.Session, "request", self._original_request))
+        requests.sessions.Session.request = request
+        for name in ("get_local_data", "get_population"):
+            original = getattr(pynsee, name)
+            self._patched.append((pynsee, name, original))
+            setattr(pynsee, name, lambda *a, _n=name, _o=original, **k: cassette.pynsee_call(_n, _o, *a, **k))
+
+    def uninstall(self):
+        while self._patched:
+            owner, name, original = self._patched.pop()
+            setattr(owner, name, original)
+        self.save()
@@ -0,0 +1,152 @@
+"""Fixtures des benchmarks : amont hors ligne, territoires aux quatre échelles, budgets de temps.
+
+Les données locales (DATA_DIR) pointent vers un répertoire temporaire : aucun
+cube, index ou référentiel précalculé de la machine ne fausse les mesures.
+
+Usage (depuis la racine du dépôt, dépendances dans benchmarks/requirements.txt) :
+    python -m pytest                      # mesures + budgets absolus (budgets.json)
+    python -m pytest --benchmark-compare --benchmark-compare-fail=mean:25%
+                                          # régression par rapport au dernier passage enregistré
+    BENCH_RECORD=1 python -m pytest -k commune
+                                          # enregistre les réponses réelles dans la cassette
+
+Le dépôt ne livre aucune cassette (benchmarks/cassettes absent) : par défaut, tout
+l'amont est simulé (synthetic.py), et les volumes mesurés sont ceux des territoires
+synthétiques. Le mode (synthetic, cassette ou record) est affiché en tête du passage
+et joint à chaque mesure (extra_info « upstream ») : deux passages ne se comparent
+que dans le même mode. En fin de session, le mode est vérifié : aucune réponse de
+cassette en mode synthétique, aucun repli synthétique lors du rejeu d'une cassette.
+
+Chaque passage est enregistré dans .cache/benchmarks (--benchmark-storage pour
+un autre emplacement, ex. un volume conservé par la CI) : historique consultable
+avec `pytest-benchmark compare`.
+"""
+import json
+import logging
+import os
+import sys
+import tempfile
+
+import pytest
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+os.environ.setdefault("INSEE_DATA_DIR", tempfile.mkdtemp(prefix="insee-bench-"))
+
+import streamlit as st  # noqa: E402
+
+import synthetic  # noqa: E402
+from cassette import Cassette  # noqa: E402
+from geo_cache import get_geo_cache  # noqa: E402
+
+CASSETTE_DIR = os.getenv("BENCH_CASSETTE_DIR", os.path.join(BENCH_DIR, "cassettes"))
+BUDGETS_PATH = os.path.join(BENCH_DIR, "budgets.json")
+APP_PATH = os.path.join(os.path.dirname(BENCH_DIR), "app.py")
+TYPE_LABELS = {"commune": "Communes", "epci": "EPCI (Intercommunalités)"}
+# Marge appliquée aux budgets absolus (machine de CI plus lente, etc.)
+BUDGET_FACTOR = float(os.getenv("BENCH_BUDGET_FACTOR", "1.0"))
+
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+
+def _cassette():
+    return Cassette(
+        CASSETTE_DIR,
+        record=os.getenv("BENCH_RECORD") == "1",
+        fallback=synthetic.respond,
+        pynsee_fallback={"get_local_data": synthetic.get_local_data, "get_population": synthetic.get_population},
+    )
+
+
+def pytest_report_header(config):
+    return f"amont : {_cassette().mode} ({CASSETTE_DIR})"
+
+
+@pytest.fixture(scope="session", autouse=True)
+def upstream():
+    cassette = _cassette()
+    cassette.install()
+    # Ressources partagées entre sessions (construites une fois par processus) : hors mesure
+    from insee_data import get_hierarchy
+    get_hierarchy()
+    yield cassette
+    cassette.uninstall()
+    print(f"\nAppels amont ({cassette.mode}) : {cassette.hits}")
+    if cassette.mode == "synthetic":
+        assert cassette.hits["cassette"] == 0, cassette.hits
+    elif cassette.mode == "cassette":
+        # Rejeu partiel : les mesures mêleraient volumes réels et synthétiques
+        assert cassette.hits["synthetic"] == 0, f"cassette incomplète, repli synthétique : {cassette.hits}"
+
+
+@pytest.fixture(params=list(synthetic.SCALES))
+def scale(request):
+    """Échelle mesurée : commune, EPCI, grand département, région."""
+    return request.param
+
+
+@pytest.fixture
+def open_territory():
+    """Fabrique de sessions AppTest ouvertes sur un territoire synthétique (commune ou EPCI).
+
+    Le territoire est choisi comme le ferait un utilisateur : type, recherche, sélection.
+    """
+    from streamlit.testing.v1 import AppTest
+
+    def open_(scale):
+        code, _, name, _ = synthetic.SCALES[scale]
+        at = AppTest.from_file(APP_PATH, default_timeout=120)
+        at.run()
+        at.selectbox(key="territory_type").select(TYPE_LABELS[scale]).run()
+        at.text_input(key="territory_search").input(name).run()
+        next(s for s in at.sidebar.selectbox if s.label == "Choisir").select(f"{name} ({code})").run()
+        return at
+    return open_
+
+
+@pytest.fixture(scope="session")
+def budgets():
+    with open(BUDGETS_PATH, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def clear_data_caches():
+    """Premier affichage d'un territoire : caches de données (st.cache_data, contours) vidés, ressources conservées."""
+    st.cache_data.clear()
+    get_geo_cache().clear()
+
+
+@pytest.fixture
+def measure(benchmark, budgets, request, upstream):
+    """Mesure `func(*args)` (à froid par défaut) puis vérifie le budget absolu du benchmark.
+
+    Un tour d'échauffement (non mesuré) amorce l'amont simulé et les imports paresseux.
+
+    `setup` (non mesuré) précède chaque tour, après le vidage des caches à froid.
+
+    Le budget (budgets.json) est cherché par identifiant complet (``test_x[pdf-fragment]``),
+    par fonction et échelle (``test_x[region]``), puis par fonction ; la moyenne doit
+    rester sous budget × BENCH_BUDGET_FACTOR.
+    """
+    benchmark.extra_info["upstream"] = upstream.mode
+
+    def run(func, *args, cold=True, rounds=3, setup=None, **kwargs):
+        def prepare():
+            if cold:
+                clear_data_caches()
+            if setup is not None:
+                setup()
+
+        result = benchmark.pedantic(func, args=args, kwargs=kwargs, rounds=rounds, iterations=1,
+                                    setup=prepare if cold or setup else None, warmup_rounds=1)
+        stats = getattr(benchmark, "stats", None)
+        name = request.node.originalname
+        callspec = getattr(request.node, "callspec", None)
+        keys = [f"{name}[{callspec.id}]", f"{name}[{callspec.params.get('scale')}]"] if callspec else []
+        budget = next((budgets[k] for k in keys if k in budgets), budgets.get(name))
+        if stats is not None and budget is not None:
+            mean = stats.stats.mean
+            assert mean <= budget * BUDGET_FACTOR, (
+                f"{request.node.name} : {mean:.3f} s en moyenne, budget {budget * BUDGET_FACTOR:.3f} s")
+        return result
+    return run
@@ -0,0 +1,230 @@
+"""Territoire synthétique et amont simulé pour les benchmarks (aucun accès réseau).
+
+Une région fictive de 5 départements × 890 communes, découpée en EPCI de 40
+communes : les quatre échelles mesurées (commune, EPCI, grand département,
+région) reprennent les volumes réels. Les contours sont des polygones
+irréguliers au nombre de sommets proche des contours geo.api non simplifiés,
+générés de façon déterministe (même graine -> mêmes octets), ce qui rend les
+mesures comparables d'un passage à l'autre.
+
+`respond(method, url)` joue le rôle des API amont (geo.api, api.insee.fr,
+france-geojson, tuiles IGN, fichier des mouvements du COG) et
+`get_local_data` / `get_population` celui de pynsee.
+"""
+import io
+import json
+import re
+from functools import lru_cache
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+REGION = "84"
+DEPARTEMENTS = ["01", "03", "07", "15", "26"]
+COMMUNES_PER_DEP = 890
+EPCI_SIZE = 40
+# Sommets par contour communal (ordre de grandeur des contours geo.api)
+VERTICES = 160
+
+# Territoire mesuré à chaque échelle : (code, kind, libellé, nombre de communes)
+SCALES = {
+    "commune": ("01001", "communes", "Commune synthétique 01001", 1),
+    "epci": ("200001000", "EPCI", "CC synthétique 000", EPCI_SIZE),
+    "departement": ("01", "departements", "Ain", COMMUNES_PER_DEP),
+    "region": (REGION, "regions", "Auvergne-Rhône-Alpes", COMMUNES_PER_DEP * len(DEPARTEMENTS)),
+}
+
+AGE_CLASSES = ["00", "15", "30", "45", "60", "75", "90"]
+AGE_WEIGHTS = np.array([0.17, 0.17, 0.18, 0.19, 0.15, 0.10, 0.04])
+
+
+def epci_of(dep, i):
+    return f"2000{dep}{i // EPCI_SIZE:03d}"
+
+
+def _polygon_coords(rng, cx, cy, radius, vertices):
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    wobble = 1 + 0.12 * np.sin(angles * rng.integers(3, 7)) + rng.normal(0, 0.03, vertices)
+    ring = np.column_stack([cx + radius * wobble * np.cos(angles), cy + radius * 0.7 * wobble * np.sin(angles)])
+    return np.vstack([ring, ring[:1]])
+
+
+@lru_cache(maxsize=None)
+def communes(dep=None):
+    """GeoDataFrame des communes synthétiques (toutes, ou celles d'un département) : code, nom, population, geometry."""
+    rows, geometries = [], []
+    side = int(np.ceil(np.sqrt(COMMUNES_PER_DEP)))
+    cell = 1.0 / side
+    for d, dep_code in enumerate(DEPARTEMENTS):
+        if dep is not None and dep_code != dep:
+            continue
+        rng = np.random.default_rng(int(dep_code))
+        x0, y0 = 3.0 + (d % 3) * 1.1, 44.5 + (d // 3) * 0.8
+        for i in range(COMMUNES_PER_DEP):
+            cx, cy = x0 + (i % side + 0.5) * cell, y0 + (i // side + 0.5) * cell * 0.7
+            geometries.append(shapely.Polygon(_polygon_coords(rng, cx, cy, cell * 0.48, VERTICES)))
+            rows.append({"code": f"{dep_code}{i + 1:03d}", "nom": f"Commune synthétique {dep_code}{i + 1:03d}",
+                         "population": int(rng.lognormal(6.5, 1.2)), "epci": epci_of(dep_code, i),
+                         "departement": dep_code})
+    return gpd.GeoDataFrame(rows, geometry=geometries, crs="EPSG:4326")
+
+
+def territory_gdf(scale):
+    """Communes du territoire mesuré à une échelle (GeoDataFrame)."""
+    code, kind, _, _ = SCALES[scale]
+    frame = communes()
+    column = {"communes": "code", "EPCI": "epci", "departements": "departement"}.get(kind)
+    return frame if column is None else frame[frame[column] == code].reset_index(drop=True)
+
+
+def _outline(frame):
+    """Contour d'un regroupement : enveloppe densifiée (ordre de grandeur des sommets d'un contour réel)."""
+    hull = frame.geometry.union_all().convex_hull.buffer(0.01)
+    return shapely.segmentize(hull, 0.005)
+
+
+def _feature(row, geometry=None):
+    properties = {"code": row["code"], "nom": row["nom"], "population": int(row["population"])}
+    return {"type": "Feature", "properties": properties,
+            "geometry": shapely.geometry.mapping(geometry if geometry is not None else row["geometry"])}
+
+
+def _collection(features):
+    return {"type": "FeatureCollection", "features": features}
+
+
+@lru_cache(maxsize=None)
+def _department_collection(dep):
+    return json.dumps(_collection([_feature(r) for _, r in communes(dep).iterrows()])).encode()
+
+
+@lru_cache(maxsize=None)
+def _group_collection(kind):
+    frame = communes()
+    column = {"departements": "departement", "regions": None}[kind]
+    groups = frame.groupby(column) if column else [(REGION, frame)]
+    features = [{"type": "Feature", "properties": {"code": code, "nom": f"Territoire {code}"},
+                 "geometry": shapely.geometry.mapping(_outline(group))} for code, group in groups]
+    return json.dumps(_collection(features)).encode()
+
+
+@lru_cache(maxsize=None)
+def tile_png():
+    """Tuile 256 × 256 PNG unie (fond de carte simulé)."""
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (256, 256), (238, 236, 230)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _json(payload, status=200):
+    return status, "application/json", json.dumps(payload).encode()
+
+
+def _members(kind, code):
+    frame = communes()
+    if kind == "epcis":
+        return frame[frame["epci"] == code]
+    if kind == "departements":
+        return frame[frame["departement"] == code]
+    if kind == "regions":
+        return frame if code == REGION else frame.iloc[:0]
+    return frame[frame["code"] == code]
+
+
+@lru_cache(maxsize=None)
+def respond(method, url):
+    """Réponse simulée (statut, type de contenu, corps) ; None pour une URL non couverte.
+
+    Mémorisée : le coût de l'amont simulé ne compte pas dans les mesures.
+    """
+    if "data.geopf.fr/wmts" in url:
+        return 200, "image/png", tile_png()
+    if "v_mvt_commune" in url:
+        # Aucun mouvement : géographie synthétique stable
+        return 200, "text/csv", b"MOD,DATE_EFF,TYPECOM_AV,COM_AV,LIBELLE_AV,TYPECOM_AP,COM_AP,LIBELLE_AP\n"
+    if "france-geojson" in url:
+        kind = "regions" if "regions" in url else "departements"
+        m = re.search(r"departements/(\w+)-", url)
+        if m and m.group(1) not in DEPARTEMENTS:
+            return 404, "text/plain", b""
+        return 200, "application/json", _group_collection(kind)
+    if "api.insee.fr/metadonnees/geo/" in url:
+        frame = communes()
+        if url.endswith("/communes"):
+            return _json([{"code": r.code, "intitule": r.nom} for r in frame.itertuples()])
+        if url.endswith("/departements"):
+            return _json([{"code": d, "intitule": f"Département {d}"} for d in DEPARTEMENTS])
+        if url.endswith("/regions"):
+            return _json([{"code": REGION, "intitule": SCALES["region"][2]}])
+        return _json([{"code": e, "intitule": f"CC synthétique {e[-3:]}"} for e in frame["epci"].unique()])
+    if "api.insee.fr/melodi" in url:
+        measures = [("MED_SL", 22150.0), ("PR_MD60", 13.2), ("GI", 0.27), ("D1_SL", 12100.0), ("D9_SL", 38900.0)]
+        return _json({"observations": [{"dimensions": {"FILOSOFI_MEASURE": k},
+                                         "measures": {"OBS_VALUE_NIVEAU": {"value": v}}} for k, v in measures]})
+
+    m = re.search(r"geo\.api\.gouv\.fr/(communes|epcis|departements|regions)/(\w+)(/communes)?\?(.*)$", url)
+    if not m:
+        return None
+    kind, code, children, query = m.groups()
+    members = _members(kind, code)
+    if members.empty:
+        return _json({"code": 404, "message": "not found"}, 404)
+    if children:
+        if "format=geojson" in query:
+            if kind == "departements":
+                return 200, "application/json", _department_collection(code)
+            return _json(_collection([_feature(r) for _, r in members.iterrows()]))
+        return _json([{"code": r.code, "nom": r.nom, "population": int(r.population)} for r in members.itertuples()])
+    if "format=geojson" in query:
+        if kind == "communes":
+            return _json(_feature(members.iloc[0]))
+        return _json({"type": "Feature", "properties": {"code": code, "nom": f"Territoire {code}"},
+                      "geometry": shapely.geometry.mapping(_outline(members))})
+    centre = members.geometry.union_all().centroid
+    payload = {"code": code, "nom": f"Territoire {code}", "population": int(members["population"].sum()),
+               "surface": round(float(members.to_crs(epsg=2154).area.sum() / 1e4), 1),
+               "centre": {"type": "Point", "coordinates": [centre.x, centre.y]}}
+    if kind == "communes":
+        payload.update({"codesPostaux": [f"{code[:2]}100"], "codeDepartement": code[:2], "codeRegion": REGION})
+    return _json(payload)
+
+
+def get_population(*args, **kwargs):
+    """Référentiel communal au format de pynsee.get_population."""
+    frame = communes()
+    return pd.DataFrame({
+        "code_insee": frame["code"], "nom_de_la_commune": frame["nom"], "population": frame["population"],
+        "codes_siren_des_epci": frame["epci"], "code_insee_du_departement": frame["departement"],
+        "code_insee_de_la_region": REGION,
+    })
+
+
+def get_local_data(dataset_version=None, nivgeo="COM", geocodes=None, variables=None, **kwargs):
+    """Données locales au format long de pynsee.get_local_data (une ligne par modalité)."""
+    codes = [str(c) for c in (geocodes or [])]
+    population = communes().set_index("code")["population"].reindex(codes).fillna(500).to_numpy(dtype=float)
+    n = len(codes)
+    variables = variables or ""
+    if variables.startswith("SEXE-AGE15_15_90"):
+        sexes, ages = np.meshgrid(["1", "2"], AGE_CLASSES, indexing="ij")
+        values = population[:, None] * np.tile(np.outer([0.49, 0.51], AGE_WEIGHTS).ravel(), (n, 1))
+        return pd.DataFrame({"CODEGEO": np.repeat(codes, sexes.size), "SEXE": np.tile(sexes.ravel(), n),
+                             "AGE15_15_90": np.tile(ages.ravel(), n), "OBS_VALUE": values.ravel()})
+    if variables.startswith("INDICS_FILO"):
+        units = ["MEDIANE", "NBPERS", "NBMEN", "TP60", "D1", "D9"]
+        per_unit = np.column_stack([21000 + population % 3000, population, population / 2.2,
+                                    8 + population % 9, 11000 + population % 800, 35000 + population % 4000])
+        return pd.DataFrame({"CODEGEO": np.repeat(codes, len(units)), "UNIT": np.tile(units, n),
+                             "OBS_VALUE": per_unit.ravel()})
+    if variables == "IND_POPLEGALES":
+        return pd.DataFrame({"CODEGEO": codes, "UNIT": "POPMUN", "OBS_VALUE": population})
+    # Variables RP génériques (ex. NA17-TYPMR…) : quelques modalités et le total
+    var = variables.split("-")[0]
+    modalities = ["1", "2", "10", "4", "11", "ENS"]
+    shares = np.array([0.3, 0.2, 0.1, 0.15, 0.25, 1.0])
+    return pd.DataFrame({"CODEGEO": np.repeat(codes, len(modalities)), var: np.tile(modalities, n),
+                         "SEXE": "1", "OBS_VALUE": (population[:, None] * shares).ravel()})
@@ -0,0 +1,84 @@
+"""Règles d'agrégation (aggregation.py) : valeurs attendues calculées à la main.
+
+Trois communes : les deux premières forment le groupe 0, la troisième le groupe 1.
+"""
+import numpy as np
+import pytest
+
+from aggregation import aggregate
+
+POPULATION = [100.0, 300.0, 50.0]
+GROUPS = np.array([0, 0, 1])
+
+
+def _aggregate(data, group_ids=GROUPS, n_groups=2, min_coverage=0.5):
+    """{colonne: valeurs par groupe} pour des colonnes données en {nom: valeurs par commune}."""
+    data = {"_population": POPULATION, **data}
+    columns = list(data)
+    out, coverage = aggregate(columns, np.array([data[c] for c in columns], dtype=np.float64),
+                              group_ids, n_groups, min_coverage)
+    return dict(zip(columns, out)), dict(zip(columns, coverage))
+
+
+def test_sum():
+    out, _ = _aggregate({"Population municipale": POPULATION})
+    np.testing.assert_allclose(out["Population municipale"], [400, 50])
+
+
+def test_ratio_sums_numerators_and_denominators():
+    out, _ = _aggregate({"_surface_km2": [10, 20, 5], "Densité de population (hab/km²)": [10, 15, 10],
+                         "_jeunes": [20, 30, 5], "_ages": [10, 50, 5], "Indice de jeunesse": [2, 0.6, 1]})
+    # (100 + 300) / (10 + 20) et (20 + 30) / (10 + 50), et non la moyenne des ratios communaux
+    np.testing.assert_allclose(out["Densité de population (hab/km²)"], [400 / 30, 10], rtol=1e-6)
+    np.testing.assert_allclose(out["Indice de jeunesse"], [50 / 60, 1], rtol=1e-6)
+
+
+def test_share_is_ratio_of_household_counts():
+    # Parts communales 10 % et 20 % : 100 × (4 + 20) / (40 + 100) = 17,14 %
+    # (la moyenne pondérée par la population donnerait 17,5 %, la moyenne simple 15 %)
+    out, _ = _aggregate({"_menages": [40, 100, 20], "_menages_pauvres": [4, 20, 2],
+                         "Part des ménages pauvres (%)": [10, 20, 10]})
+    np.testing.assert_allclose(out["Part des ménages pauvres (%)"], [100 * 24 / 140, 10], rtol=1e-6)
+
+
+def test_share_without_components_is_missing():
+    # Cube antérieur aux composantes de ménages : pas de repli sur une moyenne de taux
+    out, _ = _aggregate({"Part des ménages pauvres (%)": [10, 20, 10]})
+    assert np.isnan(out["Part des ménages pauvres (%)"]).all()
+
+
+def test_weighted_means():
+    out, _ = _aggregate({"Nombre d'individus au sens fiscal": [100, 300, 50],
+                         "Niveau de vie des individus (€)": [20000, 30000, 25000],
+                         "Part de la population étrangère (%)": [10, 30, 4]})
+    # Médiane : pondérée par les individus ; autre taux : par la population
+    np.testing.assert_allclose(out["Niveau de vie des individus (€)"], [27500, 25000])
+    np.testing.assert_allclose(out["Part de la population étrangère (%)"], [25, 4])
+
+
+def test_partial_sum_is_withheld():
+    out, _ = _aggregate({"Population municipale": [100, np.nan, 50], "_menages": [40, np.nan, 20]},
+                        min_coverage=0)
+    # Total publié : seulement si toutes les communes sont renseignées ; composante : somme partielle
+    assert np.isnan(out["Population municipale"][0]) and out["Population municipale"][1] == 50
+    np.testing.assert_allclose(out["_menages"], [40, 20])
+
+
+@pytest.mark.parametrize("min_coverage, expected", [(0.5, np.nan), (0.2, 10.0)])
+def test_coverage_threshold(min_coverage, expected):
+    out, coverage = _aggregate({"Part de la population étrangère (%)": [10, np.nan, 4]}, min_coverage=min_coverage)
+    # Commune renseignée : 100 habitants sur 400
+    np.testing.assert_allclose(coverage["Part de la population étrangère (%)"], [0.25, 1])
+    np.testing.assert_allclose(out["Part de la population étrangère (%)"], [expected, 4])
+
+
+def test_ratio_skips_communes_missing_an_operand():
+    out, coverage = _aggregate({"_jeunes": [20, np.nan, 5], "_ages": [10, 50, 5], "Indice de jeunesse": [2, 0, 1]},
+                               min_coverage=0)
+    np.testing.assert_allclose(out["Indice de jeunesse"], [2, 1])
+    np.testing.assert_allclose(coverage["Indice de jeunesse"], [0.25, 1])
+
+
+def test_communes_outside_any_group_are_ignored():
+    out, _ = _aggregate({"Population municipale": POPULATION}, group_ids=np.array([0, -1, 0]), n_groups=1)
+    np.testing.assert_allclose(out["Population municipale"], [150])
@@ -0,0 +1,65 @@
+"""Harmonisation des géographies communales (cog.py) : valeurs attendues calculées à la main.
+
+Entre 2020 et 2024 : fusion de 01002 dans 01001 (2022), rétablissement de 02002 à
+partir de 02001 (2023, populations 100 et 300 : parts 0,25 et 0,75) ; 03001 est inchangée.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from cog import RATE, STOCK, CogTransition
+
+MOVEMENTS = pd.DataFrame({
+    "mod": ["32", "32", "21", "21"],
+    "date": pd.to_datetime(["2022-01-01", "2022-01-01", "2023-01-01", "2023-01-01"]),
+    "av": ["01001", "01002", "02001", "02001"],
+    "ap": ["01001", "01001", "02001", "02002"],
+})
+POPULATIONS = {"02001": 100, "02002": 300}
+
+
+@pytest.fixture
+def transition():
+    return CogTransition.from_movements(MOVEMENTS, 2020, 2024, POPULATIONS)
+
+
+def _harmonize(transition, values, mode, weights=None):
+    return transition.harmonize(pd.Series(values, dtype=float), mode, weights).to_dict()
+
+
+def test_table(transition):
+    assert sorted(transition.sources) == ["01002", "02001"]
+    # Codes à demander : ceux qui s'y reportent, plus le code cible lui-même (absent en 2020 : sans effet)
+    assert transition.source_codes(["01001", "02002", "03001"]) == ["01001", "01002", "02001", "02002", "03001"]
+
+
+def test_movements_outside_window_are_ignored():
+    assert len(CogTransition.from_movements(MOVEMENTS, 2022, 2024, POPULATIONS)) == 1
+    assert len(CogTransition.from_movements(MOVEMENTS, 2023, 2024, POPULATIONS)) == 0
+
+
+def test_stock(transition):
+    out = _harmonize(transition, {"01001": 10, "01002": 5, "02001": 40, "03001": 7}, STOCK)
+    assert out == {"01001": 15, "02001": 10, "02002": 30, "03001": 7}
+
+
+def test_stock_with_missing_source_is_missing(transition):
+    out = _harmonize(transition, {"01001": 10, "01002": np.nan, "03001": 7}, STOCK)
+    assert np.isnan(out["01001"]) and out["03001"] == 7
+
+
+def test_rate_weighted_by_population(transition):
+    out = _harmonize(transition, {"01001": 10, "01002": 40, "02001": 20}, RATE,
+                     weights={"01001": 300, "01002": 100, "02001": 400})
+    # Fusion : (10 × 300 + 40 × 100) / 400 ; rétablissement : le taux de la commune d'origine
+    assert out == pytest.approx({"01001": 17.5, "02001": 20, "02002": 20})
+
+
+def test_rate_without_weights_is_plain_mean(transition):
+    out = _harmonize(transition, {"01001": 10, "01002": 40}, RATE)
+    assert out["01001"] == pytest.approx(25)
+
+
+def test_rate_skips_missing_source(transition):
+    out = _harmonize(transition, {"01001": 10, "01002": np.nan}, RATE, weights={"01001": 300, "01002": 100})
+    assert out["01001"] == pytest.approx(10)
@@ -0,0 +1,204 @@
+"""Construction nocturne du cube national d'indicateurs (voir indicator_cube.py).
+
+Calcule chaque indicateur d'INDICATORS_CONFIG pour toutes les communes, département
+par département (chaque département terminé est enregistré : une construction
+interrompue reprend là où elle s'était arrêtée), puis agrège aux niveaux EPCI,
+département et région (aggregation.py). La nouvelle version n'est activée qu'une fois complète.
+
+Usage (cron) :
+    python build_cube.py --workers 4
+"""
+import argparse
+import datetime
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+from aggregation import aggregate
+from indicator_cube import current_version_dir
+from insee_data import (
+    CUBE_DIR, INDICATORS_CONFIG, age_components, area_km2, fetch_department_contours, get_hierarchy, harmonized_values,
+)
+
+DENSITY = "Densité de population (hab/km²)"
+POPULATION = "Population municipale"
+YOUTH_INDEX = "Indice de jeunesse"
+HOUSEHOLDS = "Nombre de ménages fiscaux"
+# Jeu du recensement utilisé par l'application pour l'indice de jeunesse (cf. get_pynsee_indicators)
+YOUTH_DATASET = 'GEO2019RP2011'
+# Composantes techniques (cf. indicator_cube.COMPONENT_PREFIX) : numérateurs et
+# dénominateurs nécessaires à l'agrégation (voir aggregation.RULES)
+COMPONENTS = ["_population", "_surface_km2", "_jeunes", "_ages", "_menages", "_menages_pauvres", "_logements_sociaux"]
+# Numérateurs des parts de ménages : part communale (%) × ménages fiscaux
+SHARE_NUMERATORS = {"_menages_pauvres": "Part des ménages pauvres (%)",
+                    "_logements_sociaux": "Part des logements sociaux (%)"}
+# Nombre de versions conservées (la précédente reste disponible pour un retour arrière)
+KEEP_VERSIONS = 2
+
+
+def all_indicators():
+    return [i for group in INDICATORS_CONFIG.values() for i in group]
+
+
+def build_department(dep, columns, hierarchy):
+    """Valeurs (indicateurs × communes, float32) des communes d'un département."""
+    codes = hierarchy.communes_of(dep, "departements")
+    records = {r["code"]: r["population"] for r in hierarchy.commune_records(dep, "departements")}
+    population = np.array([records.get(c) if records.get(c) is not None else np.nan for c in codes])
+    values = np.full((len(columns), len(codes)), np.nan, dtype=np.float32)
+
+    surface = np.full(len(codes), np.nan)
+    contours = fetch_department_contours.__wrapped__(dep)
+    if contours is not None:
+        areas = area_km2(contours.set_index("code"))
+        surface = areas.reindex(codes).to_numpy(dtype=np.float64)
+
+    _, young, old = age_components(codes, YOUTH_DATASET)
+    for j, name in enumerate(columns):
+        if name in ("_population", POPULATION):
+            values[j] = population
+        elif name == "_surface_km2":
+            values[j] = surface
+        elif name == DENSITY:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                values[j] = population / surface
+        elif name in ("_jeunes", "_ages", YOUTH_INDEX):
+            if young is None:
+                continue
+            if name == YOUTH_INDEX:
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    values[j] = np.where(old > 0, young / old, np.nan)
+            else:
+                values[j] = young if name == "_jeunes" else old
+        elif name in SHARE_NUMERATORS:
+            continue  # dérivés des parts et des ménages, une fois toutes les colonnes calculées
+        elif name == "_menages":
+            series = harmonized_values(codes, HOUSEHOLDS, cache=False)
+            if series is not None:
+                values[j] = series.reindex(codes).to_numpy(dtype=np.float64)
+        else:
+            # Appel direct (hors cache Streamlit) : le cube est lui-même le cache
+            series = harmonized_values(codes, name, cache=False)
+            if series is not None:
+                values[j] = series.reindex(codes).to_numpy(dtype=np.float64)
+    row = {name: j for j, name in enumerate(columns)}
+    for name, share in SHARE_NUMERATORS.items():
+        if name in row and share in row and "_menages" in row:
+            values[row[name]] = values[row[share]] / 100 * values[row["_menages"]]
+    return codes, values
+
+
+def _save_atomic(path, array):
+    tmp = f"{path}.tmp.npy"
+    np.save(tmp, array)
+    os.replace(tmp, path)
+
+
+def build_cube(directory=CUBE_DIR, workers=4, departements=None):
+    """Construit une nouvelle version du cube et l'active ; retourne son répertoire.
+
+    Un cube limité à quelques départements (`departements`) remplacerait le cube
+    national de toutes les sessions : il n'est construit que hors de CUBE_DIR.
+    """
+    if departements and os.path.abspath(directory) == os.path.abspath(CUBE_DIR):
+        raise SystemExit("Cube partiel (--departements) : indiquer un répertoire --output distinct de "
+                         f"celui du cube servi ({CUBE_DIR}).")
+    hierarchy = get_hierarchy()
+    if hierarchy is None:
+        raise SystemExit("Référentiel communal indisponible : construction impossible.")
+    columns = all_indicators() + COMPONENTS
+    dep_codes, _ = hierarchy.groups("departements")
+    dep_codes = [d for d in (departements or dep_codes) if d]
+
+    # Points de reprise : un fichier par département terminé
+    work_dir = os.path.join(directory, "_build")
+    os.makedirs(work_dir, exist_ok=True)
+    signature = {"indicators": columns}
+    signature_path = os.path.join(work_dir, "signature.json")
+    if os.path.exists(signature_path):
+        with open(signature_path, encoding="utf-8") as f:
+            if json.load(f) != signature:
+                shutil.rmtree(work_dir)
+                os.makedirs(work_dir)
+    with open(signature_path, "w", encoding="utf-8") as f:
+        json.dump(signature, f)
+
+    todo = [d for d in dep_codes if not os.path.exists(os.path.join(work_dir, f"{d}.npz"))]
+    print(f"{len(dep_codes)} départements, {len(dep_codes) - len(todo)} déjà calculés, {len(todo)} à calculer.")
+
+    def _process(dep):
+        t0 = time.perf_counter()
+        codes, values = build_department(dep, columns, hierarchy)
+        tmp = os.path.join(work_dir, f"{dep}.tmp.npz")
+        np.savez(tmp, codes=np.array(codes, dtype=str), values=values)
+        os.replace(tmp, os.path.join(work_dir, f"{dep}.npz"))
+        return len(codes), time.perf_counter() - t0
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_process, d): d for d in todo}
+        for i, future in enumerate(as_completed(futures), 1):
+            dep = futures[future]
+            try:
+                n, duration = future.result()
+                print(f"[{i}/{len(todo)}] {dep} : {n} communes ({duration:.1f} s)")
+            except Exception as e:
+                print(f"[{i}/{len(todo)}] {dep} : échec ({e})")
+
+    # Assemblage dans l'ordre du référentiel
+    parts = {}
+    for dep in dep_codes:
+        path = os.path.join(work_dir, f"{dep}.npz")
+        if os.path.exists(path):
+            with np.load(path) as part:
+                parts[dep] = (part["codes"].tolist(), part["values"])
+    missing = [d for d in dep_codes if d not in parts]
+    if missing:
+        raise SystemExit(f"{len(missing)} départements en échec ({', '.join(missing[:10])}) : relancer la construction.")
+
+    position = {c: i for i, c in enumerate(hierarchy.codes)}
+    communes = np.full((len(columns), len(hierarchy.codes)), np.nan, dtype=np.float32)
+    for codes, values in parts.values():
+        communes[:, [position[c] for c in codes]] = values
+
+    version = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    version_dir = os.path.join(directory, version)
+    os.makedirs(version_dir)
+    levels = {"communes": hierarchy.codes.tolist()}
+    _save_atomic(os.path.join(version_dir, "communes.npy"), communes)
+    for level in ("intercommunalites", "departements", "regions"):
+        group_codes, group_ids = hierarchy.groups(level)
+        rolled, coverage = aggregate(columns, communes, group_ids, len(group_codes))
+        keep = np.flatnonzero(group_codes != "")
+        levels[level] = group_codes[keep].tolist()
+        _save_atomic(os.path.join(version_dir, f"{level}.npy"), np.ascontiguousarray(rolled[:, keep]))
+        _save_atomic(os.path.join(version_dir, f"{level}.coverage.npy"), np.ascontiguousarray(coverage[:, keep]))
+    with open(os.path.join(version_dir, "index.json"), "w", encoding="utf-8") as f:
+        json.dump({"built_at": datetime.datetime.now().isoformat(timespec="seconds"),
+                   "indicators": columns, "levels": levels}, f, ensure_ascii=False)
+
+    # Activation atomique de la nouvelle version, puis nettoyage
+    tmp = os.path.join(directory, "CURRENT.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(tmp, os.path.join(directory, "CURRENT"))
+    shutil.rmtree(work_dir)
+    versions = sorted(d for d in os.listdir(directory)
+                      if os.path.isdir(os.path.join(directory, d)) and not d.startswith("_"))
+    for old in versions[:-KEEP_VERSIONS]:
+        shutil.rmtree(os.path.join(directory, old), ignore_errors=True)
+    print(f"Cube {version} activé : {len(columns)} indicateurs × {len(hierarchy.codes)} communes.")
+    return current_version_dir(directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Construit le cube national des indicateurs communaux.")
+    parser.add_argument("--workers", type=int, default=4, help="Départements traités en parallèle")
+    parser.add_argument("--departements", nargs="*",
+                        help="Limiter à quelques départements (tests ; exige --output hors du cube servi)")
+    parser.add_argument("--output", default=CUBE_DIR)
+    args = parser.parse_args()
+    build_cube(args.output, args.workers, args.departements)
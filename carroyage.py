@@ -0,0 +1,345 @@
+"""Données carroyées FILOSOFI (carreaux de 200 m et 1 km) stockées et rendues localement.
+
+Les fichiers nationaux de l'Insee (plusieurs millions de carreaux) sont
+convertis une fois en tableaux .npy par département, projetés en mémoire à la
+lecture. Dans chaque département, les carreaux sont triés par tuile de
+10 km : un petit répertoire de tuiles (clé → position) permet de ne lire que
+la fenêtre couvrant le territoire affiché.
+
+Le rendu est un raster : les carreaux sont découpés selon le contour du
+territoire puis rééchantillonnés en Web Mercator dans une image PNG affichée
+en ImageOverlay (aucun GeoJSON par carreau).
+
+Disposition sur disque :
+    <CARROYAGE_DIR>/<résolution>/meta.json           variables, taille des tuiles, date
+    <CARROYAGE_DIR>/<résolution>/<dep>/cells.npy     coin sud-ouest (x, y) en EPSG:3035, int32 (2, n)
+    <CARROYAGE_DIR>/<résolution>/<dep>/values.npy    variables × carreaux, float32
+    <CARROYAGE_DIR>/<résolution>/<dep>/tiles.npy     clés de tuiles triées, int64
+    <CARROYAGE_DIR>/<résolution>/<dep>/offsets.npy   début de chaque tuile (+ fin), int64
+
+Usage :
+    python carroyage.py carreaux_200m_met.csv --resolution 200m
+    python carroyage.py carreaux_1km_met.gpkg --resolution 1km
+"""
+import argparse
+import base64
+import datetime
+import io
+import json
+import os
+import shutil
+import threading
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from insee_data import DATA_DIR, departements_of, fetch_department_contours, get_communes_of_territory, get_hierarchy
+import telemetry
+
+CARROYAGE_DIR = os.getenv("CARROYAGE_DIR", os.path.join(DATA_DIR, "carroyage"))
+
+GRID_CATEGORY = "Filosofi 2021 (carreau 200m et 1km)"
+RESOLUTIONS = {"200m": 200, "1km": 1000}
+RESOLUTION_LABELS = {"200m": "Carroyage 200 m", "1km": "Carroyage 1 km"}
+
+# Tuiles de l'index spatial (mètres, EPSG:3035) ; clé = ty * TILE_STRIDE + tx
+TILE_SIZE = 10_000
+TILE_STRIDE = 10_000
+# Côté maximal de l'image rendue (pixels)
+MAX_IMAGE_SIDE = 1024
+OVERLAY_OPACITY = 0.8
+
+# Indicateur -> (variables sommées au numérateur, au dénominateur, facteur)
+GRID_INDICATORS = {
+    "Niveau de vie des individus (€)": (("ind_snv",), ("ind",), 1),
+    "Nombre d'individus au sens fiscal": (("ind",), (), 1),
+    "Part des familles monoparentales (%) (Filo)": (("men_fmp",), ("men",), 100),
+    "Part des logements sociaux (%)": (("log_soc",), ("log_av45", "log_45_70", "log_70_90", "log_ap90", "log_inc"), 100),
+    "Part des ménages pauvres (%)": (("men_pauv",), ("men",), 100),
+    "Part des ménages propriétaires (%)": (("men_prop",), ("men",), 100),
+    "Part des ménages d'une seule personne (%)": (("men_1ind",), ("men",), 100),
+    "Part des ménages de 5 personnes ou plus (%)": (("men_5ind",), ("men",), 100),
+    "Part des personnes âgées de moins de 18 ans (%)": (("ind_0_3", "ind_4_5", "ind_6_10", "ind_11_17"), ("ind",), 100),
+    "Part des personnes âgées de 65 ans ou plus (%)": (("ind_65_79", "ind_80p"), ("ind",), 100),
+    "Surface moyenne des logements (m²)": (("men_surf",), ("men",), 1),
+}
+VARIABLES = sorted({v for num, den, _ in GRID_INDICATORS.values() for v in num + den})
+
+
+def _tile_keys(x, y):
+    return (np.asarray(y, dtype=np.int64) // TILE_SIZE) * TILE_STRIDE + np.asarray(x, dtype=np.int64) // TILE_SIZE
+
+
+def _departement_lookup():
+    """Dictionnaire commune -> département (référentiel local, repli sur le préfixe du code)."""
+    hierarchy = get_hierarchy()
+    if hierarchy is None:
+        return {}
+    return {c: hierarchy.parent(c, "communes", "departements") for c in hierarchy.codes.tolist()}
+
+
+def _prepare_chunk(df, id_column, lookup):
+    """Carreaux d'un bloc du fichier source : coordonnées, département(s), variables."""
+    df = df.rename(columns=str.lower)
+    xy = df[id_column].str.extract(r"N(\d+)E(\d+)").astype(np.int64)
+    out = pd.DataFrame({"x": xy[1].to_numpy(), "y": xy[0].to_numpy()})
+    for var in VARIABLES:
+        out[var] = pd.to_numeric(df[var], errors="coerce").astype(np.float32) if var in df else np.nan
+    # Un carreau à cheval sur plusieurs communes (lcog_geo : codes concaténés) est rangé
+    # dans chacun des départements concernés ; les doublons sont éliminés à la lecture
+    lcog = pd.Series(df["lcog_geo"].fillna("").astype(str).to_numpy())
+    frames = []
+    for start in range(0, int(lcog.str.len().max()), 5):
+        communes = lcog.str[start:start + 5]
+        present = communes.str.len() == 5
+        communes = communes[present]
+        prefix = communes.str[:2].where(~communes.str.startswith("97"), communes.str[:3])
+        frames.append(out[present.to_numpy()].assign(dep=communes.map(lookup).fillna(prefix).to_numpy()))
+    if not frames:
+        return out.assign(dep=pd.Series(dtype=str)).iloc[:0]
+    return pd.concat(frames).drop_duplicates(["x", "y", "dep"])
+
+
+def build_carroyage(source, resolution="200m", directory=CARROYAGE_DIR, chunksize=500_000):
+    """Convertit un fichier carroyé FILOSOFI (CSV ou GPKG) en stock local par département."""
+    if resolution not in RESOLUTIONS:
+        raise SystemExit(f"Résolution inconnue : {resolution}")
+    id_column = f"idcar_{resolution}"
+    lookup = _departement_lookup()
+
+    if source.lower().endswith(".csv"):
+        usecols = lambda c: c.lower() in {id_column, "lcog_geo", *VARIABLES}
+        chunks = pd.read_csv(source, usecols=usecols, dtype=str, chunksize=chunksize)
+    else:
+        chunks = [gpd.read_file(source, ignore_geometry=True)]
+    parts = []
+    for i, chunk in enumerate(chunks, 1):
+        parts.append(_prepare_chunk(chunk, id_column, lookup))
+        print(f"bloc {i} : {sum(len(p) for p in parts)} carreaux lus")
+    cells = pd.concat(parts, ignore_index=True)
+
+    target = os.path.join(directory, resolution)
+    tmp = f"{target}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for dep, group in cells.groupby("dep", sort=True):
+        group = group.drop_duplicates(["x", "y"])
+        keys = _tile_keys(group["x"], group["y"])
+        order = np.lexsort((group["x"].to_numpy(), group["y"].to_numpy(), keys))
+        keys = keys[order]
+        tiles, starts = np.unique(keys, return_index=True)
+        dep_dir = os.path.join(tmp, dep)
+        os.makedirs(dep_dir)
+        np.save(os.path.join(dep_dir, "cells.npy"), group[["x", "y"]].to_numpy(dtype=np.int32)[order].T.copy())
+        np.save(os.path.join(dep_dir, "values.npy"), group[VARIABLES].to_numpy(dtype=np.float32)[order].T.copy())
+        np.save(os.path.join(dep_dir, "tiles.npy"), tiles)
+        np.save(os.path.join(dep_dir, "offsets.npy"), np.append(starts, len(keys)).astype(np.int64))
+    with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"resolution": RESOLUTIONS[resolution], "tile_size": TILE_SIZE, "variables": VARIABLES,
+                   "source": os.path.basename(source),
+                   "built_at": datetime.datetime.now().isoformat(timespec="seconds")}, f, ensure_ascii=False)
+
+    # Remplacement de l'ancienne version (les lecteurs en cours gardent leurs fichiers ouverts)
+    old = f"{target}.old"
+    if os.path.isdir(target):
+        os.replace(target, old)
+    os.replace(tmp, target)
+    shutil.rmtree(old, ignore_errors=True)
+    print(f"{cells[['x', 'y']].drop_duplicates().shape[0]} carreaux de {resolution} "
+          f"répartis en {cells['dep'].nunique()} départements dans {target}")
+    return target
+
+
+class GridStore:
+    """Stock carroyé d'une résolution : lectures par fenêtre dans des tableaux projetés en mémoire."""
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.path = path
+        self.resolution = meta["resolution"]
+        self.tile_size = meta["tile_size"]
+        self.built_at = meta.get("built_at")
+        self._row = {name: i for i, name in enumerate(meta["variables"])}
+        self._parts = {}
+        self._lock = threading.Lock()
+
+    def _part(self, dep):
+        with self._lock:
+            if dep not in self._parts:
+                dep_dir = os.path.join(self.path, dep)
+                if not os.path.isdir(dep_dir):
+                    self._parts[dep] = None
+                else:
+                    self._parts[dep] = {name: np.load(os.path.join(dep_dir, f"{name}.npy"), mmap_mode="r")
+                                        for name in ("cells", "values", "tiles", "offsets")}
+            return self._parts[dep]
+
+    def window(self, dep, bbox, variables):
+        """Carreaux d'un département dont le coin sud-ouest est dans la fenêtre (EPSG:3035).
+
+        Retourne (x, y, {variable: valeurs}) ; seules les tuiles touchées sont lues.
+        """
+        part = self._part(dep)
+        empty = np.empty(0, dtype=np.int64)
+        if part is None:
+            return empty, empty, {v: np.empty(0, dtype=np.float32) for v in variables}
+        minx, miny, maxx, maxy = bbox
+        tx = np.arange(int(minx - self.resolution) // self.tile_size, int(maxx) // self.tile_size + 1)
+        ty = np.arange(int(miny - self.resolution) // self.tile_size, int(maxy) // self.tile_size + 1)
+        wanted = (ty[:, None] * TILE_STRIDE + tx[None, :]).ravel()
+        tiles = part["tiles"]
+        pos = np.searchsorted(tiles, wanted)
+        hit = pos[(pos < len(tiles)) & (tiles[np.minimum(pos, len(tiles) - 1)] == wanted)]
+        offsets = part["offsets"]
+        ranges = [(offsets[i], offsets[i + 1]) for i in hit]
+        if not ranges:
+            return empty, empty, {v: np.empty(0, dtype=np.float32) for v in variables}
+        idx = np.concatenate([np.arange(a, b) for a, b in ranges])
+        x = part["cells"][0, idx].astype(np.int64)
+        y = part["cells"][1, idx].astype(np.int64)
+        keep = (x + self.resolution > minx) & (x < maxx) & (y + self.resolution > miny) & (y < maxy)
+        idx = idx[keep]
+        return x[keep], y[keep], {v: np.asarray(part["values"][self._row[v], idx]) for v in variables}
+
+
+@telemetry.cache_resource(show_spinner=False)
+def get_grid_store(resolution):
+    """Stock carroyé partagé entre les sessions (None s'il n'a pas été construit)."""
+    path = os.path.join(CARROYAGE_DIR, resolution)
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        return None
+    try:
+        return GridStore(path)
+    except (OSError, ValueError, KeyError) as e:
+        telemetry.record_error(f"get_grid_store error: {e}")
+        return None
+
+
+def available_resolutions():
+    return [r for r in RESOLUTIONS if get_grid_store(r) is not None]
+
+
+def grid_indicator(values, indicator):
+    """Valeur d'un indicateur par carreau à partir des variables brutes (NaN si dénominateur nul)."""
+    numerator, denominator, factor = GRID_INDICATORS[indicator]
+    num = np.sum([np.asarray(values[v], dtype=np.float64) for v in numerator], axis=0)
+    if not denominator:
+        return num
+    den = np.sum([np.asarray(values[v], dtype=np.float64) for v in denominator], axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(den > 0, num / den * factor, np.nan)
+
+
+@telemetry.cache_data(show_spinner=False)
+def territory_geometry(code, kind):
+    """Contour d'un territoire (WKB, EPSG:4326) et départements qu'il couvre."""
+    if kind == "communes":
+        departements = departements_of([code])
+        frames = [g for g in (fetch_department_contours(d) for d in departements) if g is not None]
+        if not frames:
+            return None, departements
+        gdf = pd.concat(frames, ignore_index=True)
+        gdf = gdf[gdf["code"] == code]
+    else:
+        gdf = get_communes_of_territory(code, kind)
+        if gdf is None:
+            return None, []
+        departements = departements_of(gdf["code"].tolist())
+    if gdf.empty:
+        return None, departements
+    return shapely.to_wkb(gdf.geometry.union_all()), departements
+
+
+@telemetry.cache_data(show_spinner=False, max_entries=64)
+def grid_overlay(geometry_wkb, departements, indicator, resolution="200m", cmap="YlOrRd"):
+    """Image PNG des carreaux d'un territoire, découpés selon son contour.
+
+    Retourne un dict : 'image' (URL data: PNG), 'bounds' ([[sud, ouest], [nord, est]]),
+    'vmin' / 'vmax' (bornes de l'échelle), 'colors' (palette), 'cells' (carreaux
+    représentés) ; None si aucun carreau n'est renseigné.
+    """
+    import matplotlib
+    import matplotlib.pyplot as plt
+    from pyproj import Transformer
+
+    store = get_grid_store(resolution)
+    if store is None or indicator not in GRID_INDICATORS:
+        return None
+    res = store.resolution
+    territory = gpd.GeoSeries([shapely.from_wkb(geometry_wkb)], crs="EPSG:4326")
+    shape_3035 = territory.to_crs(epsg=3035).iloc[0]
+    numerator, denominator, _ = GRID_INDICATORS[indicator]
+    variables = list(dict.fromkeys(numerator + denominator))
+
+    xs, ys, columns = [], [], {v: [] for v in variables}
+    for dep in departements:
+        x, y, values = store.window(dep, shape_3035.bounds, variables)
+        xs.append(x)
+        ys.append(y)
+        for v in variables:
+            columns[v].append(values[v])
+    x, y = np.concatenate(xs), np.concatenate(ys)
+    if x.size == 0:
+        return None
+    # Carreaux présents dans plusieurs départements : une seule occurrence
+    _, first = np.unique(y * 10**8 + x, return_index=True)
+    x, y = x[first], y[first]
+    value = grid_indicator({v: np.concatenate(columns[v])[first] for v in variables}, indicator)
+
+    # Découpage : carreaux dont le centre est dans le territoire
+    shapely.prepare(shape_3035)
+    keep = shapely.contains_xy(shape_3035, x + res / 2, y + res / 2) & np.isfinite(value)
+    if not keep.any():
+        return None
+    x, y, value = x[keep], y[keep], value[keep]
+
+    # Grille locale en EPSG:3035
+    gx0, gy0 = x.min(), y.min()
+    local = np.full(((y.max() - gy0) // res + 1, (x.max() - gx0) // res + 1), np.nan, dtype=np.float32)
+    local[(y - gy0) // res, (x - gx0) // res] = value
+
+    # Image en Web Mercator (ce que Leaflet étire entre les coins de l'overlay)
+    minx, miny, maxx, maxy = territory.to_crs(epsg=3857).total_bounds
+    lat = np.radians((territory.total_bounds[1] + territory.total_bounds[3]) / 2)
+    # Au moins deux pixels par carreau, au plus MAX_IMAGE_SIDE pixels de côté
+    pixel = max(res / np.cos(lat) / 2, max(maxx - minx, maxy - miny) / MAX_IMAGE_SIDE)
+    width, height = int(np.ceil((maxx - minx) / pixel)), int(np.ceil((maxy - miny) / pixel))
+    px, py = np.meshgrid(minx + (np.arange(width) + 0.5) * pixel, maxy - (np.arange(height) + 0.5) * pixel)
+    ex, ey = Transformer.from_crs(3857, 3035, always_xy=True).transform(px.ravel(), py.ravel())
+    col = np.floor((ex - gx0) / res).astype(np.int64)
+    row = np.floor((ey - gy0) / res).astype(np.int64)
+    inside = (col >= 0) & (col < local.shape[1]) & (row >= 0) & (row < local.shape[0])
+    image = np.full(width * height, np.nan, dtype=np.float32)
+    image[inside] = local[row[inside], col[inside]]
+    image = image.reshape(height, width)
+
+    vmin, vmax = np.nanpercentile(value, [2, 98])
+    if vmax <= vmin:
+        vmax = vmin + 1
+    colormap = matplotlib.colormaps[cmap]
+    rgba = colormap(np.clip((image - vmin) / (vmax - vmin), 0, 1))
+    rgba[..., 3] = np.where(np.isnan(image), 0.0, OVERLAY_OPACITY)
+    buffer = io.BytesIO()
+    plt.imsave(buffer, rgba, format="png")
+
+    lon, lat = Transformer.from_crs(3857, 4326, always_xy=True).transform([minx, maxx], [miny, maxy])
+    return {
+        "image": "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode("ascii"),
+        "bounds": [[lat[0], lon[0]], [lat[1], lon[1]]],
+        "vmin": float(vmin),
+        "vmax": float(vmax),
+        "colors": [matplotlib.colors.to_hex(colormap(t)) for t in np.linspace(0, 1, 9)],
+        "cells": int(keep.sum()),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convertit les données carroyées FILOSOFI en stock local.")
+    parser.add_argument("source", help="Fichier Insee des carreaux (CSV ou GPKG)")
+    parser.add_argument("--resolution", default="200m", choices=list(RESOLUTIONS))
+    parser.add_argument("--output", default=CARROYAGE_DIR)
+    args = parser.parse_args()
+    build_carroyage(args.source, args.resolution, args.output)
@@ -0,0 +1,172 @@
+"""Harmonisation des géographies communales entre millésimes du Code officiel géographique (COG).
+
+Les jeux pynsee (GEO2021…, GEO2019…), les contours geo.api et le référentiel de
+population ne sont pas tous à la même date : fusions (communes nouvelles),
+rétablissements et changements de code font que certains codes n'ont pas
+d'équivalent d'un millésime à l'autre.
+
+L'historique des mouvements (fichier « mvtcommune » de l'Insee) est rejoué une
+fois entre deux dates pour obtenir une table de passage : chaque code source
+concerné est réparti sur un ou plusieurs codes cibles avec une part (1 pour
+une fusion ou un changement de code, part de population cible pour une
+scission). L'application à un jeu de données est vectorisée (un seul
+np.bincount) :
+    - stock (population, effectifs) : somme des parts reçues ;
+    - taux / ratio : moyenne pondérée des communes d'origine (une commune
+      rétablie reçoit le taux de la commune dont elle est issue).
+"""
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+STOCK = "stock"
+RATE = "rate"
+
+# Colonnes du fichier mvtcommune (noms selon les millésimes)
+MOVEMENT_COLUMNS = {
+    "MOD": "mod", "DATE_EFF": "date",
+    "TYPECOM_AV": "type_av", "COM_AV": "av", "TYPECOM_AP": "type_ap", "COM_AP": "ap",
+}
+# Type de commune : seules les communes (pas les communes déléguées / associées) portent les données
+COMMUNE_TYPE = "COM"
+
+
+def parse_movements(frame):
+    """Mouvements commune → commune du fichier mvtcommune, triés par date d'effet."""
+    frame = frame.rename(columns={k: v for k, v in MOVEMENT_COLUMNS.items() if k in frame.columns})
+    frame = frame.rename(columns=str.lower)
+    frame = frame[(frame["type_av"] == COMMUNE_TYPE) & (frame["type_ap"] == COMMUNE_TYPE)]
+    movements = pd.DataFrame({
+        "mod": frame["mod"].astype(str),
+        "date": pd.to_datetime(frame["date"], errors="coerce"),
+        "av": frame["av"].astype(str).str.zfill(5),
+        "ap": frame["ap"].astype(str).str.zfill(5),
+    }).dropna(subset=["date"])
+    return movements.sort_values(["date", "mod"], kind="stable").reset_index(drop=True)
+
+
+class CogTransition:
+    """Table de passage des codes communes d'un millésime source vers un millésime cible.
+
+    Seuls les codes touchés par un mouvement figurent dans la table ; tout autre
+    code est conservé tel quel.
+    """
+
+    def __init__(self, sources, targets, shares):
+        sources = np.asarray(sources, dtype=str)
+        order = np.argsort(sources, kind="stable")
+        sources, self.targets, self.shares = sources[order], np.asarray(targets, dtype=str)[order], \
+            np.asarray(shares, dtype=np.float64)[order]
+        unique, starts = np.unique(sources, return_index=True)
+        self.sources = pd.Index(unique)
+        self.offsets = np.append(starts, len(sources)).astype(np.int64)
+        self._reverse = defaultdict(list)
+        for source, target in zip(sources, self.targets):
+            self._reverse[str(target)].append(str(source))
+
+    def __len__(self):
+        return len(self.sources)
+
+    @classmethod
+    def from_movements(cls, movements, source_year, target_year, populations=None):
+        """Rejoue les mouvements effectifs entre le 1er janvier de `source_year` (exclu) et celui de `target_year`.
+
+        `populations` (code cible -> population) sert à répartir une commune scindée ;
+        à défaut, les parts sont égales.
+        """
+        populations = populations or {}
+        window = movements[(movements["date"] > pd.Timestamp(source_year, 1, 1))
+                           & (movements["date"] <= pd.Timestamp(target_year, 1, 1))]
+        state = {}                   # code source -> {code courant: part}
+        holders = defaultdict(set)   # code courant -> codes sources qui y contribuent
+        for _, event in window.groupby(["date", "mod"], sort=True):
+            for av, aps in event.groupby("av")["ap"]:
+                aps = sorted(set(aps))
+                if aps == [av]:
+                    continue
+                weights = np.array([populations.get(ap, np.nan) for ap in aps], dtype=np.float64)
+                if np.isnan(weights).any() or weights.sum() <= 0:
+                    weights = np.ones(len(aps))
+                split = dict(zip(aps, weights / weights.sum()))
+                sources = holders.pop(av, set())
+                if av not in state:
+                    # Code jamais déplacé jusqu'ici : il contribue à lui-même
+                    sources.add(av)
+                for source in sources:
+                    current = state.setdefault(source, {av: 1.0})
+                    share = current.pop(av, 0.0)
+                    for ap, w in split.items():
+                        current[ap] = current.get(ap, 0.0) + share * w
+                        holders[ap].add(source)
+        sources, targets, shares = [], [], []
+        for source, current in state.items():
+            if current == {source: 1.0}:
+                continue
+            for target, share in current.items():
+                sources.append(source)
+                targets.append(target)
+                shares.append(share)
+        return cls(sources, targets, shares)
+
+    def source_codes(self, target_codes):
+        """Codes à demander dans la géographie source pour couvrir des communes cibles."""
+        codes = []
+        for target in target_codes:
+            target = str(target)
+            codes.extend(self._reverse.get(target, []))
+            if target not in self.sources:
+                codes.append(target)
+        return sorted(set(codes))
+
+    def affected_codes(self, source_codes):
+        """Codes sources regroupés ou répartis par un mouvement (ceux dont le poids compte pour un taux)."""
+        positions = self.sources.get_indexer([str(c) for c in source_codes])
+        touched = set()
+        for i in positions[positions >= 0]:
+            touched.update(self.targets[self.offsets[i]:self.offsets[i + 1]].tolist())
+        return sorted({str(c) for c, i in zip(source_codes, positions) if i >= 0 or str(c) in touched})
+
+    def harmonize(self, values, mode=STOCK, weights=None):
+        """Reporte une série indexée par codes sources sur les codes cibles (pd.Series).
+
+        En mode STOCK, une cible dont une partie des sources est manquante est NaN ;
+        en mode RATE, la moyenne est pondérée par `weights` (population des
+        communes sources, si disponible) × part, sur les sources renseignées.
+        """
+        values = pd.Series(values)
+        codes = values.index.astype(str).to_numpy()
+        data = pd.to_numeric(values, errors="coerce").to_numpy(dtype=np.float64)
+        pos = self.sources.get_indexer(codes)
+        kept = np.flatnonzero(pos < 0)
+        moved = np.flatnonzero(pos >= 0)
+        # Arêtes des codes concernés : toutes les cibles de chaque source, sans boucle Python
+        starts, ends = self.offsets[pos[moved]], self.offsets[pos[moved] + 1]
+        counts = ends - starts
+        edge = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        rows = np.concatenate([kept, np.repeat(moved, counts)])
+        targets = np.concatenate([codes[kept], self.targets[edge]])
+        shares = np.concatenate([np.ones(len(kept)), self.shares[edge]])
+
+        inverse, target_codes = pd.factorize(targets)
+        v = data[rows]
+        missing = np.isnan(v)
+        if mode == STOCK:
+            totals = np.bincount(inverse, weights=np.where(missing, 0.0, v * shares), minlength=len(target_codes))
+            incomplete = np.bincount(inverse, weights=missing, minlength=len(target_codes)) > 0
+            result = np.where(incomplete, np.nan, totals)
+        else:
+            w = shares.copy()
+            if weights is not None:
+                source_weights = pd.to_numeric(pd.Series(weights), errors="coerce")
+                source_weights.index = source_weights.index.astype(str)
+                w *= np.nan_to_num(source_weights.reindex(codes).to_numpy(dtype=np.float64)[rows], nan=0.0)
+                # Sans poids pour une cible : moyenne simple des parts
+                no_weight = np.bincount(inverse, weights=w, minlength=len(target_codes)) <= 0
+                w = np.where(no_weight[inverse], shares, w)
+            w = np.where(missing, 0.0, w)
+            num = np.bincount(inverse, weights=np.where(missing, 0.0, v) * w, minlength=len(target_codes))
+            den = np.bincount(inverse, weights=w, minlength=len(target_codes))
+            with np.errstate(divide="ignore", invalid="ignore"):
+                result = np.where(den > 0, num / den, np.nan)
+        return pd.Series(result, index=pd.Index(target_codes, dtype=str), name=values.name)
@@ -0,0 +1,122 @@
+"""Territoires personnalisés : regroupements libres de communes (bassin de vie, SCoT, sélection manuelle).
+
+Un territoire est défini par une liste de codes communes (saisie ou fichier) ou
+par un polygone dessiné sur la carte. Contours (union des formes simplifiées)
+et indicateurs (agrégés depuis le cube communal, voir aggregation.py) sont
+calculés à partir des données déjà en cache, sans requête par commune.
+"""
+import hashlib
+import re
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from aggregation import aggregate_custom
+from insee_data import (
+    area_km2, departements_of, fetch_department_contours, get_cube, get_departements_contours, get_hierarchy,
+)
+import telemetry
+
+CUSTOM_KIND = "custom"
+CUSTOM_LABEL = "Territoire personnalisé"
+
+# Codes communes : 5 caractères, Corse comprise (2A / 2B)
+CODE_PATTERN = re.compile(r"\b(\d{5}|2[AB]\d{3})\b")
+
+# Indicateurs agrégés -> libellés des cartes de la vue générale
+CARD_KEYS = {
+    "Population municipale": "Population",
+    "Densité de population (hab/km²)": "Densité (hab/km²)",
+    "Niveau de vie des individus (€)": "Niveau de vie Médian (€)",
+    "Part des ménages pauvres (%)": "Taux de pauvreté (%)",
+}
+
+
+def parse_codes(text):
+    """Codes communes connus du référentiel, dans l'ordre d'apparition et sans doublon."""
+    if isinstance(text, bytes):
+        text = text.decode("utf-8", errors="ignore")
+    hierarchy = get_hierarchy()
+    codes = []
+    seen = set()
+    for code in CODE_PATTERN.findall(text.upper()):
+        if code in seen:
+            continue
+        seen.add(code)
+        if hierarchy is None or hierarchy.communes_of(code, "communes"):
+            codes.append(code)
+    return codes
+
+
+def territory_code(codes):
+    """Identifiant stable d'un regroupement (indépendant de l'ordre des codes)."""
+    digest = hashlib.sha1(",".join(sorted(codes)).encode("utf-8")).hexdigest()[:10]
+    return f"PERSO-{digest}"
+
+
+def _communes_frame(departements):
+    frames = [g for g in (fetch_department_contours(d) for d in departements) if g is not None]
+    if not frames:
+        return None
+    communes = pd.concat(frames, ignore_index=True).drop_duplicates("code")
+    return gpd.GeoDataFrame(communes, crs="EPSG:4326")
+
+
+@telemetry.cache_data(show_spinner=False)
+def communes_in_polygon(geojson_geometry):
+    """Codes des communes dont le point représentatif est dans le polygone dessiné."""
+    from shapely.geometry import shape
+
+    polygon = shape(geojson_geometry)
+    departements = get_departements_contours()
+    if departements is None:
+        return []
+    touched = departements[departements.intersects(polygon)]["code"].tolist()
+    communes = _communes_frame(touched)
+    if communes is None:
+        return []
+    inside = communes[communes.representative_point().within(polygon)]
+    return sorted(inside["code"].tolist())
+
+
+@telemetry.cache_data(show_spinner=False)
+def build_custom_territory(codes):
+    """Contours et indicateurs d'un regroupement de communes.
+
+    Retourne un dict : 'communes' (GeoDataFrame des communes, colonnes nom / code /
+    population / densite), 'geometry' (GeoDataFrame à une ligne : union des
+    contours), 'indicators' (indicateurs agrégés) et 'coverage'.
+    """
+    codes = sorted(set(codes))
+    communes = _communes_frame(departements_of(codes))
+    if communes is None:
+        return None
+    communes = communes[communes["code"].isin(codes)].reset_index(drop=True)
+    if communes.empty:
+        return None
+    communes["area_km2"] = area_km2(communes)
+    communes["densite"] = communes["population"] / communes["area_km2"]
+
+    # Union sur les formes déjà simplifiées : quelques dizaines de ms pour des centaines de communes
+    with telemetry.span("union", "geometry", features=len(communes)):
+        merged = gpd.GeoDataFrame({"code": [territory_code(codes)]},
+                                  geometry=[communes.geometry.union_all()], crs="EPSG:4326")
+
+    indicators, coverage = {}, {}
+    cube = get_cube()
+    if cube is not None:
+        aggregated, coverage = aggregate_custom(cube, codes)
+        for name, value in aggregated.items():
+            indicators[CARD_KEYS.get(name, name)] = round(value, 2)
+    # Compléments (ou repli sans cube) depuis les contours
+    population = communes["population"].sum()
+    area = communes["area_km2"].sum()
+    indicators.setdefault("Population", int(population))
+    if area > 0:
+        indicators.setdefault("Densité (hab/km²)", round(float(population / area), 1))
+    indicators["Surface (km²)"] = round(float(area), 1)
+    indicators["Nombre de communes"] = len(communes)
+    if "Population" in indicators and not np.isnan(indicators["Population"]):
+        indicators["Population"] = int(indicators["Population"])
+    return {"communes": communes, "geometry": merged, "indicators": indicators, "coverage": coverage}
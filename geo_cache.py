@@ -0,0 +1,235 @@
+"""Cache partagé et compact des GeoDataFrames de contours, borné en mémoire.
+
+st.cache_data conserve un pickle de chaque résultat et en désérialise une copie
+complète à chaque appel : géométries shapely en float64, attributs float64 et
+chaînes Python, pour chaque département ou territoire visité. Ici :
+    - un seul exemplaire par processus, partagé en lecture seule par les sessions ;
+    - stockage compact : coordonnées quantifiées en int32 (1e-6 degré, ~10 cm),
+      attributs numériques en float32 / int32, chaînes en catégories ;
+    - budget mémoire (GEO_CACHE_MB, 256 Mo par défaut), éviction LRU au-delà.
+Chaque appel reconstruit un GeoDataFrame neuf (opérations vectorisées), que
+l'appelant peut modifier librement : rien n'est conservé par session.
+"""
+import functools
+import os
+import threading
+from collections import OrderedDict
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+import telemetry
+
+GEO_CACHE_MB = float(os.getenv("GEO_CACHE_MB", "256"))
+# Quantification des coordonnées : unités par degré (EPSG:4326) ou par mètre (projection).
+# La reconstruction divise par ce facteur entier : 2345678 / 1e6 donne exactement 2.345678,
+# sans chiffres parasites dans le GeoJSON envoyé au navigateur.
+GEOGRAPHIC_FACTOR = 1e6
+PROJECTED_FACTOR = 100.0
+INT32_MAX = np.iinfo(np.int32).max
+
+
+def _compact_column(values):
+    """Colonne d'attributs en représentation compacte (float32, int32 ou catégorie)."""
+    if pd.api.types.is_float_dtype(values):
+        return values.to_numpy(dtype=np.float32)
+    if pd.api.types.is_integer_dtype(values):
+        array = values.to_numpy()
+        if array.size == 0 or (array.min() >= -INT32_MAX and array.max() <= INT32_MAX):
+            return array.astype(np.int32)
+        return array
+    if pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values):
+        try:
+            return pd.Categorical(values)
+        except TypeError:
+            # Valeurs non hachables (listes…) : conservées telles quelles
+            return values.to_numpy()
+    return values.to_numpy()
+
+
+def _expand_column(values):
+    """Colonne compacte -> dtype usuel (object, float64, int64) pour l'appelant."""
+    if isinstance(values, pd.Categorical):
+        return np.asarray(values.astype(object))
+    if values.dtype == np.float32:
+        # Via l'écriture décimale la plus courte : pas de chiffres parasites (12.300000190734863)
+        return values.astype(str).astype(np.float64)
+    if values.dtype == np.int32:
+        return values.astype(np.int64)
+    return values
+
+
+class CompactFrame:
+    """GeoDataFrame figé en mémoire compacte ; `to_gdf()` en reconstruit une copie indépendante."""
+
+    __slots__ = ("order", "columns", "index", "crs", "geometry_name", "geom_type", "coords", "factor", "offsets",
+                 "type_ids", "missing", "wkb", "nbytes")
+
+    def __init__(self, gdf):
+        self.order = list(gdf.columns)
+        self.columns = {c: _compact_column(gdf[c]) for c in gdf.columns if c != gdf.geometry.name}
+        self.index = None if isinstance(gdf.index, pd.RangeIndex) else gdf.index.to_numpy()
+        self.crs = gdf.crs
+        self.geometry_name = gdf.geometry.name
+        self.wkb = None
+        geometries = gdf.geometry.to_numpy()
+        self.missing = shapely.is_missing(geometries)
+        self.type_ids = shapely.get_type_id(geometries).astype(np.int8)
+        try:
+            self.geom_type, coords, self.offsets = shapely.to_ragged_array(geometries)
+            self.factor = GEOGRAPHIC_FACTOR if self.crs is None or self.crs.is_geographic else PROJECTED_FACTOR
+            quantized = np.round(coords * self.factor)
+            if quantized.size and np.abs(quantized).max() > INT32_MAX:
+                self.coords, self.factor = coords, None
+            else:
+                self.coords = quantized.astype(np.int32)
+        except ValueError:
+            # Types de géométrie non combinables (points et polygones…) : WKB
+            self.geom_type = self.coords = self.offsets = self.factor = None
+            self.wkb = shapely.to_wkb(geometries)
+        self.nbytes = self._nbytes()
+
+    def _nbytes(self):
+        size = self.missing.nbytes + self.type_ids.nbytes
+        for values in self.columns.values():
+            if isinstance(values, pd.Categorical):
+                size += values.codes.nbytes + sum(len(str(c)) + 49 for c in values.categories)
+            elif values.dtype == object:
+                size += values.nbytes + sum(len(str(v)) + 49 for v in values)
+            else:
+                size += values.nbytes
+        if self.index is not None:
+            size += self.index.nbytes
+        if self.wkb is not None:
+            return size + sum(len(w) + 33 for w in self.wkb if w is not None)
+        return size + self.coords.nbytes + sum(o.nbytes for o in self.offsets)
+
+    def __len__(self):
+        return len(self.missing)
+
+    def geometries(self):
+        if self.wkb is not None:
+            return shapely.from_wkb(self.wkb)
+        coords = self.coords if self.factor is None else self.coords / self.factor
+        geometries = shapely.from_ragged_array(self.geom_type, coords, self.offsets)
+        # to_ragged_array promeut les Polygon en MultiPolygon (etc.) : type d'origine restauré
+        demoted = (self.type_ids != shapely.get_type_id(geometries)) & ~self.missing
+        if demoted.any():
+            geometries[demoted] = shapely.get_geometry(geometries[demoted], 0)
+        geometries[self.missing] = None
+        return geometries
+
+    def to_gdf(self):
+        data = {c: _expand_column(v) for c, v in self.columns.items()}
+        data[self.geometry_name] = self.geometries()
+        index = self.index.copy() if self.index is not None else None
+        return gpd.GeoDataFrame({c: data[c] for c in self.order}, index=index, geometry=self.geometry_name,
+                                crs=self.crs)
+
+
+class GeoCache:
+    """LRU de CompactFrame bornée en octets, partagée par toutes les sessions du processus.
+
+    Une entrée plus grosse que le budget entier n'est pas conservée. Pendant le
+    calcul d'une clé manquante, les autres sessions qui la demandent attendent
+    ce calcul au lieu de le relancer.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._building = {}
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry
+
+    def put(self, key, gdf):
+        entry = CompactFrame(gdf)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            if entry.nbytes > self.max_bytes:
+                return entry
+            self._entries[key] = entry
+            self._bytes += entry.nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self.stats["evictions"] += 1
+        return entry
+
+    def get_or_build(self, key, build):
+        """CompactFrame de `key`, construit par `build()` (GeoDataFrame ou None) en cas d'absence."""
+        entry = self.get(key)
+        if entry is not None:
+            return entry, True
+        with self._lock:
+            building = self._building.setdefault(key, threading.Lock())
+        with building:
+            entry = self.get(key)
+            if entry is not None:
+                return entry, True
+            with self._lock:
+                self.stats["misses"] += 1
+            try:
+                gdf = build()
+                # Échec (None) non conservé : l'amont sera réinterrogé au prochain appel
+                return (self.put(key, gdf) if gdf is not None else None), False
+            finally:
+                with self._lock:
+                    self._building.pop(key, None)
+
+    def clear(self, prefix=None):
+        """Vide le cache (ou les seules clés d'une fonction)."""
+        with self._lock:
+            for key in [k for k in self._entries if prefix is None or k[0] == prefix]:
+                self._bytes -= self._entries.pop(key).nbytes
+
+    def metrics(self):
+        with self._lock:
+            total = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "entries": len(self._entries),
+                "mb": round(self._bytes / 2**20, 2),
+                "budget_mb": round(self.max_bytes / 2**20, 1),
+                "hit_rate": round(self.stats["hits"] / total, 3) if total else 0.0,
+            }
+
+
+@telemetry.cache_resource(show_spinner=False)
+def get_geo_cache():
+    """Cache géographique partagé par toutes les sessions du processus."""
+    return GeoCache(max_bytes=int(GEO_CACHE_MB * 2**20))
+
+
+def cached(func):
+    """Décorateur des fonctions qui renvoient un GeoDataFrame (ou None), à la place de st.cache_data.
+
+    Les arguments forment la clé ; `__wrapped__` donne la fonction d'origine, hors cache.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (func.__name__, *args, *sorted(kwargs.items()))
+        with telemetry.span(func.__name__, "cache", cache="hit") as s:
+            entry, hit = get_geo_cache().get_or_build(key, lambda: func(*args, **kwargs))
+            if entry is None:
+                s.attributes["cache"] = "miss"
+                return None
+            s.attributes.update(cache="hit" if hit else "miss", features=len(entry), compact_kb=entry.nbytes // 1024)
+            return entry.to_gdf()
+
+    wrapper.clear = lambda: get_geo_cache().clear(func.__name__)
+    return wrapper
@@ -0,0 +1,150 @@
+"""Index hiérarchique en mémoire : commune → EPCI → département → région.
+
+Construit une fois à partir du référentiel communal (fichier de population
+pynsee / ADMIN EXPRESS COG) et stocké dans des tableaux numpy : chaque commune
+porte l'indice de ses parents, et les enfants de chaque niveau sont rangés
+contigus (format CSR, décalages + permutation). Les requêtes parent / enfants
+ne font aucun appel réseau.
+"""
+import numpy as np
+import pandas as pd
+
+LEVELS = ("intercommunalites", "departements", "regions")
+KIND_ALIASES = {"EPCI": "intercommunalites"}
+
+# Noms de colonnes possibles selon la version du référentiel
+NAME_COLUMNS = ("nom_officiel", "nom", "nom_de_la_commune", "nom_commune")
+
+
+def _normalize_kind(kind):
+    return KIND_ALIASES.get(kind, kind)
+
+
+def _first_epci(value):
+    """Premier SIREN d'EPCI valide (le champ peut en contenir plusieurs, séparés par '/')."""
+    if not isinstance(value, str):
+        return ""
+    for part in value.split("/"):
+        part = part.strip()
+        if len(part) == 9 and part.isdigit():
+            return part
+    return ""
+
+
+class _Level:
+    """Codes d'un niveau parent, indice de parent par commune et enfants au format CSR."""
+
+    def __init__(self, parent_codes):
+        self.codes, self.of_commune = np.unique(parent_codes, return_inverse=True)
+        self.of_commune = self.of_commune.astype(np.int32)
+        # Code vide = commune sans parent à ce niveau (ex : îles mono-communales hors EPCI)
+        missing = np.flatnonzero(self.codes == "")
+        if missing.size:
+            self.of_commune[self.of_commune == missing[0]] = -1
+        self.position = {code: i for i, code in enumerate(self.codes) if code}
+        valid = self.of_commune >= 0
+        order = np.flatnonzero(valid)[np.argsort(self.of_commune[valid], kind="stable")]
+        counts = np.bincount(self.of_commune[valid], minlength=len(self.codes))
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        self.members = order.astype(np.int32)
+
+    def children(self, code):
+        i = self.position.get(str(code))
+        if i is None:
+            return self.members[:0]
+        return self.members[self.offsets[i]:self.offsets[i + 1]]
+
+
+class HierarchyIndex:
+    """Relations d'appartenance entre communes, EPCI, départements et régions."""
+
+    def __init__(self, codes, names, populations, epcis, departements, regions):
+        order = np.argsort(codes, kind="stable")
+        self.codes = np.asarray(codes, dtype=str)[order]
+        self.names = np.asarray(names, dtype=object)[order]
+        self.populations = np.asarray(populations, dtype=np.float64)[order]
+        self._commune_position = {code: i for i, code in enumerate(self.codes)}
+        self._levels = {
+            "intercommunalites": _Level(np.asarray(epcis, dtype=str)[order]),
+            "departements": _Level(np.asarray(departements, dtype=str)[order]),
+            "regions": _Level(np.asarray(regions, dtype=str)[order]),
+        }
+
+    @classmethod
+    def from_population(cls, frame):
+        """Construit l'index depuis le DataFrame de population (une ligne par commune)."""
+        frame = pd.DataFrame(frame).drop_duplicates("code_insee")
+        name_col = next((c for c in NAME_COLUMNS if c in frame.columns), None)
+        names = frame[name_col].fillna("").astype(str) if name_col else frame["code_insee"]
+        return cls(
+            codes=frame["code_insee"].astype(str).values,
+            names=names.values,
+            populations=pd.to_numeric(frame.get("population"), errors="coerce").values
+            if "population" in frame.columns else np.full(len(frame), np.nan),
+            epcis=frame["codes_siren_des_epci"].map(_first_epci).values,
+            departements=frame["code_insee_du_departement"].fillna("").astype(str).values,
+            regions=frame["code_insee_de_la_region"].fillna("").astype(str).values,
+        )
+
+    def __len__(self):
+        return len(self.codes)
+
+    def _commune_indices(self, code, kind):
+        kind = _normalize_kind(kind)
+        if kind == "communes":
+            i = self._commune_position.get(str(code))
+            return np.array([i] if i is not None else [], dtype=np.int32)
+        level = self._levels.get(kind)
+        return level.children(code) if level is not None else np.array([], dtype=np.int32)
+
+    def groups(self, level):
+        """(codes du niveau, indice de groupe de chaque commune ou -1), alignés sur `self.codes`."""
+        target = self._levels[_normalize_kind(level)]
+        return target.codes, target.of_commune
+
+    def communes_of(self, code, kind):
+        """Codes des communes d'un territoire (EPCI, département, région)."""
+        return self.codes[self._commune_indices(code, kind)].tolist()
+
+    def commune_records(self, code, kind):
+        """Communes d'un territoire sous forme de dicts {'nom', 'code', 'population'}."""
+        idx = self._commune_indices(code, kind)
+        return [
+            {"nom": self.names[i], "code": str(self.codes[i]),
+             "population": None if np.isnan(self.populations[i]) else int(self.populations[i])}
+            for i in idx
+        ]
+
+    def population_of(self, code, kind):
+        """Population totale des communes du territoire (0 si inconnu)."""
+        return float(np.nansum(self.populations[self._commune_indices(code, kind)]))
+
+    def parent(self, code, kind, level):
+        """Code du territoire de niveau `level` contenant le territoire donné (ou None).
+
+        Pour un EPCI ou un département, le parent retenu est celui de la majorité
+        de ses communes (un EPCI peut s'étendre sur plusieurs départements).
+        """
+        parents = self.parents_of(code, kind, level)
+        return parents[0] if parents else None
+
+    def parents_of(self, code, kind, level):
+        """Codes de niveau `level` couverts par le territoire, du plus au moins représenté."""
+        target = self._levels.get(_normalize_kind(level))
+        if target is None:
+            return []
+        of_commune = target.of_commune[self._commune_indices(code, kind)]
+        of_commune = of_commune[of_commune >= 0]
+        if of_commune.size == 0:
+            return []
+        if of_commune.size == 1:
+            return [str(target.codes[of_commune[0]])]
+        counts = np.bincount(of_commune, minlength=len(target.codes))
+        ranked = np.flatnonzero(counts)[np.argsort(-counts[np.flatnonzero(counts)], kind="stable")]
+        return target.codes[ranked].tolist()
+
+    def lineage(self, code, kind="communes"):
+        """Parents d'un territoire à chaque niveau supérieur : {'intercommunalites': ..., ...}."""
+        kind = _normalize_kind(kind)
+        upper = LEVELS[LEVELS.index(kind) + 1:] if kind in LEVELS else LEVELS
+        return {level: self.parent(code, kind, level) for level in upper}
@@ -0,0 +1,175 @@
+"""Fonds de carte IGN (GéoPlateforme, WMTS) : gabarits d'URL et proxy de tuiles à cache disque.
+
+Les cartes de l'application (folium) et l'image du PDF (contextily) prennent leurs
+tuiles via `tile_url`. Sans proxy configuré, le navigateur les demande directement
+au WMTS de l'IGN ; avec IGN_TILE_PROXY_URL (route /tuiles/ign de api.py, ex.
+http://localhost:8000/tuiles/ign), elles passent par `TileCache` :
+    - une tuile déjà servie est relue sur disque (DATA_DIR/tiles/<fond>/<z>/<x>/<y>),
+      sans requête vers l'IGN : les territoires consultés souvent restent locaux ;
+    - au-delà de IGN_TILE_TTL_DAYS, la tuile est redemandée ; si l'IGN ne répond
+      pas, la copie périmée est servie plutôt qu'une case vide ;
+    - au-delà de IGN_TILE_CACHE_MB, les tuiles servies le moins récemment sont supprimées.
+Seuls les fonds déclarés dans LAYERS sont relayés (pas de proxy ouvert).
+"""
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from insee_data import DATA_DIR, get_http_session
+import telemetry
+
+# Service WMTS de l'IGN, surchargeable pour les tests hors ligne
+IGN_WMTS_URL = os.getenv("IGN_WMTS_URL", "https://data.geopf.fr/wmts")
+IGN_TILE_PROXY_URL = os.getenv("IGN_TILE_PROXY_URL", "").rstrip("/")
+TILE_CACHE_DIR = os.getenv("IGN_TILE_CACHE_DIR", os.path.join(DATA_DIR, "tiles"))
+TILE_CACHE_MB = float(os.getenv("IGN_TILE_CACHE_MB", "512"))
+TILE_TTL_DAYS = float(os.getenv("IGN_TILE_TTL_DAYS", "30"))
+MAX_ZOOM = 20
+ATTRIBUTION = '&copy; <a href="https://www.ign.fr/">IGN</a> GéoPlateforme'
+
+# Fond -> (couche WMTS, format, libellé du sélecteur de fond)
+LAYERS = {
+    "plan": ("GEOGRAPHICALGRIDSYSTEMS.PLANIGNV2", "image/png", "Plan IGN"),
+    "ortho": ("ORTHOIMAGERY.ORTHOPHOTOS", "image/jpeg", "Photos aériennes"),
+}
+
+
+def wmts_url(layer, z, x, y):
+    """URL WMTS (GetTile, Web Mercator) d'une tuile ; z, x, y peuvent être des gabarits « {z} »."""
+    name, fmt, _ = LAYERS[layer]
+    return (f"{IGN_WMTS_URL}?SERVICE=WMTS&REQUEST=GetTile&VERSION=1.0.0&LAYER={name}&STYLE=normal"
+            f"&TILEMATRIXSET=PM&TILEMATRIX={z}&TILEROW={y}&TILECOL={x}&FORMAT={fmt}")
+
+
+def tile_url(layer):
+    """Gabarit {z}/{x}/{y} d'un fond pour folium ou contextily : proxy s'il est configuré, sinon WMTS IGN."""
+    if IGN_TILE_PROXY_URL:
+        return f"{IGN_TILE_PROXY_URL}/{layer}/{{z}}/{{x}}/{{y}}"
+    return wmts_url(layer, "{z}", "{x}", "{y}")
+
+
+def valid_tile(layer, z, x, y):
+    return layer in LAYERS and 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+class TileCache:
+    """Tuiles IGN sur disque, bornées en octets (LRU sur l'ordre des accès du processus).
+
+    Au démarrage, les fichiers déjà présents sont repris dans l'ordre de leur dernière
+    modification. Les écritures passent par un fichier temporaire renommé : un
+    lecteur concurrent ne voit jamais de tuile tronquée.
+    """
+
+    def __init__(self, root, max_bytes, ttl_s):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self._lock = threading.Lock()
+        self._files = OrderedDict()  # chemin -> taille, du moins au plus récemment servi
+        self._bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "errors": 0, "evictions": 0}
+        self._scan()
+
+    def _scan(self):
+        found = []
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                found.append((st.st_mtime, path, st.st_size))
+        for _, path, size in sorted(found):
+            self._files[path] = size
+            self._bytes += size
+
+    def path(self, layer, z, x, y):
+        return os.path.join(self.root, layer, str(z), str(x), str(y))
+
+    def _read(self, path):
+        """(contenu, fraîche ?) de la tuile sur disque, ou (None, False)."""
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+            return content, time.time() - os.path.getmtime(path) < self.ttl_s
+        except OSError:
+            return None, False
+
+    def _write(self, path, content):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tuile-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp, path)
+        with self._lock:
+            self._bytes += len(content) - self._files.pop(path, 0)
+            self._files[path] = len(content)
+            evicted = []
+            while self._bytes > self.max_bytes and len(self._files) > 1:
+                old, size = self._files.popitem(last=False)
+                self._bytes -= size
+                evicted.append(old)
+            self.stats["evictions"] += len(evicted)
+        for old in evicted:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+    def _touch(self, path):
+        with self._lock:
+            if path in self._files:
+                self._files.move_to_end(path)
+
+    def get(self, layer, z, x, y):
+        """Contenu de la tuile (disque, sinon IGN), ou None si l'IGN ne la fournit pas."""
+        path = self.path(layer, z, x, y)
+        content, fresh = self._read(path)
+        if content is not None and fresh:
+            self._touch(path)
+            with self._lock:
+                self.stats["hits"] += 1
+            return content
+        with telemetry.span("tuile IGN", "http", layer=layer, z=z, cache="miss") as s:
+            try:
+                r = get_http_session().get(wmts_url(layer, z, x, y), timeout=10)
+                if r.status_code == 200 and r.headers.get("content-type", "").startswith("image/"):
+                    s.attributes["bytes"] = len(r.content)
+                    self._write(path, r.content)
+                    with self._lock:
+                        self.stats["misses"] += 1
+                    return r.content
+                # Tuile hors couverture (404, exception WMTS en XML) : rien à conserver
+                failure = f"statut {r.status_code}"
+            except Exception as e:
+                failure = str(e)
+        with self._lock:
+            self.stats["errors"] += 1
+        if content is not None:
+            # IGN injoignable : la copie périmée vaut mieux qu'une case vide
+            self._touch(path)
+            with self._lock:
+                self.stats["stale"] += 1
+            return content
+        telemetry.record_error(f"Tuile IGN {layer}/{z}/{x}/{y} indisponible : {failure}")
+        return None
+
+    def metrics(self):
+        with self._lock:
+            total = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "files": len(self._files),
+                "mb": round(self._bytes / 2**20, 2),
+                "budget_mb": round(self.max_bytes / 2**20, 1),
+                "hit_rate": round(self.stats["hits"] / total, 3) if total else 0.0,
+            }
+
+
+@telemetry.cache_resource(show_spinner=False)
+def get_tile_cache():
+    """Cache de tuiles du processus (proxy de api.py)."""
+    return TileCache(TILE_CACHE_DIR, max_bytes=int(TILE_CACHE_MB * 2**20), ttl_s=TILE_TTL_DAYS * 86400)
@@ -1,10 +1,52 @@
 const axios = require('axios');
+const fs = require('fs');
+const http = require('http');
+const https = require('https');
+const path = require('path');
 const querystring = require('querystring');
+const readline = require('readline');
 
 // --- CONFIGURATION ---
-const API_BASE_URL = 'https://api.insee.fr/api-sirene/3.11';
+const API_BASE_URL = process.env.SIRENE_API_URL || 'https://api.insee.fr/api-sirene/3.11';
 const API_KEY = process.env.INSEE_API_KEY; // Ceci est le jeton d'accès direct
 
+// Mode lot : valeurs par défaut (l'API SIRENE publique autorise 30 requêtes par minute)
+const DEFAULT_CONCURRENCY = 4;
+const DEFAULT_RATE_PER_MINUTE = 30;
+const DEFAULT_CACHE_DIR = path.join(__dirname, '.cache', 'sirene');
+const MAX_RETRIES = 3;
+
+// --- ARGUMENTS ---
+const parseArgs = (argv) => {
+  const options = {
+    batch: false,
+    input: null,
+    concurrency: DEFAULT_CONCURRENCY,
+    rate: DEFAULT_RATE_PER_MINUTE,
+    cacheDir: DEFAULT_CACHE_DIR,
+    searchTerm: null,
+  };
+  for (let i = 0; i < argv.length; i++) {
+    const arg = argv[i];
+    if (arg === '--batch') {
+      options.batch = true;
+      // Fichier d'entrée optionnel ('-' ou absent : entrée standard)
+      if (argv[i + 1] && !argv[i + 1].startsWith('--')) options.input = argv[++i];
+    } else if (arg === '--concurrency') {
+      options.concurrency = Math.max(1, parseInt(argv[++i], 10) || DEFAULT_CONCURRENCY);
+    } else if (arg === '--rate') {
+      options.rate = Math.max(1, parseInt(argv[++i], 10) || DEFAULT_RATE_PER_MINUTE);
+    } else if (arg === '--cache-dir') {
+      options.cacheDir = argv[++i];
+    } else if (options.searchTerm === null) {
+      options.searchTerm = arg;
+    }
+  }
+  return options;
+};
+
+const options = parseArgs(process.argv.slice(2));
+
 // --- VALIDATION ---
 if (!API_KEY) {
   console.error('\x1b[31mErreur : La clé d\'API est manquante.\x1b[0m');
@@ -13,32 +55,39 @@ if (!API_KEY) {
   process.exit(1);
 }
 
-const searchTerm = process.argv[2];
-if (!searchTerm) {
+const searchTerm = options.searchTerm;
+if (!searchTerm && !options.batch) {
   console.error('\x1b[31mErreur : Veuillez fournir le nom de la collectivité en argument.\x1b[0m');
   console.error('Exemple: node index.js "Mairie de Toulouse"');
+  console.error('Mode lot : node index.js --batch collectivites.txt [--concurrency 4] [--rate 30] > resultats.ndjson');
   process.exit(1);
 }
 
+const createApiClient = (maxSockets = Infinity) => axios.create({
+  baseURL: API_BASE_URL,
+  headers: {
+    'Authorization': `Bearer ${API_KEY}`, // Utilisation du jeton direct
+    'Accept': 'application/json'
+  },
+  // Connexions persistantes : évite une poignée de main TLS par requête
+  httpAgent: new http.Agent({ keepAlive: true, maxSockets }),
+  httpsAgent: new https.Agent({ keepAlive: true, maxSockets }),
+  timeout: 30000,
+});
+
 // --- LOGIQUE PRINCIPALE ---
 const findCollectivite = async () => {
   try {
-    const apiClient = axios.create({
-      baseURL: API_BASE_URL,
-      headers: {
-        'Authorization': `Bearer ${API_KEY}`, // Utilisation du jeton direct
-        'Accept': 'application/json'
-      }
-    });
+    const apiClient = createApiClient();
 
     // 1. Construire la requête de recherche par nom uniquement
     const query = `raisonSociale:${querystring.escape(searchTerm)}`;
-    
+
     console.log(`Recherche de la collectivité "${searchTerm}"...`);
 
     // 2. Construire l'URL manuellement pour éviter l'encodage du ':' par axios
     const searchUrl = `/siren?q=${query}&nombre=1`; // On prend le premier résultat
-    
+
     console.log(`URL de recherche: ${searchUrl}`);
 
     const searchResponse = await apiClient.get(searchUrl);
@@ -71,4 +120,161 @@ const findCollectivite = async () => {
   }
 };
 
-findCollectivite();
\ No newline at end of file
+// --- MODE LOT ---
+
+// Seau à jetons : au plus `ratePerMinute` requêtes par minute, partagées entre tous les workers
+const createTokenBucket = (ratePerMinute) => {
+  const capacity = Math.max(1, Math.min(ratePerMinute, 10));
+  const refillPerMs = ratePerMinute / 60000;
+  let tokens = capacity;
+  let last = Date.now();
+  let chain = Promise.resolve();
+
+  const take = () => {
+    // Les demandes sont sérialisées pour que chaque attente tienne compte des précédentes
+    chain = chain.then(async () => {
+      const now = Date.now();
+      tokens = Math.min(capacity, tokens + (now - last) * refillPerMs);
+      last = now;
+      if (tokens < 1) {
+        const wait = Math.ceil((1 - tokens) / refillPerMs);
+        await new Promise((resolve) => setTimeout(resolve, wait));
+        tokens = 1;
+        last = Date.now();
+      }
+      tokens -= 1;
+    });
+    return chain;
+  };
+  return { take };
+};
+
+const readCache = async (cacheDir, siren) => {
+  try {
+    return JSON.parse(await fs.promises.readFile(path.join(cacheDir, `${siren}.json`), 'utf8'));
+  } catch (error) {
+    return null;
+  }
+};
+
+const writeCache = async (cacheDir, siren, dossier) => {
+  const file = path.join(cacheDir, `${siren}.json`);
+  // Écriture atomique : un fichier partiellement écrit ne doit jamais être relu comme valide
+  const tmp = `${file}.${process.pid}.${Date.now()}.${Math.random().toString(36).slice(2)}.tmp`;
+  await fs.promises.writeFile(tmp, JSON.stringify(dossier));
+  await fs.promises.rename(tmp, file);
+};
+
+const runBatch = async () => {
+  const apiClient = createApiClient(options.concurrency);
+  const bucket = createTokenBucket(options.rate);
+  await fs.promises.mkdir(options.cacheDir, { recursive: true });
+  const stats = { total: 0, ok: 0, notFound: 0, errors: 0, cacheHits: 0, requests: 0 };
+
+  // Requête limitée par le seau à jetons, rejouée sur 429 / 5xx
+  const get = async (url) => {
+    for (let attempt = 0; ; attempt++) {
+      await bucket.take();
+      stats.requests++;
+      try {
+        return await apiClient.get(url);
+      } catch (error) {
+        const status = error.response && error.response.status;
+        const retryable = status === 429 || (status >= 500 && status < 600) || (!error.response && error.request);
+        if (!retryable || attempt >= MAX_RETRIES) throw error;
+        const retryAfter = error.response && parseInt(error.response.headers['retry-after'], 10);
+        const delay = retryAfter ? retryAfter * 1000 : 1000 * 2 ** attempt;
+        await new Promise((resolve) => setTimeout(resolve, delay));
+      }
+    }
+  };
+
+  // Un même SIREN demandé plusieurs fois en parallèle n'est récupéré qu'une fois
+  const inFlight = new Map();
+  const fetchDossier = (siren) => {
+    if (!inFlight.has(siren)) {
+      const promise = (async () => {
+        const cached = await readCache(options.cacheDir, siren);
+        if (cached) {
+          stats.cacheHits++;
+          return { dossier: cached, cache: true };
+        }
+        const dossierResponse = await get(`/siren/${siren}`);
+        await writeCache(options.cacheDir, siren, dossierResponse.data);
+        return { dossier: dossierResponse.data, cache: false };
+      })().finally(() => inFlight.delete(siren));
+      inFlight.set(siren, promise);
+    }
+    return inFlight.get(siren);
+  };
+
+  const lookup = async (entry) => {
+    let siren = /^\d{9}$/.test(entry) ? entry : null;
+    if (!siren) {
+      let unites = [];
+      try {
+        const searchResponse = await get(`/siren?q=raisonSociale:${querystring.escape(entry)}&nombre=1`);
+        unites = searchResponse.data.unitesLegales || [];
+      } catch (error) {
+        // L'API SIRENE répond 404 quand la recherche ne renvoie aucun résultat
+        if (!(error.response && error.response.status === 404)) throw error;
+      }
+      if (unites.length === 0) return { siren: null, dossier: null };
+      siren = unites[0].siren;
+    }
+    const { dossier, cache } = await fetchDossier(siren);
+    return { siren, dossier, cache };
+  };
+
+  const processEntry = async (entry, ligne) => {
+    stats.total++;
+    let record;
+    try {
+      const { siren, dossier, cache } = await lookup(entry);
+      if (!siren) {
+        stats.notFound++;
+        record = { ligne, entree: entry, siren: null, erreur: 'Aucune unité légale trouvée' };
+      } else {
+        stats.ok++;
+        record = { ligne, entree: entry, siren, cache, dossier };
+      }
+    } catch (error) {
+      stats.errors++;
+      const message = error.response
+        ? `Erreur de l'API : ${error.response.status} - ${error.response.statusText}`
+        : error.message;
+      record = { ligne, entree: entry, siren: null, erreur: message };
+    }
+    // Une ligne JSON par résultat, émise dès qu'elle est prête
+    process.stdout.write(`${JSON.stringify(record)}\n`);
+  };
+
+  const input = options.input && options.input !== '-' ? fs.createReadStream(options.input) : process.stdin;
+  const lines = readline.createInterface({ input, crlfDelay: Infinity });
+
+  // Pool borné : on ne lit une nouvelle ligne que lorsqu'un worker est libre
+  const running = new Set();
+  let ligne = 0;
+  for await (const raw of lines) {
+    const entry = raw.trim();
+    ligne++;
+    if (!entry || entry.startsWith('#')) continue;
+    const task = processEntry(entry, ligne).finally(() => running.delete(task));
+    running.add(task);
+    if (running.size >= options.concurrency) await Promise.race(running);
+  }
+  await Promise.all(running);
+
+  console.error(`\x1b[32mTerminé : ${stats.ok} dossiers, ${stats.notFound} introuvables, ${stats.errors} erreurs ` +
+    `(${stats.cacheHits} depuis le cache, ${stats.requests} requêtes API).\x1b[0m`);
+};
+
+if (options.batch) {
+  runBatch().catch((error) => {
+    console.error('\x1b[31m--- Une erreur est survenue ---\x1b[0m');
+    console.error('Erreur inattendue :', error.message);
+    process.exit(1);
+  });
+} else {
+  findCollectivite();
+}
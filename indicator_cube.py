@@ -0,0 +1,109 @@
+"""Lecture du cube national d'indicateurs (territoire × indicateur, float32).
+
+Le cube est produit chaque nuit par build_cube.py. Chaque niveau (communes,
+EPCI, départements, régions) est un tableau .npy de forme
+(indicateurs, territoires) : les valeurs d'un indicateur sont contiguës, si bien
+qu'une carte choroplèthe ne lit qu'une seule ligne du fichier projeté en mémoire.
+
+Disposition sur disque :
+    <CUBE_DIR>/CURRENT                 nom de la version active
+    <CUBE_DIR>/<version>/index.json    indicateurs, codes de chaque niveau, date
+    <CUBE_DIR>/<version>/<niveau>.npy
+    <CUBE_DIR>/<version>/<niveau>.coverage.npy   part renseignée de chaque agrégat (secret statistique)
+"""
+import json
+import os
+
+import numpy as np
+
+LEVELS = ("communes", "intercommunalites", "departements", "regions")
+KIND_ALIASES = {"EPCI": "intercommunalites"}
+
+# Composantes techniques stockées avec les indicateurs (préfixe « _ », non affichées)
+COMPONENT_PREFIX = "_"
+
+
+def current_version_dir(directory):
+    """Répertoire de la version active du cube, ou None s'il n'a jamais été construit."""
+    try:
+        with open(os.path.join(directory, "CURRENT"), encoding="utf-8") as f:
+            version = f.read().strip()
+    except OSError:
+        return None
+    path = os.path.join(directory, version)
+    return path if os.path.isdir(path) else None
+
+
+class IndicatorCube:
+    """Cube projeté en mémoire : aucune donnée n'est lue avant d'être demandée."""
+
+    def __init__(self, path):
+        with open(os.path.join(path, "index.json"), encoding="utf-8") as f:
+            index = json.load(f)
+        self.path = path
+        self.built_at = index.get("built_at")
+        self.columns = index["indicators"]
+        self._row = {name: i for i, name in enumerate(self.columns)}
+        self._codes = {level: codes for level, codes in index["levels"].items()}
+        self._positions = {level: {code: i for i, code in enumerate(codes)}
+                           for level, codes in self._codes.items()}
+        self._arrays = {level: np.load(os.path.join(path, f"{level}.npy"), mmap_mode="r")
+                        for level in self._codes}
+        self._coverage = {}
+        for level in self._codes:
+            coverage_path = os.path.join(path, f"{level}.coverage.npy")
+            if os.path.exists(coverage_path):
+                self._coverage[level] = np.load(coverage_path, mmap_mode="r")
+
+    @property
+    def indicators(self):
+        """Indicateurs publiés (hors composantes techniques)."""
+        return [c for c in self.columns if not c.startswith(COMPONENT_PREFIX)]
+
+    def has(self, indicator):
+        return indicator in self._row
+
+    def codes(self, level):
+        return self._codes.get(KIND_ALIASES.get(level, level), [])
+
+    def slice(self, indicator, codes, level="communes"):
+        """Valeurs d'un indicateur pour une liste de codes (NaN si absent du cube)."""
+        level = KIND_ALIASES.get(level, level)
+        row = self._row.get(indicator)
+        positions = self._positions.get(level)
+        if row is None or positions is None:
+            return np.full(len(codes), np.nan)
+        idx = np.fromiter((positions.get(str(c), -1) for c in codes), dtype=np.int64, count=len(codes))
+        values = self._arrays[level][row][np.maximum(idx, 0)].astype(np.float64)
+        values[idx < 0] = np.nan
+        return values
+
+    def values(self, code, level="communes"):
+        """Tous les indicateurs publiés d'un territoire : {indicateur: valeur} (valeurs manquantes omises)."""
+        level = KIND_ALIASES.get(level, level)
+        i = self._positions.get(level, {}).get(str(code))
+        if i is None:
+            return {}
+        column = np.asarray(self._arrays[level][:, i], dtype=np.float64)
+        return {name: float(v) for name, v in zip(self.columns, column)
+                if not name.startswith(COMPONENT_PREFIX) and not np.isnan(v)}
+
+    def coverage(self, code, level):
+        """Couverture des indicateurs agrégés d'un territoire : {indicateur: part renseignée}."""
+        level = KIND_ALIASES.get(level, level)
+        i = self._positions.get(level, {}).get(str(code))
+        if i is None or level not in self._coverage:
+            return {}
+        column = np.asarray(self._coverage[level][:, i], dtype=np.float64)
+        return {name: float(v) for name, v in zip(self.columns, column)
+                if not name.startswith(COMPONENT_PREFIX) and not np.isnan(v)}
+
+
+def open_cube(path):
+    """Ouvre une version du cube (None si illisible)."""
+    try:
+        return IndicatorCube(path)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"open_cube error: {e}")
+        return None
+
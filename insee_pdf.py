@@ -0,0 +1,477 @@
+"""Génération du rapport PDF d'un territoire (fpdf2) et de sa carte statique."""
+import datetime
+import re
+
+import numpy as np
+from unidecode import unidecode
+
+from insee_data import (DEFAULT_VINTAGE, INSEE_KEY, VINTAGES, fetch_demographic_data, fetch_epci_communes,
+                        fetch_pdf_data, get_cube, get_geo)
+from llm_context import conversation_turns
+from pdf_jobs import pdf_key
+from syntheses import get_synthesis, synthesis_version
+import ign_tiles
+import telemetry
+
+# Libellés de type affichés dans l'application -> kind technique
+LABEL_TO_KIND = {
+    "Communes": "communes", "EPCI (Intercommunalités)": "intercommunalites",
+    "Départements": "departements", "Régions": "regions",
+    "Arrondissements": "arrondissements",
+    "Arrondissements Municipaux (Paris, Lyon, Marseille)": "arrondissementsMunicipaux",
+    "Communes Associées / Déléguées": "communesDeleguees",
+    "Territoire personnalisé": "custom",
+}
+
+
+def report_versions(code, type_label):
+    """Versions des données que le rapport lit hors de la session : synthèse précalculée, cube, millésimes.
+
+    Elles entrent dans la clé du rapport (pdf_jobs.pdf_key) : une synthèse régénérée,
+    un nouveau cube ou un changement de millésime ne servent plus l'ancien fichier.
+    Marqueurs sans appel réseau ni lecture de texte : les données étendues
+    (fetch_pdf_data) ne sont lues que par la génération, dans le pool.
+    """
+    cube = get_cube()
+    return {
+        "synthesis": synthesis_version(code, LABEL_TO_KIND.get(type_label, "communes")),
+        "cube": cube.built_at if cube is not None else None,
+        "vintages": VINTAGES[DEFAULT_VINTAGE],
+    }
+
+
+def report_job(code, title, type_label, url_insee, indicators, messages=None, gdf=None, communes=None):
+    """Clé du rapport (pdf_jobs.pdf_key) et paramètres de generate_insee_pdf, pour PDFJobs.submit.
+
+    Application et API construisent la même clé : un rapport généré pour l'une est servi à l'autre.
+    """
+    messages = list(messages or [])
+    snapshot = {"title": title, "type": type_label, "url": url_insee, "indicators": indicators,
+                "communes": communes, "versions": report_versions(code, type_label)}
+    return pdf_key(code, snapshot, messages), dict(
+        title=title,
+        code=code,
+        type_label=type_label,
+        url_insee=url_insee,
+        indicators=dict(indicators),
+        ai_messages=messages,
+        gdf=gdf,
+        communes=communes,
+    )
+
+
+def strip_markdown(text):
+    """Supprime les balises markdown courantes pour un rendu texte brut."""
+    text = re.sub(r'\*\*(.+?)\*\*', r'\1', text)   # **gras**
+    text = re.sub(r'\*(.+?)\*', r'\1', text)         # *italique*
+    text = re.sub(r'__(.+?)__', r'\1', text)         # __gras__
+    text = re.sub(r'_(.+?)_', r'\1', text)           # _italique_
+    text = re.sub(r'`{1,3}(.+?)`{1,3}', r'\1', text, flags=re.DOTALL)  # `code`
+    text = re.sub(r'^#{1,6}\s*', '', text, flags=re.MULTILINE)  # # titres
+    text = re.sub(r'^\s*[-*+]\s+', '- ', text, flags=re.MULTILINE)  # listes
+    text = re.sub(r'^\s*\d+\.\s+', '', text, flags=re.MULTILINE)  # listes numérotées
+    text = re.sub(r'\[(.+?)\]\(.+?\)', r'\1', text)  # [liens](url)
+    text = re.sub(r'^\s*>{1,}\s*', '', text, flags=re.MULTILINE)  # > citations
+    return text.strip()
+
+
+
+def pdf_safe(text):
+    """Remplace les caractères hors Latin-1 par des équivalents ASCII pour fpdf2/Helvetica."""
+    replacements = {"€": "EUR", "—": "-", "–": "-", "…": "...", "\u2019": "'", "\u2018": "'",
+                    "\u201c": '"', "\u201d": '"', "°": " deg", "²": "2", "³": "3"}
+    for char, repl in replacements.items():
+        text = str(text).replace(char, repl)
+    return unidecode(text)
+
+
+
+@telemetry.traced("pdf")
+def generate_map_image(code, kind, title, gdf=None):
+    """Génère une image PNG du territoire avec fond de carte IGN Plan V2 (contours fournis ou via get_geo).
+
+    Figure matplotlib autonome (sans pyplot ni son état global) : plusieurs rapports
+    peuvent être produits en parallèle par le pool d'export (pdf_jobs).
+    """
+    from matplotlib.figure import Figure
+    import io as _io
+
+    if gdf is None:
+        gdf = get_geo(code, kind, title)
+    if gdf is None:
+        return None
+    try:
+        # Reprojection en Web Mercator pour contextily
+        with telemetry.span("reprojection", "geometry", features=len(gdf)):
+            gdf_wm = gdf.to_crs(epsg=3857)
+
+        fig = Figure(figsize=(6, 4))
+        ax = fig.subplots(1, 1)
+        gdf_wm.plot(ax=ax, color='none', edgecolor='#003366', linewidth=2.5, zorder=2)
+
+        # Fond de carte IGN Plan V2 (même source que dans l'app)
+        try:
+            import contextily as cx
+            with telemetry.span("fond de carte", "render"):
+                cx.add_basemap(ax, source=ign_tiles.tile_url("plan"), zoom="auto", attribution="")
+        except Exception as e:
+            telemetry.record_error(f"Basemap IGN error (fallback sans fond): {e}")
+            gdf_wm.plot(ax=ax, color='#ccd9f0', edgecolor='#003366', linewidth=2, zorder=2)
+
+        ax.set_axis_off()
+        fig.patch.set_facecolor('white')
+        fig.tight_layout(pad=0.2)
+
+        buf = _io.BytesIO()
+        with telemetry.span("png", "render") as s:
+            fig.savefig(buf, format='png', dpi=150, bbox_inches='tight',
+                        facecolor='white', edgecolor='none')
+            s.attributes["bytes"] = buf.tell()
+        buf.seek(0)
+        return buf
+    except Exception as e:
+        telemetry.record_error(f"generate_map_image error: {e}")
+        return None
+
+
+def _pdf_row(pdf, label, value, fill, col_w=190):
+    """Affiche une ligne label/valeur dans le PDF."""
+    GREY = (108, 117, 125)
+    BLACK = (30, 30, 30)
+    # Saut de page explicite si plus assez de place pour cette ligne
+    if pdf.get_y() + 7 > pdf.h - pdf.b_margin:
+        pdf.add_page()
+    y = pdf.get_y()
+    bg = (245, 247, 250) if fill else (255, 255, 255)
+    pdf.set_fill_color(*bg)
+    pdf.set_draw_color(220, 220, 220)
+    pdf.rect(10, y, col_w, 7, 'FD')
+    pdf.set_text_color(*GREY)
+    pdf.set_font("Helvetica", "", 8)
+    pdf.set_xy(12, y + 1.5)
+    pdf.cell(120, 4, pdf_safe(str(label))[:60], ln=False)
+    pdf.set_text_color(*BLACK)
+    pdf.set_font("Helvetica", "B", 8)
+    try:
+        if isinstance(value, float) and not np.isnan(value):
+            val_str = f"{value:,.2f}".replace(",", " ")
+        elif isinstance(value, int):
+            val_str = f"{value:,}".replace(",", " ")
+        else:
+            val_str = pdf_safe(str(value))
+    except Exception:
+        val_str = pdf_safe(str(value))
+    pdf.set_xy(132, y + 1.5)
+    pdf.cell(66, 4, val_str, ln=False, align="R")
+    pdf.ln(7)
+
+
+def _pdf_section(pdf, title):
+    """Affiche un bandeau de titre de section."""
+    BLUE = (0, 51, 102)
+    # Si moins de 25mm restants, passer à la page suivante
+    # pour éviter un titre de section isolé en bas de page
+    if pdf.get_y() + 25 > pdf.h - pdf.b_margin:
+        pdf.add_page()
+    else:
+        pdf.ln(3)
+    pdf.set_fill_color(*BLUE)
+    pdf.set_text_color(255, 255, 255)
+    pdf.set_font("Helvetica", "B", 10)
+    pdf.cell(0, 7, pdf_safe(f"  {title}"), ln=True, fill=True)
+    pdf.ln(1)
+
+
+@telemetry.traced("pdf")
+def generate_insee_pdf(title, code, type_label, url_insee, indicators, ai_messages=None, gdf=None, communes=None,
+                       progress=None):
+    """Génère un rapport PDF multi-pages depuis les données INSEE et FILOSOFI.
+
+    Pour un territoire personnalisé, `gdf` fournit les contours fusionnés et
+    `communes` la liste des communes ({'nom', 'code', 'population'}).
+    `progress(fraction, étape)`, s'il est fourni, est appelé au début de chaque étape.
+    """
+    step = progress or (lambda fraction, message: None)
+    from fpdf import FPDF
+
+    BLUE  = (0, 51, 102)
+    GREY  = (108, 117, 125)
+    LIGHT = (230, 236, 245)
+
+    # Données étendues (on reconstitue le kind technique depuis type_label)
+    step(0.05, "Données étendues")
+    _kind = LABEL_TO_KIND.get(type_label, "communes")
+    extended = fetch_pdf_data(code, _kind, INSEE_KEY)
+    # Fusion : indicators en priorité
+    all_data = {**extended, **{k: v for k, v in indicators.items() if v is not None}}
+
+    class ReportPDF(FPDF):
+        def header(self):
+            self.set_fill_color(*BLUE)
+            self.rect(0, 0, 210, 12, 'F')
+            self.set_text_color(255, 255, 255)
+            self.set_font("Helvetica", "B", 9)
+            self.set_xy(10, 2)
+            self.cell(130, 8, pdf_safe(f"DOSSIER INSEE - {title}"), ln=False)
+            self.set_font("Helvetica", "", 8)
+            self.set_xy(140, 2)
+            self.cell(60, 8, pdf_safe(f"Code : {code}  |  {type_label}"), ln=False, align="R")
+            self.ln(14)
+
+        def footer(self):
+            self.set_y(-12)
+            self.set_draw_color(*BLUE)
+            self.line(10, self.get_y(), 200, self.get_y())
+            self.set_text_color(*GREY)
+            self.set_font("Helvetica", "I", 7)
+            self.cell(95, 6, f"Source : INSEE - FILOSOFI 2021, Recensement de la population 2022", ln=False)
+            self.cell(95, 6, f"Page {self.page_no()}", align="R")
+
+    pdf = ReportPDF()
+    pdf.set_auto_page_break(auto=True, margin=18)
+    pdf.add_page()
+
+    # ── PAGE DE GARDE ──────────────────────────────────────────────
+    pdf.set_fill_color(*BLUE)
+    pdf.rect(0, 14, 210, 55, 'F')
+    pdf.set_text_color(255, 255, 255)
+    pdf.set_font("Helvetica", "B", 26)
+    pdf.set_xy(10, 20)
+    pdf.cell(0, 12, "DOSSIER STATISTIQUE", ln=True)
+    pdf.set_font("Helvetica", "B", 18)
+    pdf.set_x(10)
+    pdf.cell(0, 10, pdf_safe(title), ln=True)
+    pdf.set_font("Helvetica", "", 11)
+    pdf.set_x(10)
+    pdf.cell(0, 7, pdf_safe(f"{type_label}  |  Code INSEE : {code}"), ln=True)
+    pdf.set_font("Helvetica", "I", 9)
+    pdf.set_x(10)
+    pdf.cell(0, 6, f"Rapport genere le {datetime.date.today().strftime('%d/%m/%Y')}", ln=True)
+    pdf.ln(6)
+
+    # Lien dossier complet
+    pdf.set_text_color(0, 51, 102)
+    pdf.set_font("Helvetica", "U", 9)
+    pdf.set_x(10)
+    pdf.cell(0, 6, "Consulter le dossier complet sur le site de l'INSEE", ln=True, link=url_insee)
+    pdf.ln(6)
+
+    # ── BANDEAU 4 INDICATEURS CLÉS ─────────────────────────────────
+    KEY_METRICS = [
+        ("Population 2022", "Population", lambda v: f"{int(v):,} hab.".replace(",", " ")),
+        ("Densite", "Densité (hab/km²)", lambda v: f"{v} hab/km2"),
+        ("Revenu median", "Niveau de vie median (EUR/an)", lambda v: f"{int(v):,} EUR/an".replace(",", " ")),
+        ("Taux de pauvrete", "Taux de pauvreté (%)", lambda v: f"{v} %"),
+    ]
+    pdf.set_draw_color(*BLUE)
+    col_w = 46
+    y_band = pdf.get_y()
+    for i, (label, key, fmt) in enumerate(KEY_METRICS):
+        x = 10 + i * (col_w + 2)
+        pdf.set_fill_color(*LIGHT)
+        pdf.rect(x, y_band, col_w, 24, 'FD')
+        pdf.set_text_color(*GREY)
+        pdf.set_font("Helvetica", "", 7)
+        pdf.set_xy(x + 2, y_band + 2)
+        pdf.cell(col_w - 4, 4, label.upper())
+        val = all_data.get(key)
+        try:
+            display = pdf_safe(fmt(val)) if val is not None and not (isinstance(val, float) and np.isnan(val)) else "N/D"
+        except Exception:
+            display = "N/D"
+        pdf.set_text_color(*BLUE)
+        pdf.set_font("Helvetica", "B", 13)
+        pdf.set_xy(x + 2, y_band + 9)
+        pdf.cell(col_w - 4, 8, display)
+    pdf.ln(32)
+
+    # ── CARTE DU TERRITOIRE ───────────────────────────────────────
+    step(0.2, "Carte du territoire")
+    map_img = generate_map_image(code, _kind, title, gdf=gdf)
+    if map_img:
+        map_w = 100
+        # Saut de page si moins de 80mm restants
+        if pdf.get_y() + 80 > pdf.h - pdf.b_margin:
+            pdf.add_page()
+        # Sans y= explicite : fpdf2 place l'image et avance le curseur automatiquement
+        pdf.image(map_img, x=(210 - map_w) / 2, w=map_w)
+        pdf.set_text_color(*GREY)
+        pdf.set_font("Helvetica", "I", 7)
+        pdf.cell(0, 4, pdf_safe(f"Carte du territoire : {title}"), ln=True, align="C")
+        pdf.ln(4)
+
+    # ── SYNTHÈSE IA PRÉCALCULÉE (si disponible) ──────────────────
+    step(0.6, "Indicateurs détaillés")
+    synthesis = get_synthesis(code, _kind)
+    if synthesis:
+        _pdf_section(pdf, "Synthese territoriale")
+        pdf.set_text_color(30, 30, 30)
+        pdf.set_font("Helvetica", "", 9)
+        pdf.set_x(10)
+        pdf.multi_cell(190, 5, pdf_safe(strip_markdown(synthesis["texte"])))
+        pdf.set_text_color(*GREY)
+        pdf.set_font("Helvetica", "I", 7)
+        pdf.cell(0, 5, pdf_safe(f"Synthese generee par IA le {synthesis['date'][:10]} a partir des donnees INSEE."), ln=True)
+
+    # ── SECTION 1 : TERRITOIRE ────────────────────────────────────
+    _pdf_section(pdf, "1. Presentation du territoire")
+    territoire_keys = [
+        "Population", "Densité (hab/km²)", "Surface (km2)",
+        "Code(s) postal(aux)", "Departement (code)", "Region (code)", "Code Département",
+    ]
+    for i, k in enumerate(territoire_keys):
+        if k in all_data:
+            _pdf_row(pdf, k, all_data[k], i % 2 == 0)
+
+    # ── SECTION 2 : COMPOSITION DÉMOGRAPHIQUE ────────────────────
+    demo_data = fetch_demographic_data(code, _kind)
+    _pdf_section(pdf, "2. Composition demographique (RP 2018)")
+    if demo_data:
+        # Ligne résumé hommes/femmes
+        if 'Part des hommes (%)' in demo_data and 'Part des femmes (%)' in demo_data:
+            _pdf_row(pdf, "Part des hommes (%)", demo_data['Part des hommes (%)'], True)
+            _pdf_row(pdf, "Part des femmes (%)", demo_data['Part des femmes (%)'], False)
+        if 'Indice de jeunesse' in demo_data:
+            _pdf_row(pdf, "Indice de jeunesse (pop<20ans / pop>=60ans)", demo_data['Indice de jeunesse'], True)
+        # Tranches d'âge
+        age_keys = ['Part 0-14 ans (%)', 'Part 15-29 ans (%)', 'Part 30-44 ans (%)',
+                    'Part 45-59 ans (%)', 'Part 60-74 ans (%)', 'Part 75-89 ans (%)', 'Part 90 ans et plus (%)']
+        for i, k in enumerate(age_keys):
+            if k in demo_data:
+                _pdf_row(pdf, k, demo_data[k], i % 2 == 0)
+    else:
+        pdf.set_text_color(108, 117, 125)
+        pdf.set_font("Helvetica", "I", 8)
+        pdf.cell(0, 6, "  Donnees non disponibles pour ce territoire.", ln=True)
+
+    # ── SECTION 3 : REVENUS & NIVEAU DE VIE ──────────────────────
+    _pdf_section(pdf, "3. Revenus et niveau de vie (FILOSOFI 2021)")
+    revenus_keys = [
+        "Niveau de vie median (EUR/an)",
+        "Niveau de vie D1 - 10pct les plus modestes (EUR/an)",
+        "Niveau de vie D9 - 10pct les plus aises (EUR/an)",
+        "Rapport interdecile D9/D1",
+        "Indice de Gini",
+        "Part des revenus d activite (%)",
+        "Part des prestations sociales (%)",
+        "Part des revenus du patrimoine (%)",
+        "Rapport Interdécile (D9/D1)",
+        "Part des revenus d'activité (%)",
+        "Niveau de vie Médian (€)",
+    ]
+    found = 0
+    for i, k in enumerate(revenus_keys):
+        if k in all_data:
+            _pdf_row(pdf, k, all_data[k], i % 2 == 0)
+            found += 1
+    if found == 0:
+        pdf.set_text_color(*GREY)
+        pdf.set_font("Helvetica", "I", 8)
+        pdf.cell(0, 6, "  Donnees non disponibles pour ce territoire.", ln=True)
+
+    # ── SECTION 4 : PAUVRETÉ ─────────────────────────────────────
+    _pdf_section(pdf, "4. Pauvrete et precarite (FILOSOFI 2021)")
+    pauvrete_keys = [
+        "Taux de pauvreté (%)",
+        "Taux de pauvrete a 60pct (%)",
+        "Taux de pauvrete des personnes en emploi (%)",
+        "Nombre de menages fiscaux",
+        "Nombre de personnes (menages fiscaux)",
+    ]
+    found = 0
+    for i, k in enumerate(pauvrete_keys):
+        if k in all_data:
+            _pdf_row(pdf, k, all_data[k], i % 2 == 0)
+            found += 1
+    if found == 0:
+        pdf.set_text_color(*GREY)
+        pdf.set_font("Helvetica", "I", 8)
+        pdf.cell(0, 6, "  Donnees non disponibles pour ce territoire.", ln=True)
+
+    # ── SECTION 5 : TOUTES LES AUTRES DONNÉES ────────────────────
+    already_shown = set(territoire_keys + revenus_keys + pauvrete_keys +
+                        list(demo_data.keys()) + ["URL Dossier INSEE", "Surface (ha)"])
+    remaining = {k: v for k, v in all_data.items()
+                 if k not in already_shown and v is not None}
+    if remaining:
+        _pdf_section(pdf, "5. Donnees complementaires")
+        for i, (k, v) in enumerate(remaining.items()):
+            _pdf_row(pdf, k, v, i % 2 == 0)
+
+    # ── SECTION EPCI / TERRITOIRE PERSONNALISÉ : LISTE DES COMMUNES ──
+    step(0.75, "Liste des communes")
+    group_label = "EPCI" if _kind in ("intercommunalites", "EPCI") else "TERRITOIRE"
+    if communes is None and _kind in ("intercommunalites", "EPCI"):
+        communes = fetch_epci_communes(code)
+    if communes:
+        communes = sorted(communes, key=lambda c: c["nom"])
+        scope = "de l'EPCI" if group_label == "EPCI" else "du territoire"
+        _pdf_section(pdf, f"Communes {scope} ({len(communes)} communes)")
+        # En-tête colonnes
+        y = pdf.get_y()
+        if y + 7 > pdf.h - pdf.b_margin:
+            pdf.add_page()
+            y = pdf.get_y()
+        pdf.set_fill_color(0, 51, 102)
+        pdf.set_draw_color(220, 220, 220)
+        pdf.rect(10, y, 190, 6, 'FD')
+        pdf.set_text_color(255, 255, 255)
+        pdf.set_font("Helvetica", "B", 8)
+        pdf.set_xy(12, y + 1)
+        pdf.cell(140, 4, "Commune", ln=False)
+        pdf.cell(48, 4, "Population", ln=False, align="R")
+        pdf.ln(6)
+        # Lignes
+        pop_total = sum(c["population"] or 0 for c in communes)
+        for i, commune in enumerate(communes):
+            _pdf_row(pdf, commune["nom"], commune.get("population") or "N/D", i % 2 == 0)
+        # Total
+        if pdf.get_y() + 8 > pdf.h - pdf.b_margin:
+            pdf.add_page()
+        y = pdf.get_y()
+        pdf.set_fill_color(230, 236, 245)
+        pdf.set_draw_color(0, 51, 102)
+        pdf.rect(10, y, 190, 7, 'FD')
+        pdf.set_text_color(0, 51, 102)
+        pdf.set_font("Helvetica", "B", 8)
+        pdf.set_xy(12, y + 1.5)
+        pdf.cell(140, 4, f"TOTAL {group_label}", ln=False)
+        pdf.cell(48, 4, f"{pop_total:,}".replace(",", " "), ln=False, align="R")
+        pdf.ln(7)
+
+    # ── SECTION ANALYSE IA (si disponible) ───────────────────────
+    step(0.85, "Analyse de l'assistant")
+    if ai_messages:
+        exchanges = [(m['content'], m['role']) for m in conversation_turns(ai_messages)]
+        if exchanges:
+            pdf.add_page()
+            _pdf_section(pdf, "6. Analyse de l'assistant IA")
+            pdf.set_font("Helvetica", "", 8)
+            pdf.set_text_color(30, 30, 30)
+            for content, role in exchanges:
+                prefix_label = "Question : " if role == "user" else "Reponse : "
+                pdf.set_font("Helvetica", "B", 8)
+                pdf.set_x(10)
+                pdf.cell(0, 5, pdf_safe(prefix_label), ln=True)
+                pdf.set_font("Helvetica", "", 8)
+                pdf.set_x(14)
+                pdf.multi_cell(186, 5, pdf_safe(strip_markdown(content)))
+                pdf.ln(2)
+
+    # ── NOTE DE BAS DE RAPPORT ────────────────────────────────────
+    pdf.ln(6)
+    pdf.set_fill_color(*LIGHT)
+    pdf.set_text_color(0, 51, 102)
+    pdf.set_font("Helvetica", "I", 8)
+    pdf.set_x(10)
+    pdf.multi_cell(190, 5,
+        "Ce rapport a ete genere automatiquement a partir des donnees "
+        "officielles de l'INSEE (FILOSOFI 2021, Recensement de la population 2022, "
+        "API Melodi). Pour acceder au dossier complet interactif avec graphiques et "
+        "tableaux detailles, consultez le lien en page 1.", fill=True)
+
+    step(0.95, "Mise en forme du PDF")
+    with telemetry.span("pdf.output", "pdf", pages=pdf.page_no()) as s:
+        output = pdf.output()
+        s.attributes["bytes"] = len(output)
+    return output
@@ -0,0 +1,125 @@
+"""Cache des réponses de l'assistant IA (TTL + LRU, déduplication des prompts)."""
+import difflib
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from unidecode import unidecode
+
+
+def normalize_prompt(prompt):
+    """Normalise une question : minuscules, sans accents, sans ponctuation ni espaces multiples."""
+    text = unidecode(str(prompt)).lower()
+    text = re.sub(r"[^a-z0-9%€ ]+", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def prompt_numbers(prompt_norm):
+    """Nombres d'une question normalisée (années, seuils, effectifs), dans l'ordre."""
+    return re.findall(r"\d+", prompt_norm)
+
+
+def same_terms(prompt_a, prompt_b, cutoff=0.8):
+    """Vrai si chaque mot propre à l'une des questions a un proche dans l'autre (faute de frappe, pluriel).
+
+    « pauvrete » / « chomage » : mots sans rapport, les questions portent sur deux indicateurs.
+    """
+    words_a, words_b = set(prompt_a.split()), set(prompt_b.split())
+    return all(difflib.get_close_matches(w, words_b if w in words_a else words_a, n=1, cutoff=cutoff)
+               for w in words_a ^ words_b)
+
+
+def context_hash(context_data):
+    """Empreinte stable du contexte de données envoyé au modèle."""
+    payload = json.dumps(context_data, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+class ResponseCache:
+    """Cache mémoire partagé des réponses Gemini.
+
+    La clé combine la question normalisée, le code du territoire et l'empreinte
+    du contexte : une mise à jour des données invalide donc naturellement les
+    réponses. Les entrées expirent après `ttl` secondes et les moins récemment
+    utilisées sont évincées au-delà de `max_entries`. Si `semantic` est activé,
+    une question quasi identique (ratio difflib >= `similarity`) sur le même
+    territoire et le même contexte est servie depuis le cache, à condition de
+    porter les mêmes nombres et les mêmes termes aux fautes près : « taux de
+    pauvreté 2019 » et « … 2021 », ou « taux de pauvreté » et « taux de chômage »,
+    presque identiques au caractère près, sont des questions différentes.
+    """
+
+    def __init__(self, ttl=86400, max_entries=512, semantic=False, similarity=0.92):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.semantic = semantic
+        self.similarity = similarity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "semantic_hits": 0, "misses": 0, "evictions": 0}
+
+    def make_key(self, prompt, territory_code, context_data):
+        return (normalize_prompt(prompt), str(territory_code), context_hash(context_data))
+
+    def _expired(self, stored_at):
+        return self.ttl is not None and time.time() - stored_at > self.ttl
+
+    def _find_similar(self, key):
+        prompt_norm, territory_code, ctx = key
+        numbers = prompt_numbers(prompt_norm)
+        best_key, best_ratio = None, 0.0
+        for other in self._entries:
+            if other[1] != territory_code or other[2] != ctx or prompt_numbers(other[0]) != numbers:
+                continue
+            ratio = difflib.SequenceMatcher(None, prompt_norm, other[0]).ratio()
+            if ratio > best_ratio and ratio >= self.similarity and same_terms(prompt_norm, other[0]):
+                best_key, best_ratio = other, ratio
+        return best_key
+
+    def get(self, prompt, territory_code, context_data):
+        """Retourne la réponse en cache ou None."""
+        key = self.make_key(prompt, territory_code, context_data)
+        with self._lock:
+            entry = self._entries.get(key)
+            semantic_hit = False
+            if entry is None and self.semantic:
+                similar = self._find_similar(key)
+                if similar is not None:
+                    key, entry, semantic_hit = similar, self._entries[similar], True
+            if entry is not None and self._expired(entry[1]):
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            if semantic_hit:
+                self.stats["semantic_hits"] += 1
+            return entry[0]
+
+    def set(self, prompt, territory_code, context_data, response):
+        key = self.make_key(prompt, territory_code, context_data)
+        with self._lock:
+            self._entries[key] = (response, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def metrics(self):
+        """Compteurs de hits/misses et taux de succès."""
+        with self._lock:
+            total = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "entries": len(self._entries),
+                "hit_rate": round(self.stats["hits"] / total, 3) if total else 0.0,
+            }
@@ -0,0 +1,122 @@
+"""Gestion du contexte envoyé à l'assistant IA (historique borné et table d'indicateurs compacte)."""
+import math
+import re
+
+from unidecode import unidecode
+
+# Clés sans intérêt analytique pour le modèle
+IGNORED_KEYS = {"url dossier insee"}
+
+# Libellés équivalents entre get_territory_indicators, fetch_pdf_data et fetch_demographic_data
+# (après suppression des accents, unités et ponctuation)
+KEY_ALIASES = {
+    "taux de pauvrete a 60pct": "taux de pauvrete",
+    "code departement": "departement code",
+}
+
+# Marqueur du message d'accueil ajouté par l'application : hors échange (ni contexte du modèle, ni rapport)
+WELCOME = "welcome"
+
+
+def conversation_turns(messages):
+    """Questions et réponses de l'échange, sans le message d'accueil (marqué WELCOME)."""
+    return [m for m in messages or [] if m.get("role") in ("user", "assistant") and not m.get(WELCOME)]
+
+
+def estimate_tokens(text):
+    """Estimation grossière du nombre de tokens (~4 caractères par token en français)."""
+    return math.ceil(len(text) / 4) if text else 0
+
+
+def _canonical_key(label):
+    """Forme canonique d'un libellé : sans accents, unités ni ponctuation."""
+    key = unidecode(str(label)).lower()
+    key = re.sub(r"\((?:%|eur.*?|€|hab/km.*?|km2|ha)\)", " ", key)
+    key = re.sub(r"[^a-z0-9]+", " ", key).strip()
+    return KEY_ALIASES.get(key, key)
+
+
+def _format_value(value):
+    if value is None:
+        return None
+    if isinstance(value, float):
+        if math.isnan(value):
+            return None
+        return f"{value:.0f}" if abs(value) >= 1000 else f"{value:.4g}"
+    return str(value)
+
+
+def merge_indicators(*sources):
+    """Fusionne plusieurs dictionnaires d'indicateurs en supprimant les doublons.
+
+    Les premières sources sont prioritaires : un indicateur déjà présent sous un
+    libellé équivalent (ex: « Niveau de vie Médian (€) » et « Niveau de vie
+    median (EUR/an) ») n'est pas répété.
+    """
+    seen = set()
+    merged = {}
+    for source in sources:
+        for label, value in (source or {}).items():
+            key = _canonical_key(label)
+            if key in IGNORED_KEYS or key in seen or _format_value(value) is None:
+                continue
+            seen.add(key)
+            merged[label] = value
+    return merged
+
+
+def format_indicator_table(indicators):
+    """Table compacte « libellé | valeur », une ligne par indicateur."""
+    return "\n".join(f"{label} | {_format_value(value)}" for label, value in indicators.items()
+                     if _format_value(value) is not None)
+
+
+def _first_sentence(text, max_chars=160):
+    text = re.sub(r"[*_#>`]+", "", str(text)).strip()
+    sentence = re.split(r"(?<=[.!?])\s", text, maxsplit=1)[0]
+    return sentence if len(sentence) <= max_chars else sentence[:max_chars].rstrip() + "…"
+
+
+def summarize_turns(messages, max_tokens):
+    """Résumé extractif des anciens échanges : question et première phrase de chaque réponse."""
+    lines = []
+    for m in messages:
+        prefix = "Q" if m["role"] == "user" else "R"
+        lines.append(f"{prefix}: {_first_sentence(m['content'])}")
+    summary = "\n".join(lines)
+    # On garde les éléments les plus récents si le résumé dépasse son budget
+    while lines and estimate_tokens(summary) > max_tokens:
+        lines.pop(0)
+        summary = "\n".join(lines)
+    return summary
+
+
+def build_conversation_window(messages, max_tokens=1500, summary_tokens=300):
+    """Découpe l'historique en (résumé des anciens tours, tours récents) dans un budget de tokens.
+
+    Les tours récents sont conservés intégralement du plus récent au plus ancien
+    tant que le budget le permet ; les tours plus anciens sont résumés.
+    """
+    turns = conversation_turns(messages)
+    recent = []
+    used = 0
+    for m in reversed(turns):
+        cost = estimate_tokens(m["content"])
+        if used + cost > max_tokens:
+            break
+        recent.insert(0, m)
+        used += cost
+    older = turns[:len(turns) - len(recent)]
+    summary = summarize_turns(older, summary_tokens) if older else ""
+    return summary, recent
+
+
+def format_history(summary, recent):
+    """Met en forme la fenêtre de conversation pour le prompt."""
+    blocks = []
+    if summary:
+        blocks.append(f"Résumé des échanges précédents :\n{summary}")
+    if recent:
+        lines = [f"{'Utilisateur' if m['role'] == 'user' else 'Assistant'} : {m['content']}" for m in recent]
+        blocks.append("Échanges récents :\n" + "\n".join(lines))
+    return "\n\n".join(blocks)
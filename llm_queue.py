@@ -0,0 +1,328 @@
+"""File d'attente asynchrone des appels LLM (concurrence bornée, équité par utilisateur, retry sur 429)."""
+import asyncio
+import itertools
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+
+class QueueFullError(Exception):
+    """La file est saturée : la requête est refusée plutôt que mise en attente indéfiniment."""
+
+
+class RateLimitError(Exception):
+    """Quota du fournisseur atteint (HTTP 429)."""
+
+
+class StreamInterruptedError(Exception):
+    """Flux coupé après l'envoi de morceaux à l'appelant : jamais rejoué (le texte serait dupliqué)."""
+
+
+def is_rate_limit_error(exc):
+    """Détecte une erreur 429 des clients connus (google.api_core, requests, FakeModel)."""
+    if isinstance(exc, StreamInterruptedError):
+        return False
+    if isinstance(exc, RateLimitError):
+        return True
+    # google.api_core : ResourceExhausted / TooManyRequests (attribut `code` = 429)
+    if type(exc).__name__ in ("ResourceExhausted", "TooManyRequests"):
+        return True
+    # requests.HTTPError : statut de la réponse attachée
+    response = getattr(exc, "response", None)
+    return getattr(response, "status_code", None) == 429
+
+
+# --- MODÈLE FACTICE (tests hors ligne) ---
+
+class _FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class _FakeResponse:
+    def __init__(self, chunks):
+        self.text = "".join(chunks)
+
+
+class FakeModel:
+    """Imite genai.GenerativeModel.generate_content sans réseau.
+
+    `latency` est la durée totale simulée d'une génération, `rate_limit_ratio`
+    la proportion d'appels rejetés avec une erreur 429.
+    """
+
+    def __init__(self, latency=0.5, rate_limit_ratio=0.0, chunk_size=40, seed=None):
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.chunk_size = chunk_size
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def _answer(self, prompt):
+        question = prompt.rsplit("L'utilisateur demande :", 1)[-1].split("\n", 1)[0].strip()
+        return (f"Réponse simulée à la question « {question} ». "
+                "Les indicateurs fournis permettent une première lecture du territoire.")
+
+    def generate_content(self, prompt, stream=False):
+        with self._lock:
+            self.calls += 1
+            rejected = self._random.random() < self.rate_limit_ratio
+        if rejected:
+            time.sleep(self.latency * 0.1)
+            raise RateLimitError("429 Resource has been exhausted (fake model)")
+        text = self._answer(prompt)
+        chunks = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)]
+        if not stream:
+            time.sleep(self.latency)
+            return _FakeResponse(chunks)
+        delay = self.latency / max(len(chunks), 1)
+
+        def _slow_chunks():
+            for chunk in chunks:
+                time.sleep(delay)
+                yield _FakeChunk(chunk)
+        return _slow_chunks()
+
+
+# --- FILE D'ATTENTE ---
+
+class _Job:
+    __slots__ = ("id", "user_id", "func", "args", "kwargs", "future", "submitted_at", "cancelled")
+
+    def __init__(self, job_id, user_id, func, args, kwargs):
+        self.id = job_id
+        self.user_id = user_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.submitted_at = time.perf_counter()
+        self.cancelled = False
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return round(ordered[idx], 3)
+
+
+class LLMQueue:
+    """File d'attente process-wide pour les appels LLM.
+
+    Une boucle asyncio tourne dans un thread dédié ; les appels bloquants du
+    client sont exécutés via asyncio.to_thread, au plus `concurrency` à la fois.
+    Les requêtes en attente sont servies à tour de rôle par utilisateur (un
+    utilisateur qui envoie une rafale ne bloque pas les autres). Au-delà de
+    `max_pending` requêtes en attente (ou `max_pending_per_user` pour un même
+    utilisateur), submit lève QueueFullError. Les erreurs 429 sont rejouées
+    avec un backoff exponentiel et jitter.
+    """
+
+    def __init__(self, concurrency=4, max_pending=64, max_pending_per_user=4,
+                 max_retries=3, backoff_base=1.0, backoff_max=20.0):
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.max_pending_per_user = max_pending_per_user
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._lock = threading.Lock()
+        self._pending = {}        # user_id -> deque[_Job]
+        self._users = deque()     # ordre de service (round-robin)
+        self._n_pending = 0
+        self._running = 0
+        self._ids = itertools.count(1)
+        self._wait_times = deque(maxlen=500)
+        self._run_times = deque(maxlen=500)
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0, "retries": 0}
+
+        self._loop = asyncio.new_event_loop()
+        self._wakeup = None
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, args=(ready,), name="llm-queue", daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    # -- boucle asyncio --
+
+    def _run_loop(self, ready):
+        asyncio.set_event_loop(self._loop)
+        self._wakeup = asyncio.Event()
+        self._loop.create_task(self._dispatcher())
+        ready.set()
+        self._loop.run_forever()
+
+    def _next_job(self):
+        """Prochaine requête à servir, en alternant entre utilisateurs (appelé sous verrou)."""
+        while self._users:
+            user_id = self._users.popleft()
+            jobs = self._pending.get(user_id)
+            if not jobs:
+                self._pending.pop(user_id, None)
+                continue
+            job = jobs.popleft()
+            self._n_pending -= 1
+            if jobs:
+                self._users.append(user_id)
+            else:
+                del self._pending[user_id]
+            if job.cancelled:
+                job.future.cancel()
+                continue
+            return job
+        return None
+
+    async def _dispatcher(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while True:
+                with self._lock:
+                    if self._running >= self.concurrency:
+                        break
+                    job = self._next_job()
+                    if job is None:
+                        break
+                    self._running += 1
+                self._loop.create_task(self._execute(job))
+
+    async def _execute(self, job):
+        started = time.perf_counter()
+        self._wait_times.append(started - job.submitted_at)
+        try:
+            attempt = 0
+            while True:
+                try:
+                    result = await asyncio.to_thread(job.func, *job.args, **job.kwargs)
+                    job.future.set_result(result)
+                    with self._lock:
+                        self.stats["completed"] += 1
+                    break
+                except Exception as e:
+                    if is_rate_limit_error(e) and attempt < self.max_retries and not job.cancelled:
+                        attempt += 1
+                        with self._lock:
+                            self.stats["retries"] += 1
+                        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+                        await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+                        continue
+                    job.future.set_exception(e)
+                    with self._lock:
+                        self.stats["failed"] += 1
+                    break
+        finally:
+            self._run_times.append(time.perf_counter() - started)
+            with self._lock:
+                self._running -= 1
+            self._wakeup.set()
+
+    # -- API synchrone (threads de script Streamlit) --
+
+    def submit(self, user_id, func, *args, **kwargs):
+        """Place un appel dans la file et retourne un concurrent.futures.Future."""
+        with self._lock:
+            user_jobs = self._pending.get(user_id)
+            if (self._n_pending >= self.max_pending
+                    or (user_jobs is not None and len(user_jobs) >= self.max_pending_per_user)):
+                self.stats["rejected"] += 1
+                raise QueueFullError("File d'attente LLM saturée")
+            job = _Job(next(self._ids), user_id, func, args, kwargs)
+            if user_jobs is None:
+                self._pending[user_id] = deque([job])
+                self._users.append(user_id)
+            else:
+                user_jobs.append(job)
+            self._n_pending += 1
+            self.stats["submitted"] += 1
+        self._loop.call_soon_threadsafe(self._wakeup.set)
+        job.future.job = job
+        return job.future
+
+    def call(self, user_id, func, *args, timeout=None, **kwargs):
+        """Version bloquante de submit."""
+        return self.submit(user_id, func, *args, **kwargs).result(timeout=timeout)
+
+    def stream(self, user_id, make_iterable, timeout=120):
+        """Exécute un appel en streaming via la file et renvoie ses morceaux au fil de l'eau.
+
+        `make_iterable` est appelé dans un worker ; ses éléments sont transmis au
+        générateur appelant. Un 429 n'est rejoué que si aucun morceau n'a encore
+        été transmis. Fermer le générateur annule la requête.
+        """
+        chunks = queue.Queue()
+        done = object()
+        cancelled = threading.Event()
+        emitted = threading.Event()
+
+        def _consume():
+            try:
+                for item in make_iterable():
+                    if cancelled.is_set():
+                        break
+                    emitted.set()
+                    chunks.put(item)
+            except Exception as e:
+                # Rejouer après un début de réponse dupliquerait le texte : pas de retry
+                if emitted.is_set():
+                    raise StreamInterruptedError(f"Flux interrompu : {e}") from e
+                raise
+
+        future = self.submit(user_id, _consume)
+        future.add_done_callback(lambda _f: chunks.put(done))
+        try:
+            while True:
+                try:
+                    item = chunks.get(timeout=timeout)
+                except queue.Empty:
+                    raise TimeoutError("Aucune réponse du modèle dans le délai imparti")
+                if item is done:
+                    break
+                yield item
+            if not future.cancelled():
+                future.result()
+        finally:
+            cancelled.set()
+            future.job.cancelled = True
+
+    def metrics(self):
+        """Profondeur de file, requêtes en cours, compteurs et latences (attente / exécution)."""
+        with self._lock:
+            return {
+                "queue_depth": self._n_pending,
+                "running": self._running,
+                "concurrency": self.concurrency,
+                **self.stats,
+                "wait_p50_s": _percentile(self._wait_times, 50),
+                "wait_p95_s": _percentile(self._wait_times, 95),
+                "run_p50_s": _percentile(self._run_times, 50),
+                "run_p95_s": _percentile(self._run_times, 95),
+            }
+
+
+if __name__ == "__main__":
+    # Démonstration hors ligne : 3 utilisateurs, rafale de requêtes, 20 % de 429 simulés
+    fake = FakeModel(latency=0.2, rate_limit_ratio=0.2, seed=42)
+    llm_queue = LLMQueue(concurrency=int(os.getenv("LLM_CONCURRENCY", "2")), backoff_base=0.1)
+    futures = []
+    for i in range(12):
+        user = f"user-{i % 3}"
+        try:
+            futures.append(llm_queue.submit(user, fake.generate_content, f"L'utilisateur demande : question {i}"))
+        except QueueFullError:
+            print(f"{user} : requête {i} refusée (file saturée)")
+    for f in futures:
+        try:
+            print(f.result().text)
+        except Exception as e:
+            print(f"Échec : {e}")
+    print("".join(llm_queue.stream("user-0", lambda: (c.text for c in fake.generate_content(
+        "L'utilisateur demande : en streaming", stream=True)))))
+    print(llm_queue.metrics())
@@ -0,0 +1,203 @@
+"""Amont simulé pour les tests de charge : un serveur HTTP local à latence et taux d'erreur réglables.
+
+Le serveur rejoue le territoire synthétique des benchmarks (benchmarks/synthetic.py)
+pour toutes les API amont. Le premier segment du chemin désigne l'hôte d'origine :
+
+    http://127.0.0.1:<port>/geo.api.gouv.fr/communes/01001?fields=centre
+        -> https://geo.api.gouv.fr/communes/01001?fields=centre
+
+L'application y est redirigée par ses variables d'environnement (GEO_API_URL,
+INSEE_API_URL, FRANCE_GEOJSON_URL, IGN_WMTS_URL, COG_MVT_URL), voir `upstream_env`.
+
+pynsee n'expose pas d'URL configurable : `install_pynsee` remplace dans le
+processus testé get_local_data / get_population par des appels à la route
+/_pynsee/<fonction> du serveur, qui applique le même modèle de latence et
+d'erreurs et renvoie le résultat en parquet.
+
+Lancement autonome (imprime l'URL de base sur la première ligne) :
+    python loadtest/mock_upstream.py --latency-ms 120 --jitter-ms 60 --error-rate 0.02
+"""
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+LOADTEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(LOADTEST_DIR), "benchmarks"))
+
+import synthetic  # noqa: E402
+
+PYNSEE_FUNCTIONS = {"get_local_data": synthetic.get_local_data, "get_population": synthetic.get_population}
+
+
+class UpstreamModel:
+    """Latence (moyenne + gigue uniforme, en ms) et taux d'erreurs 503, globaux ou par hôte."""
+
+    def __init__(self, latency_ms=80.0, jitter_ms=40.0, error_rate=0.0, per_host=None, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.per_host = per_host or {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.counts = {"requests": 0, "errors": 0, "unknown": 0}
+
+    def draw(self, host):
+        """(délai en secondes, erreur simulée ?) pour une requête vers `host`."""
+        latency, jitter, error_rate = self.per_host.get(host, (self.latency_ms, self.jitter_ms, self.error_rate))
+        with self._lock:
+            delay = max(0.0, latency + self._rng.uniform(-jitter, jitter)) / 1000
+            failed = self._rng.random() < error_rate
+            self.counts["requests"] += 1
+            self.counts["errors"] += failed
+        return delay, failed
+
+
+def _parquet(frame):
+    buffer = io.BytesIO()
+    frame.to_parquet(buffer)
+    return buffer.getvalue()
+
+
+def make_handler(model):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, status, content_type, body):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _serve(self, payload=None):
+            parts = urlsplit(self.path)
+            host, _, rest = parts.path.lstrip("/").partition("/")
+            if host == "_stats":
+                return self._send(200, "application/json", json.dumps(model.counts).encode())
+            delay, failed = model.draw(host)
+            time.sleep(delay)
+            if failed:
+                return self._send(503, "text/plain", b"Service temporairement indisponible (simule)")
+            if host == "_pynsee":
+                function = PYNSEE_FUNCTIONS.get(rest)
+                if function is None:
+                    return self._send(404, "text/plain", b"")
+                kwargs = json.loads(payload or b"{}")
+                return self._send(200, "application/vnd.apache.parquet", _parquet(function(**kwargs)))
+            url = f"https://{host}/{rest}" + (f"?{parts.query}" if parts.query else "")
+            response = synthetic.respond(self.command, url)
+            if response is None:
+                model.counts["unknown"] += 1
+                return self._send(404, "text/plain", f"URL non simulee : {url}".encode())
+            self._send(*response)
+
+        def do_GET(self):
+            self._serve()
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            self._serve(self.rfile.read(length))
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(model, host="127.0.0.1", port=0):
+    """Démarre le serveur dans un thread ; renvoie (serveur, URL de base)."""
+    server = ThreadingHTTPServer((host, port), make_handler(model))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name="mock-upstream").start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def upstream_env(base_url):
+    """Variables d'environnement qui redirigent l'application vers le serveur simulé."""
+    return {
+        "GEO_API_URL": f"{base_url}/geo.api.gouv.fr",
+        "INSEE_API_URL": f"{base_url}/api.insee.fr",
+        "FRANCE_GEOJSON_URL": f"{base_url}/raw.githubusercontent.com/gregoiredavid/france-geojson/master",
+        "IGN_WMTS_URL": f"{base_url}/data.geopf.fr/wmts",
+        "COG_MVT_URL": f"{base_url}/www.data.gouv.fr/v_mvt_commune.csv",
+        "NO_PROXY": "127.0.0.1,localhost",
+    }
+
+
+def install_pynsee(base_url, timeout=60):
+    """Redirige pynsee.get_local_data / get_population vers la route /_pynsee du serveur simulé.
+
+    À appeler avant l'import d'insee_data (l'instrumentation de telemetry enveloppe alors ces appels).
+    """
+    import pandas as pd
+    import pynsee
+    import requests
+
+    def remote(name):
+        def call(**kwargs):
+            r = requests.post(f"{base_url}/_pynsee/{name}", data=json.dumps(kwargs, default=list), timeout=timeout)
+            r.raise_for_status()
+            return pd.read_parquet(io.BytesIO(r.content))
+        call.__name__ = name
+        return call
+
+    for name in PYNSEE_FUNCTIONS:
+        setattr(pynsee, name, remote(name))
+
+
+def warm():
+    """Précalcule les réponses les plus lourdes du territoire synthétique (hors mesure)."""
+    synthetic.communes()
+    for dep in synthetic.DEPARTEMENTS:
+        synthetic.communes(dep)
+
+
+def parse_per_host(values):
+    """`hôte=latence_ms[:gigue_ms[:taux]]` -> {hôte: (latence, gigue, taux)}."""
+    per_host = {}
+    for value in values or []:
+        host, _, spec = value.partition("=")
+        fields = [float(x) for x in spec.split(":")]
+        latency = fields[0]
+        jitter = fields[1] if len(fields) > 1 else 0.0
+        rate = fields[2] if len(fields) > 2 else 0.0
+        per_host[host] = (latency, jitter, rate)
+    return per_host
+
+
+def add_model_arguments(parser):
+    parser.add_argument("--latency-ms", type=float, default=80.0, help="Latence moyenne de l'amont (ms)")
+    parser.add_argument("--jitter-ms", type=float, default=40.0, help="Gigue uniforme autour de la moyenne (ms)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Part des requêtes en erreur 503 (0-1)")
+    parser.add_argument("--host", action="append", metavar="HÔTE=MS[:GIGUE[:TAUX]]",
+                        help="Modèle propre à un hôte, ex. api.insee.fr=400:200:0.05 ; _pynsee pour pynsee (répétable)")
+    parser.add_argument("--seed", type=int, default=None, help="Graine du tirage latence / erreurs")
+
+
+def model_from_args(args):
+    return UpstreamModel(args.latency_ms, args.jitter_ms, args.error_rate, parse_per_host(args.host), args.seed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=0)
+    add_model_arguments(parser)
+    args = parser.parse_args(argv)
+    warm()
+    server, base_url = serve(model_from_args(args), port=args.port)
+    print(base_url, flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
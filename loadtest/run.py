@@ -0,0 +1,362 @@
+"""Test de charge : N sessions Streamlit simulées parcourent l'application en parallèle.
+
+Chaque utilisateur virtuel est une session AppTest (sans navigateur) exécutée dans
+un thread du processus de test : comme les sessions d'un serveur Streamlit, elles
+partagent caches (st.cache_data), ressources et GIL. Parcours d'un utilisateur :
+
+    ouverture -> type de territoire -> recherche -> sélection
+    -> changement d'indicateur (carte) -> export PDF (demande, puis rapport prêt)
+    -> question à l'assistant
+
+Les API amont sont servies par mock_upstream.py (processus séparé, latence et
+erreurs réglables), Gemini par le modèle factice de llm_queue (LLM_FAKE=1).
+La charge monte par paliers (--users 1 2 4 8) ; pour chaque palier : p50/p95/p99
+par étape, taux d'erreur, débit de parcours et mémoire par session (pic de RSS
+au-dessus du niveau de départ, divisé par le nombre de sessions). Le point de
+saturation est le premier palier où le débit ne progresse plus (gain < --min-gain)
+ou où le p95 d'une étape dépasse --slo-p95.
+
+Usage (depuis la racine du dépôt, dépendances de benchmarks/requirements.txt) :
+    python loadtest/run.py --users 1 2 4 8 16 --latency-ms 120 --error-rate 0.02
+    python loadtest/run.py --users 4 --scales epci departement --host api.insee.fr=600:300
+Rapport JSON écrit dans .cache/loadtest (--out pour un autre fichier).
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen
+
+import numpy as np
+
+LOADTEST_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(LOADTEST_DIR)
+APP_PATH = os.path.join(ROOT_DIR, "app.py")
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, LOADTEST_DIR)
+
+import mock_upstream  # noqa: E402
+import synthetic  # noqa: E402  (benchmarks/, ajouté au chemin par mock_upstream)
+
+STEPS = ["ouverture", "type", "recherche", "sélection", "indicateur", "pdf", "pdf prêt", "assistant"]
+SCALE_LABELS = {"commune": "Communes", "epci": "EPCI (Intercommunalités)", "departement": "Départements",
+                "region": "Régions"}
+QUESTIONS = [
+    "Quel est le taux de pauvreté ?",
+    "Comment évolue la population ?",
+    "Quels sont les principaux employeurs ?",
+    "Ce territoire est-il plutôt jeune ou âgé ?",
+]
+
+
+def pick_territory(rng, scales):
+    """(libellé du type, texte recherché, entrée à choisir) d'un territoire synthétique tiré au hasard."""
+    scale = rng.choice(scales)
+    dep = rng.choice(synthetic.DEPARTEMENTS)
+    i = rng.randrange(synthetic.COMMUNES_PER_DEP)
+    if scale == "commune":
+        code = f"{dep}{i + 1:03d}"
+        name = f"Commune synthétique {code}"
+    elif scale == "epci":
+        code = synthetic.epci_of(dep, i)
+        name = f"CC synthétique {code[-3:]}"
+    elif scale == "departement":
+        code, name = dep, f"Département {dep}"
+    else:
+        code, name = synthetic.SCALES["region"][0], synthetic.SCALES["region"][2]
+    return SCALE_LABELS[scale], name, f"{name} ({code})"
+
+
+def rss_bytes():
+    """Mémoire résidente du processus (Linux : /proc ; ailleurs : pic de getrusage)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RssSampler:
+    """Pic de RSS pendant un palier (échantillonné en arrière-plan)."""
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.peak = rss_bytes()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, rss_bytes())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss_bytes())
+
+
+def share_runtime():
+    """Rend AppTest utilisable depuis plusieurs threads.
+
+    AppTest installe un Runtime factice global au début de chaque rerun et le retire
+    à la fin (idem pour l'option global.appTest) : deux sessions simultanées se le
+    retirent mutuellement. Ici le premier Runtime installé reste en place pour tout
+    le processus, comme l'unique Runtime d'un serveur partagé par ses sessions ; de
+    même, un seul cache de bytecode (verrouillé) au lieu d'une compilation du script
+    par rerun, que CPython ne supporte pas en parallèle.
+    """
+    import contextlib
+
+    from streamlit import config
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1 import app_test, local_script_runner
+
+    class KeepFirstInstance(type(Runtime)):
+        def __setattr__(cls, name, value):
+            if name != "_instance":
+                return super().__setattr__(name, value)
+            if value is not None and Runtime._instance is None:
+                Runtime._instance = value
+
+    app_test.Runtime = KeepFirstInstance("SharedRuntime", (Runtime,), {})
+    config.set_option("global.appTest", True)
+    app_test.patch_config_options = lambda options: contextlib.nullcontext()
+    script_cache = ScriptCache()
+    app_test.ScriptCache = local_script_runner.ScriptCache = lambda: script_cache
+
+
+def element(elements, label):
+    """Élément de la page par libellé (exact, ou contenu pour les boutons) ; LookupError s'il est absent."""
+    found = next((e for e in elements if e.label == label or label in e.label), None)
+    if found is None:
+        raise LookupError(f"élément absent : {label}")
+    return found
+
+
+def run_session(seed, args):
+    """Parcours complet d'un utilisateur virtuel ; renvoie les mesures de chaque étape jouée."""
+    from streamlit.testing.v1 import AppTest
+
+    rng = random.Random(seed)
+    type_label, query, display = pick_territory(rng, args.scales)
+    at = AppTest.from_file(APP_PATH, default_timeout=args.timeout)
+    results = []
+
+    def step(name, action):
+        if results and args.think:
+            time.sleep(rng.uniform(0, 2 * args.think))
+        t0 = time.perf_counter()
+        error = None
+        try:
+            if action() is False:
+                return True  # étape sans objet pour ce territoire
+            if at.exception:
+                error = at.exception[0].value.splitlines()[0]
+            elif at.error:
+                error = str(at.error[0].value).splitlines()[0]
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        results.append({"étape": name, "durée_s": time.perf_counter() - t0, "erreur": error})
+        return error is None
+
+    def choose_indicator():
+        try:
+            box = element(at.selectbox, "Indicateur à afficher")
+        except LookupError:
+            return False
+        others = [o for o in box.options if o != box.value]
+        if not others:
+            return False
+        box.select(rng.choice(others)).run()
+
+    def pdf_ready():
+        job = at.session_state.pdf_job
+        if not job.wait(args.timeout) or job.error:
+            raise RuntimeError(job.error or "rapport PDF non terminé")
+        at.run()
+        if not [e for e in at.get("download_button") if "Télécharger" in e.proto.label]:
+            raise LookupError("élément absent : Télécharger le rapport PDF")
+
+    flow = [
+        ("ouverture", at.run),
+        ("type", lambda: at.selectbox(key="territory_type").select(type_label).run()),
+        ("recherche", lambda: at.text_input(key="territory_search").input(query).run()),
+        ("sélection", lambda: element(at.sidebar.selectbox, "Choisir").select(display).run()),
+        ("indicateur", choose_indicator),
+        ("pdf", lambda: element(at.button, "PDF").click().run()),
+        # Génération en tâche de fond (pdf_jobs) : attente du rapport, puis rerun qui affiche le téléchargement
+        ("pdf prêt", pdf_ready),
+        ("assistant", lambda: at.chat_input[0].set_value(rng.choice(QUESTIONS)).run()),
+    ]
+    for name, action in flow:
+        # Une étape en échec (élément absent, exception) interrompt le parcours comme pour un vrai utilisateur
+        if not step(name, action):
+            break
+    return results
+
+
+def percentiles(values):
+    if not values:
+        return {"n": 0}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"n": len(values), "p50": p50, "p95": p95, "p99": p99, "moyenne": float(np.mean(values))}
+
+
+def run_level(users, args, level_seed):
+    """Palier de charge : `users` sessions simultanées, chacune enchaînant --flows parcours."""
+    import streamlit as st
+    from geo_cache import get_geo_cache
+
+    if not args.warm:
+        st.cache_data.clear()
+        get_geo_cache().clear()
+    baseline = rss_bytes()
+    t0 = time.perf_counter()
+    with RssSampler() as sampler, ThreadPoolExecutor(max_workers=users) as pool:
+        futures = [pool.submit(lambda u=u: [r for f in range(args.flows)
+                                            for r in run_session(level_seed * 100003 + u * 101 + f, args)])
+                   for u in range(users)]
+        rows = [r for future in futures for r in future.result()]
+    wall = time.perf_counter() - t0
+
+    steps = {}
+    for name in STEPS:
+        durations = [r["durée_s"] for r in rows if r["étape"] == name]
+        errors = [r["erreur"] for r in rows if r["étape"] == name and r["erreur"]]
+        steps[name] = {**percentiles(durations), "erreurs": len(errors),
+                       "exemples_erreurs": sorted(set(errors))[:3]}
+    completed = sum(1 for r in rows if r["étape"] == "assistant" and not r["erreur"])
+    return {
+        "sessions": users,
+        "durée_s": wall,
+        "parcours_complets": completed,
+        "débit_parcours_min": 60 * completed / wall,
+        "mémoire_session_mo": (sampler.peak - baseline) / users / 2**20,
+        "rss_pic_mo": sampler.peak / 2**20,
+        "cache_geo": get_geo_cache().metrics(),
+        "étapes": steps,
+    }
+
+
+def find_saturation(levels, min_gain, slo_p95):
+    """Premier palier où le débit ne progresse plus assez, ou où un p95 d'étape dépasse le SLO."""
+    previous = None
+    for level in levels:
+        slow = [name for name, s in level["étapes"].items() if s.get("p95", 0) > slo_p95]
+        if slow:
+            return {"sessions": level["sessions"], "raison": f"p95 > {slo_p95:g} s ({', '.join(slow)})"}
+        if previous and previous["débit_parcours_min"] > 0:
+            gain = level["débit_parcours_min"] / previous["débit_parcours_min"] - 1
+            if gain < min_gain:
+                return {"sessions": level["sessions"],
+                        "raison": f"débit {gain:+.0%} par rapport à {previous['sessions']} session(s)"}
+        previous = level
+    return None
+
+
+def print_level(level):
+    print(f"\n== {level['sessions']} session(s) : {level['durée_s']:.1f} s, "
+          f"{level['parcours_complets']} parcours complets ({level['débit_parcours_min']:.1f}/min), "
+          f"{level['mémoire_session_mo']:.0f} Mo/session (pic RSS {level['rss_pic_mo']:.0f} Mo)")
+    print(f"  {'étape':<12}{'n':>5}{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}{'erreurs':>9}")
+    for name, s in level["étapes"].items():
+        if not s["n"]:
+            continue
+        print(f"  {name:<12}{s['n']:>5}{s['p50']:>9.2f}{s['p95']:>9.2f}{s['p99']:>9.2f}{s['erreurs']:>9}")
+        for example in s["exemples_erreurs"]:
+            print(f"      ! {example[:110]}")
+
+
+def start_upstream(args):
+    """Lance mock_upstream.py dans un processus séparé (son CPU ne concurrence pas les sessions)."""
+    command = [sys.executable, os.path.join(LOADTEST_DIR, "mock_upstream.py"),
+               "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+               "--error-rate", str(args.error_rate)]
+    for host in args.host or []:
+        command += ["--host", host]
+    if args.seed is not None:
+        command += ["--seed", str(args.seed)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    base_url = process.stdout.readline().strip()
+    if not base_url:
+        process.kill()
+        raise RuntimeError("Le serveur amont simulé n'a pas démarré")
+    return process, base_url
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, nargs="+", default=[1, 2, 4, 8], help="Paliers de sessions simultanées")
+    parser.add_argument("--flows", type=int, default=1, help="Parcours enchaînés par session et par palier")
+    parser.add_argument("--scales", nargs="+", choices=list(SCALE_LABELS), default=["commune", "epci"],
+                        help="Échelles des territoires tirés au hasard")
+    parser.add_argument("--think", type=float, default=0.0, help="Temps de réflexion moyen entre étapes (s)")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Latence du modèle factice (s)")
+    parser.add_argument("--llm-429-ratio", type=float, default=0.0, help="Part des appels IA refusés (429)")
+    parser.add_argument("--timeout", type=float, default=300, help="Délai maximal d'un rerun (s)")
+    parser.add_argument("--warm", action="store_true", help="Conserver les caches de données d'un palier à l'autre")
+    parser.add_argument("--slo-p95", type=float, default=10.0, help="p95 maximal acceptable par étape (s)")
+    parser.add_argument("--min-gain", type=float, default=0.1, help="Gain de débit minimal entre deux paliers")
+    parser.add_argument("--out", default=None, help="Rapport JSON (défaut : .cache/loadtest/<date>.json)")
+    mock_upstream.add_model_arguments(parser)
+    args = parser.parse_args(argv)
+
+    process, base_url = start_upstream(args)
+    # Environnement fixé avant le premier import de l'application (lu à l'import des modules)
+    os.environ.update(mock_upstream.upstream_env(base_url))
+    os.environ.setdefault("INSEE_DATA_DIR", tempfile.mkdtemp(prefix="insee-loadtest-"))
+    os.environ.update({"LLM_FAKE": "1", "LLM_FAKE_LATENCY": str(args.llm_latency),
+                       "LLM_FAKE_429_RATIO": str(args.llm_429_ratio)})
+    mock_upstream.install_pynsee(base_url)
+    from streamlit import logger
+    logger.set_log_level("error")
+
+    levels = []
+    try:
+        print(f"Amont simulé : {base_url} (latence {args.latency_ms:g} ± {args.jitter_ms:g} ms, "
+              f"erreurs {args.error_rate:.0%}) ; données : {os.environ['INSEE_DATA_DIR']}")
+        # Ressources partagées (référentiels) construites une fois, hors mesure, comme au démarrage d'un serveur
+        from insee_data import get_hierarchy
+        get_hierarchy()
+        share_runtime()
+        # Parcours d'échauffement non mesuré : imports paresseux faits une fois, avant que des sessions
+        # simultanées ne les déclenchent ensemble (compile() n'est pas sûr en parallèle sous CPython 3.11)
+        run_session(-1, args)
+        for n, users in enumerate(args.users):
+            levels.append(run_level(users, args, n + (args.seed or 0)))
+            print_level(levels[-1])
+        with urlopen(f"{base_url}/_stats") as r:
+            upstream = json.load(r)
+    finally:
+        process.terminate()
+
+    saturation = find_saturation(levels, args.min_gain, args.slo_p95)
+    print(f"\nAppels amont : {upstream['requests']} dont {upstream['errors']} en erreur simulée, "
+          f"{upstream['unknown']} non couverts")
+    if saturation:
+        print(f"Saturation à {saturation['sessions']} session(s) : {saturation['raison']}")
+    else:
+        print(f"Pas de saturation jusqu'à {args.users[-1]} session(s)")
+
+    out = args.out or os.path.join(ROOT_DIR, ".cache", "loadtest", time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump({"paramètres": vars(args), "amont": upstream, "paliers": levels, "saturation": saturation},
+                  f, ensure_ascii=False, indent=1, default=float)
+    print(f"Rapport : {out}")
+
+
+if __name__ == "__main__":
+    main()
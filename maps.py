@@ -0,0 +1,137 @@
+"""Construction des cartes folium de l'application (vue générale, choroplèthes, carroyage).
+
+Fonctions sans état Streamlit : importables par app.py comme par les
+benchmarks (benchmarks/bench_render.py). folium n'est importé qu'à la
+construction de la première carte.
+"""
+import math
+
+import ign_tiles
+import telemetry
+
+# Contour du territoire sur la vue générale, selon le fond affiché
+OUTLINE_STYLE = {'fillColor': '#003366', 'color': '#003366', 'weight': 3, 'fillOpacity': 0.1}
+OUTLINE_STYLE_BY_LAYER = {ign_tiles.LAYERS["ortho"][2]: {**OUTLINE_STYLE, 'color': 'white'}}
+
+
+def palette_for(indicator):
+    if "Niveau de vie" in indicator: return "YlGn"
+    if "pauvres" in indicator: return "RdPu"
+    return "YlOrRd"
+
+
+def _base_layer_styles(outline, styles, default):
+    """Élément Leaflet : restyle `outline` au changement de fond (baselayerchange), dans le navigateur."""
+    from branca.element import MacroElement
+    from jinja2 import Template
+
+    element = MacroElement()
+    element._name = "BaseLayerStyles"
+    element._template = Template("""
+        {% macro script(this, kwargs) %}
+            {{ this._parent.get_name() }}.on("baselayerchange", function (e) {
+                {{ this.outline.get_name() }}.setStyle({{ this.styles|tojson }}[e.name] || {{ this.default|tojson }});
+            });
+        {% endmacro %}
+    """)
+    element.outline, element.styles, element.default = outline, styles, default
+    return element
+
+
+@telemetry.traced("render")
+def build_overview_map(geometry, zoom_start):
+    """Vue générale : contour du territoire sur fond Plan IGN ou photographies aériennes.
+
+    Les deux fonds sont des couches de base du sélecteur Leaflet : changer de fond se fait
+    dans le navigateur, sans rerun ni nouvel envoi de la géométrie ; le contour passe en
+    blanc sur les photographies.
+    """
+    import folium
+
+    # Centre de l'emprise (sans reprojection : ~10 ms de moins par rendu)
+    minx, miny, maxx, maxy = geometry.total_bounds
+    m = folium.Map(location=[(miny + maxy) / 2, (minx + maxx) / 2], zoom_start=zoom_start, tiles=None)
+    for layer, show in (("plan", True), ("ortho", False)):
+        folium.TileLayer(tiles=ign_tiles.tile_url(layer), attr=ign_tiles.ATTRIBUTION, name=ign_tiles.LAYERS[layer][2],
+                         overlay=False, control=True, show=show, max_zoom=ign_tiles.MAX_ZOOM).add_to(m)
+
+    with telemetry.span("geojson", "render", features=len(geometry)):
+        # Contour seul (aucune propriété affichée) : ni conversion des attributs ni aller-retour JSON
+        geojson_data = geometry.geometry.__geo_interface__
+    outline = folium.GeoJson(geojson_data, name="Contour", control=False, style_function=lambda x: OUTLINE_STYLE)
+    outline.add_to(m)
+    folium.LayerControl(position="topright", collapsed=False).add_to(m)
+    m.add_child(_base_layer_styles(outline, OUTLINE_STYLE_BY_LAYER, OUTLINE_STYLE))
+    return m
+
+
+@telemetry.traced("render")
+def build_choropleth(gdf, indicator, legend_name, unit_alias="Commune: ", fill_color=None):
+    """Carte choroplèthe folium d'un GeoDataFrame (colonnes code / nom / valeur) ; None si aucune valeur."""
+    import folium
+
+    gdf_plot = gdf.dropna(subset=["valeur"])
+    if gdf_plot.empty:
+        return None
+    fill_color = fill_color or palette_for(indicator)
+
+    # Valeurs (quasi) constantes : numpy ne sait pas découper un écart de quelques ulp en
+    # 6 classes (« Too many bins for data range ») ; 3 classes centrées sur la valeur.
+    bins = 6
+    lo, hi = gdf_plot["valeur"].min(), gdf_plot["valeur"].max()
+    if math.isclose(lo, hi, rel_tol=1e-9, abs_tol=1e-12):
+        half = max(abs(lo), 1.0) / 100
+        bins = [lo - half, lo - half / 3, hi + half / 3, hi + half]
+
+    # Optimisation du centrage : on prend les limites globales
+    bounds = gdf_plot.total_bounds
+    m = folium.Map(location=[(bounds[1] + bounds[3]) / 2, (bounds[0] + bounds[2]) / 2], zoom_start=9)
+    m.fit_bounds([[bounds[1], bounds[0]], [bounds[3], bounds[2]]])
+
+    # Export JSON une seule fois
+    with telemetry.span("geojson", "render", features=len(gdf_plot)) as s:
+        geojson_data = gdf_plot[["code", "nom", "valeur", "geometry"]].to_json()
+        s.attributes["bytes"] = len(geojson_data)
+    folium.Choropleth(
+        geo_data=geojson_data,
+        name="choropleth",
+        data=gdf_plot,
+        columns=["code", "valeur"],
+        key_on="feature.properties.code",
+        fill_color=fill_color,
+        bins=bins,
+        fill_opacity=0.7,
+        line_opacity=0.2,
+        legend_name=legend_name,
+    ).add_to(m)
+
+    tooltip = folium.features.GeoJson(
+        geojson_data,
+        style_function=lambda x: {'fillColor': '#ffffff', 'color':'#000000', 'fillOpacity': 0.1, 'weight': 0.1},
+        control=False,
+        highlight_function=lambda x: {'fillColor': '#000000', 'color':'#000000', 'fillOpacity': 0.5, 'weight': 0.1},
+        tooltip=folium.features.GeoJsonTooltip(
+            fields=['nom', 'code', 'valeur'],
+            aliases=[unit_alias, 'Code: ', f'{legend_name}: '],
+            style=("background-color: white; color: #333333; font-family: arial; font-size: 12px; padding: 10px;")
+        )
+    )
+    m.add_child(tooltip)
+    return m
+
+
+@telemetry.traced("render")
+def build_grid_map(overlay, geometry, legend_name):
+    """Carte du carroyage : image PNG des carreaux et contour du territoire."""
+    import folium
+    from branca.colormap import LinearColormap
+
+    s, w = overlay["bounds"][0]
+    n, e = overlay["bounds"][1]
+    m = folium.Map(location=[(s + n) / 2, (w + e) / 2], zoom_start=11)
+    m.fit_bounds(overlay["bounds"])
+    folium.raster_layers.ImageOverlay(image=overlay["image"], bounds=overlay["bounds"], name=legend_name).add_to(m)
+    folium.GeoJson(geometry, style_function=lambda x: {'fillOpacity': 0, 'color': '#333333', 'weight': 1.5},
+                   control=False).add_to(m)
+    LinearColormap(overlay["colors"], vmin=overlay["vmin"], vmax=overlay["vmax"], caption=legend_name).add_to(m)
+    return m
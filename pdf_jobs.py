@@ -0,0 +1,222 @@
+"""Export PDF en tâche de fond : pool de workers, progression par tâche, cache adressé par contenu.
+
+La génération d'un rapport (données étendues, carte contextily, mise en page fpdf2)
+prend de l'ordre de la seconde : elle tourne dans un pool de threads partagé par le
+processus (PDF_WORKERS), pendant que la session continue de répondre. Chaque tâche
+publie sa progression (`PDFJob.update`), que la section d'export de l'application
+relit périodiquement.
+
+Un rapport est identifié par le territoire, l'empreinte des données qu'il reprend
+et celle de l'échange avec l'assistant (`pdf_key`). Les rapports terminés sont
+rangés sur disque sous cette clé (DATA_DIR/pdf) : un nouvel export identique, de la
+même session, d'une autre ou de l'API (api.py), est servi sans régénération, et
+deux demandes simultanées identiques partagent la même tâche. Le rapport porte sa date de
+génération : les fichiers expirent après PDF_CACHE_TTL_DAYS, et les moins récemment
+servis sont supprimés au-delà de PDF_CACHE_MB.
+"""
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from insee_data import DATA_DIR
+from llm_cache import context_hash
+from llm_context import conversation_turns
+import telemetry
+
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", "2"))
+PDF_CACHE_DIR = os.getenv("PDF_CACHE_DIR", os.path.join(DATA_DIR, "pdf"))
+PDF_CACHE_MB = float(os.getenv("PDF_CACHE_MB", "256"))
+PDF_CACHE_TTL_DAYS = float(os.getenv("PDF_CACHE_TTL_DAYS", "7"))
+# Intervalle de rafraîchissement de la progression dans l'application (secondes)
+PDF_POLL_S = float(os.getenv("PDF_POLL_S", "0.5"))
+# À incrémenter quand la mise en page du rapport change : les anciens fichiers ne sont plus servis
+PDF_VERSION = 1
+
+
+def transcript_hash(messages):
+    """Empreinte de l'échange avec l'assistant repris dans le rapport (questions et réponses)."""
+    return context_hash([(m["role"], m["content"]) for m in conversation_turns(messages)])
+
+
+def pdf_key(code, snapshot, messages):
+    """Clé du rapport : code du territoire, empreinte des données, empreinte de l'échange IA."""
+    safe_code = re.sub(r"[^\w.-]", "_", str(code))
+    return f"{safe_code}-{context_hash([PDF_VERSION, snapshot])}-{transcript_hash(messages)}"
+
+
+class PDFStore:
+    """Rapports terminés sur disque, un fichier par clé, bornés en octets et en âge.
+
+    Peu de fichiers, peu d'écritures : l'ordre LRU est celui des dates de
+    modification (rafraîchies à chaque lecture), relu à chaque écriture.
+    """
+
+    def __init__(self, root, max_bytes, ttl_s):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.root, f"{key}.pdf")
+
+    def fresh(self, key):
+        """Vrai si le rapport est sur disque et non expiré."""
+        try:
+            return time.time() - os.path.getmtime(self.path(key)) < self.ttl_s
+        except OSError:
+            return False
+
+    def get(self, key):
+        """Contenu du rapport, ou None s'il est absent ou expiré."""
+        path = self.path(key)
+        if not self.fresh(key):
+            return None
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+            os.utime(path)
+            return content
+        except OSError:
+            return None
+
+    def put(self, key, content):
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix=".rapport-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp, self.path(key))
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        files = []
+        for name in os.listdir(self.root):
+            if not name.endswith(".pdf"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.root, name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, name, st.st_size))
+        files.sort()
+        total = sum(size for _, _, size in files)
+        now = time.time()
+        for mtime, name, size in files[:-1]:
+            if total <= self.max_bytes and now - mtime < self.ttl_s:
+                break
+            try:
+                os.remove(os.path.join(self.root, name))
+                total -= size
+            except OSError:
+                pass
+
+    def metrics(self):
+        try:
+            sizes = [os.path.getsize(os.path.join(self.root, n)) for n in os.listdir(self.root) if n.endswith(".pdf")]
+        except OSError:
+            sizes = []
+        return {"files": len(sizes), "mb": round(sum(sizes) / 2**20, 2), "budget_mb": round(self.max_bytes / 2**20, 1)}
+
+
+class PDFJob:
+    """Génération d'un rapport : état, progression (0 à 1, libellé de l'étape) et erreur éventuelle."""
+
+    def __init__(self, key, code, cached=False):
+        self.key = key
+        self.code = code
+        self.cached = cached
+        self.progress = 1.0 if cached else 0.0
+        self.message = "Rapport disponible" if cached else "En attente d'un worker"
+        self.error = None
+        self.duration = None
+        self._done = threading.Event()
+        if cached:
+            self._done.set()
+
+    @property
+    def pending(self):
+        return not self._done.is_set()
+
+    def update(self, fraction, message):
+        self.progress = max(self.progress, min(float(fraction), 1.0))
+        self.message = message
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def _finish(self, error=None, duration=None):
+        self.error = error
+        self.duration = duration
+        if error is None:
+            self.update(1.0, "Rapport disponible")
+        self._done.set()
+
+
+class PDFJobs:
+    """Pool de génération des rapports, avec déduplication des demandes identiques.
+
+    `submit` renvoie immédiatement une tâche : terminée si le rapport est déjà sur
+    disque, la tâche en cours si la même clé est déjà demandée, sinon une nouvelle
+    tâche confiée au pool. Seules les tâches en cours sont gardées en mémoire.
+    """
+
+    def __init__(self, store, workers=2):
+        self.store = store
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pdf")
+        self._running = {}  # clé -> PDFJob en attente ou en cours
+        self._lock = threading.Lock()
+        self.stats = {"submitted": 0, "cache_hits": 0, "shared": 0, "done": 0, "errors": 0}
+
+    def submit(self, key, code, generate, kwargs):
+        """Rapport `key` (territoire `code`) produit par `generate(progress=job.update, **kwargs)`."""
+        with self._lock:
+            job = self._running.get(key)
+            if job is not None:
+                self.stats["shared"] += 1
+                return job
+            if self.store.fresh(key):
+                self.stats["cache_hits"] += 1
+                return PDFJob(key, code, cached=True)
+            job = PDFJob(key, code)
+            self._running[key] = job
+            self.stats["submitted"] += 1
+        self._pool.submit(self._run, job, generate, kwargs)
+        return job
+
+    def _run(self, job, generate, kwargs):
+        # Trace propre à la tâche (thread du pool) : exportée comme celles des reruns
+        trace = telemetry.start_trace("pdf")
+        t0 = time.perf_counter()
+        error = None
+        try:
+            job.update(0.02, "Démarrage de la génération")
+            with telemetry.span("rapport PDF", "pdf", key=job.key):
+                self.store.put(job.key, bytes(generate(progress=job.update, **kwargs)))
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            telemetry.record_error(f"Export PDF {job.key} : {error}")
+        finally:
+            telemetry.end_trace(trace)
+            with self._lock:
+                self._running.pop(job.key, None)
+                self.stats["errors" if error else "done"] += 1
+            job._finish(error, time.perf_counter() - t0)
+
+    def result(self, job):
+        """Contenu du rapport d'une tâche terminée (None s'il a expiré entre-temps)."""
+        return None if job.pending or job.error else self.store.get(job.key)
+
+    def metrics(self):
+        with self._lock:
+            return {**self.stats, "running": len(self._running), **self.store.metrics()}
+
+
+@telemetry.cache_resource(show_spinner=False)
+def get_pdf_jobs():
+    """Pool d'export PDF du processus, partagé par toutes les sessions."""
+    store = PDFStore(PDF_CACHE_DIR, max_bytes=int(PDF_CACHE_MB * 2**20), ttl_s=PDF_CACHE_TTL_DAYS * 86400)
+    return PDFJobs(store, workers=PDF_WORKERS)
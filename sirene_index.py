@@ -0,0 +1,205 @@
+"""Index local de correspondance entre territoires (codes COG) et unités légales SIRENE.
+
+Construit une fois à partir des fichiers stock SIRENE (data.gouv.fr) :
+    - StockUniteLegale_utf8.csv  : catégorie juridique et siège de chaque unité légale
+    - StockEtablissement_utf8.csv : commune d'implantation des établissements sièges
+et du fichier de population pynsee (SIREN des EPCI de chaque commune).
+
+Usage :
+    python sirene_index.py StockUniteLegale_utf8.csv StockEtablissement_utf8.csv
+
+Une fois l'index construit, le SIREN de la mairie, de l'EPCI, du conseil
+départemental ou régional d'un territoire s'obtient par une seule requête indexée.
+"""
+import argparse
+import os
+import re
+import sqlite3
+
+import pandas as pd
+from unidecode import unidecode
+
+from insee_data import DATA_DIR, load_pop_data_cached
+
+INDEX_PATH = os.getenv("SIRENE_INDEX", os.path.join(DATA_DIR, "sirene_index.sqlite"))
+
+# Catégories juridiques des collectivités (nomenclature INSEE niveau III)
+CATEGORIES = {
+    "7210": "commune",
+    "7220": "departement",
+    "7229": "departement",      # Collectivités territoriales à statut particulier (ex: Corse, Martinique)
+    "7230": "region",
+    "7343": "epci",             # Communauté urbaine
+    "7344": "epci",             # Métropole
+    "7346": "epci",             # Communauté de communes
+    "7348": "epci",             # Communauté d'agglomération
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS unites_legales (
+    siren         TEXT PRIMARY KEY,
+    denomination  TEXT,
+    categorie     TEXT,
+    niveau        TEXT,
+    etat          TEXT,
+    code_commune  TEXT
+);
+CREATE TABLE IF NOT EXISTS territoires (
+    kind   TEXT NOT NULL,
+    code   TEXT NOT NULL,
+    role   TEXT NOT NULL,
+    siren  TEXT NOT NULL,
+    PRIMARY KEY (kind, code, role)
+);
+CREATE INDEX IF NOT EXISTS idx_territoires_siren ON territoires (siren);
+"""
+
+CHUNK_SIZE = 500_000
+# Préfixe des dénominations de mairies (« COMMUNE DE BLOIS », « VILLE D'ORLEANS »)
+MAIRIE_PREFIX = re.compile(r"^(?:commune|ville|mairie)\s+(?:de|d|du|des)?\s*")
+# Collectivité à statut particulier : exerce les compétences du département qu'elle remplace
+PREFERRED_CATEGORIES = ("7229",)
+
+
+def _read_unites_legales(path):
+    """Unités légales actives des catégories de collectivités (lecture par blocs)."""
+    usecols = ["siren", "categorieJuridiqueUniteLegale", "denominationUniteLegale",
+               "nicSiegeUniteLegale", "etatAdministratifUniteLegale"]
+    frames = []
+    for chunk in pd.read_csv(path, usecols=usecols, dtype=str, chunksize=CHUNK_SIZE):
+        chunk = chunk[chunk["categorieJuridiqueUniteLegale"].isin(CATEGORIES.keys())
+                      & (chunk["etatAdministratifUniteLegale"] == "A")]
+        frames.append(chunk)
+    ul = pd.concat(frames, ignore_index=True)
+    ul["siret_siege"] = ul["siren"] + ul["nicSiegeUniteLegale"].fillna("").str.zfill(5)
+    return ul
+
+
+def _read_sieges(path, siret_sieges):
+    """Commune d'implantation des établissements sièges retenus."""
+    usecols = ["siret", "codeCommuneEtablissement", "etablissementSiege"]
+    frames = []
+    for chunk in pd.read_csv(path, usecols=usecols, dtype=str, chunksize=CHUNK_SIZE):
+        chunk = chunk[(chunk["etablissementSiege"] == "true") & chunk["siret"].isin(siret_sieges)]
+        frames.append(chunk[["siret", "codeCommuneEtablissement"]])
+    return pd.concat(frames, ignore_index=True)
+
+
+def _normalize(text):
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", unidecode(str(text)).lower()).split())
+
+
+def _resolve(candidates, role_label):
+    """Une unité légale par (kind, code, role), choisie de façon déterministe parmi les candidates.
+
+    Ordre de préférence : dénomination égale au libellé COG du territoire (mairies),
+    catégorie à statut particulier (PREFERRED_CATEGORIES), puis plus petit SIREN.
+    Les territoires à plusieurs candidates sont signalés.
+    """
+    if candidates.empty:
+        return []
+    candidates = candidates.assign(
+        name_match=[_normalize(MAIRIE_PREFIX.sub("", _normalize(d))) == _normalize(n) if isinstance(n, str) else False
+                    for d, n in zip(candidates["denomination"].fillna(""), candidates["label"])],
+        preferred=candidates["categorie"].isin(PREFERRED_CATEGORIES),
+    ).sort_values(["kind", "code", "name_match", "preferred", "siren"], ascending=[True, True, False, False, True])
+    keys = ["kind", "code", "role"]
+    conflicts = candidates[candidates.duplicated(keys, keep=False)]
+    if not conflicts.empty:
+        examples = conflicts.groupby(keys)["siren"].apply(list).head(5)
+        print(f"{conflicts.groupby(keys).ngroups} territoires à plusieurs unités « {role_label} » "
+              "(première retenue) : " + ", ".join(f"{k[1]} {v}" for k, v in examples.items()))
+    kept = candidates.drop_duplicates(keys, keep="first")
+    return list(zip(kept["kind"], kept["code"], kept["role"], kept["siren"]))
+
+
+def build_index(unites_legales_csv, etablissements_csv, path=INDEX_PATH):
+    """Construit l'index SQLite (remplace le précédent)."""
+    print("Lecture des unités légales...")
+    ul = _read_unites_legales(unites_legales_csv)
+    print(f"{len(ul)} collectivités actives. Lecture des établissements sièges...")
+    sieges = _read_sieges(etablissements_csv, set(ul["siret_siege"]))
+    ul = ul.merge(sieges, left_on="siret_siege", right_on="siret", how="left")
+    ul["niveau"] = ul["categorieJuridiqueUniteLegale"].map(CATEGORIES)
+
+    pop = load_pop_data_cached()
+    communes = pop[["code_insee", "nom_de_la_commune", "codes_siren_des_epci", "code_insee_du_departement",
+                    "code_insee_de_la_region"]].drop_duplicates("code_insee")
+    commune_parents = communes.set_index("code_insee")
+
+    rows = []
+    # Mairie : unité légale « commune » dont le siège est sur la commune (plusieurs pour une
+    # commune nouvelle dont les communes déléguées ont gardé leur SIREN)
+    mairies = ul[ul["niveau"] == "commune"].dropna(subset=["codeCommuneEtablissement"])
+    rows += _resolve(pd.DataFrame({
+        "kind": "communes", "code": mairies["codeCommuneEtablissement"], "role": "mairie",
+        "siren": mairies["siren"], "denomination": mairies["denominationUniteLegale"],
+        "categorie": mairies["categorieJuridiqueUniteLegale"],
+        "label": mairies["codeCommuneEtablissement"].map(commune_parents["nom_de_la_commune"]),
+    }), "mairie")
+    # EPCI : le code COG d'un EPCI est son SIREN ; chaque commune pointe vers son EPCI
+    rows += [("communes", c, "epci", s) for c, s in zip(communes["code_insee"], communes["codes_siren_des_epci"])
+             if isinstance(s, str) and s]
+    rows += [("intercommunalites", s, "epci", s) for s in communes["codes_siren_des_epci"].dropna().unique()]
+    # Conseils départementaux et régionaux : rattachés via la commune de leur siège
+    for niveau, kind, parent_col in (("departement", "departements", "code_insee_du_departement"),
+                                     ("region", "regions", "code_insee_de_la_region")):
+        units = ul[ul["niveau"] == niveau].dropna(subset=["codeCommuneEtablissement"])
+        units = units[units["codeCommuneEtablissement"].isin(commune_parents.index)]
+        rows += _resolve(pd.DataFrame({
+            "kind": kind, "code": commune_parents.loc[units["codeCommuneEtablissement"], parent_col].values,
+            "role": "collectivite", "siren": units["siren"].values,
+            "denomination": units["denominationUniteLegale"].values,
+            "categorie": units["categorieJuridiqueUniteLegale"].values, "label": None,
+        }), f"collectivite ({niveau})")
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    con = sqlite3.connect(tmp_path)
+    con.executescript(SCHEMA)
+    con.executemany(
+        "INSERT OR REPLACE INTO unites_legales VALUES (?, ?, ?, ?, ?, ?)",
+        zip(ul["siren"], ul["denominationUniteLegale"], ul["categorieJuridiqueUniteLegale"], ul["niveau"],
+            ul["etatAdministratifUniteLegale"], ul["codeCommuneEtablissement"].where(ul["codeCommuneEtablissement"].notna(), None)),
+    )
+    con.executemany("INSERT INTO territoires VALUES (?, ?, ?, ?)", rows)
+    con.commit()
+    con.close()
+    # Remplacement atomique : l'application ne lit jamais un index partiel
+    os.replace(tmp_path, path)
+    print(f"Index écrit dans {path} : {len(ul)} unités légales, {len(rows)} correspondances.")
+
+
+def get_legal_units(code, kind, path=INDEX_PATH):
+    """Unités légales rattachées à un territoire : [{'role', 'siren', 'denomination', 'categorie'}]."""
+    if not os.path.exists(path):
+        return []
+    if kind == "EPCI":
+        kind = "intercommunalites"
+    try:
+        con = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=5)
+        try:
+            rows = con.execute(
+                """SELECT t.role, t.siren, u.denomination, u.categorie
+                   FROM territoires t LEFT JOIN unites_legales u ON u.siren = t.siren
+                   WHERE t.kind = ? AND t.code = ?
+                   ORDER BY t.role DESC""",
+                (kind, str(code)),
+            ).fetchall()
+        finally:
+            con.close()
+    except sqlite3.Error as e:
+        print(f"get_legal_units error: {e}")
+        return []
+    return [{"role": r[0], "siren": r[1], "denomination": r[2], "categorie": r[3]} for r in rows]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Construit l'index territoires ↔ SIRENE.")
+    parser.add_argument("unites_legales_csv", help="StockUniteLegale_utf8.csv")
+    parser.add_argument("etablissements_csv", help="StockEtablissement_utf8.csv")
+    parser.add_argument("--output", default=INDEX_PATH)
+    args = parser.parse_args()
+    build_index(args.unites_legales_csv, args.etablissements_csv, args.output)
@@ -0,0 +1,391 @@
+"""Index spatial des contours communaux : point → commune, géocodage en masse.
+
+Les contours communaux d'ADMIN EXPRESS (IGN), simplifiés topologiquement (limites
+partagées entre voisines conservées), sont stockés une fois pour toutes en
+GeoParquet sous DATA_DIR ; un STRtree (shapely) les indexe. La recherche est vectorisée : des millions
+de points sont traités par blocs, sans boucle Python par point. Un point hors
+de tout contour (côte, imprécision) est rattaché au contour le plus proche
+dans une tolérance donnée.
+
+Usage :
+    python spatial_index.py build --source ADMIN-EXPRESS-COG/COMMUNE.shp   # contours nationaux (une fois)
+    python spatial_index.py build --level iris --source CONTOURS-IRIS.gpkg
+    python spatial_index.py geocode clients.csv out.csv --address adresse --postcode cp --city ville
+    python spatial_index.py geocode points.csv out.csv --lat latitude --lon longitude
+"""
+import argparse
+import io
+import os
+import re
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from insee_data import (
+    DATA_DIR, area_km2, fetch_department_contours, get_cube, get_hierarchy, get_http_session, get_iris_population,
+)
+import telemetry
+
+BOUNDARIES_DIR = os.getenv("BOUNDARIES_DIR", os.path.join(DATA_DIR, "boundaries"))
+BAN_URL = os.getenv("BAN_API_URL", "https://api-adresse.data.gouv.fr")
+
+# ~1 km en degrés : tolérance du rattachement au plus proche
+NEAREST_MAX_DISTANCE = 0.01
+CHUNK_SIZE = 1_000_000
+# Lignes envoyées par appel au géocodeur en masse de la BAN (limite du service : 50 Mo)
+BAN_BATCH_ROWS = 50_000
+
+
+def boundaries_path(level="communes"):
+    return os.path.join(BOUNDARIES_DIR, f"{level}.parquet")
+
+
+# Colonnes de la couche COMMUNE d'ADMIN EXPRESS selon les millésimes -> noms normalisés
+ADMIN_EXPRESS_COLUMNS = {
+    "INSEE_COM": "code", "code_insee": "code",
+    "NOM": "nom", "NOM_COM": "nom", "nom": "nom",
+    "INSEE_DEP": "dep", "code_insee_du_departement": "dep",
+}
+# Tolérance de la simplification topologique des communes (~20 m)
+BOUNDARY_SIMPLIFY = 0.0002
+
+
+def _admin_express_communes(source, departements=None, layer=None):
+    """Couche COMMUNE d'ADMIN EXPRESS, simplifiée comme une couverture (sans trou ni chevauchement créés)."""
+    gdf = gpd.read_file(source, layer=layer) if layer else gpd.read_file(source)
+    gdf = gdf.rename(columns={k: v for k, v in ADMIN_EXPRESS_COLUMNS.items() if k in gdf.columns})
+    missing = {"code", "nom"} - set(gdf.columns)
+    if missing:
+        raise SystemExit(f"Colonnes absentes du fichier ADMIN EXPRESS : {', '.join(sorted(missing))}")
+    if departements:
+        dep = gdf["dep"] if "dep" in gdf.columns else \
+            gdf["code"].str[:2].where(~gdf["code"].str.startswith("97"), gdf["code"].str[:3])
+        gdf = gdf[dep.isin(departements)]
+    gdf = gdf[["code", "nom", "geometry"]].to_crs(epsg=4326).reset_index(drop=True)
+    # Les communes forment une couverture : la simplifier d'un bloc garde chaque limite
+    # commune identique des deux côtés (une simplification commune par commune ouvre
+    # des trous et des chevauchements le long des limites)
+    with telemetry.span("coverage_simplify", "geometry", features=len(gdf)):
+        gdf["geometry"] = shapely.coverage_simplify(gdf.geometry.to_numpy(), BOUNDARY_SIMPLIFY)
+    return gdf
+
+
+def _geo_api_communes(departements=None):
+    """Contours geo.api par département (repli sans fichier IGN : simplifiés un à un, limites approchées)."""
+    if departements is None:
+        hierarchy = get_hierarchy()
+        if hierarchy is None:
+            raise SystemExit("Référentiel communal indisponible : précisez les départements.")
+        departements = [d for d in hierarchy.groups("departements")[0] if d]
+    frames = []
+    for i, dep in enumerate(departements, 1):
+        gdf = fetch_department_contours.__wrapped__(dep)
+        if gdf is None:
+            print(f"[{i}/{len(departements)}] {dep} : contours indisponibles")
+            continue
+        frames.append(gdf[["code", "nom", "geometry"]])
+        print(f"[{i}/{len(departements)}] {dep} : {len(gdf)} communes")
+    if not frames:
+        raise SystemExit("Aucun contour récupéré.")
+    print("Contours geo.api : limites communes approchées (trous et chevauchements) ; "
+          "préférer --source ADMIN EXPRESS pour l'index de production.")
+    return gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), crs="EPSG:4326")
+
+
+def build_boundaries(departements=None, path=None, source=None, layer=None):
+    """Rassemble les contours de toutes les communes dans un fichier GeoParquet.
+
+    `source` : couche COMMUNE d'ADMIN EXPRESS (IGN), non simplifiée. À défaut, les
+    contours geo.api sont utilisés : simplifiés chacun de leur côté, ils laissent
+    des trous et des chevauchements entre voisines, où un point peut être mal rattaché.
+    """
+    gdf = _admin_express_communes(source, departements, layer) if source else _geo_api_communes(departements)
+    gdf = gdf.drop_duplicates("code")
+    path = path or boundaries_path("communes")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    gdf.to_parquet(tmp)
+    os.replace(tmp, path)
+    print(f"{len(gdf)} contours écrits dans {path}")
+    return path
+
+
+# Colonnes du fichier IGN CONTOURS-IRIS selon les millésimes -> noms normalisés
+IRIS_COLUMNS = {
+    "CODE_IRIS": "code", "code_iris": "code",
+    "NOM_IRIS": "nom", "nom_iris": "nom",
+    "INSEE_COM": "commune", "code_insee": "commune",
+}
+# Tolérance de simplification des IRIS (~20 m) : formes plus petites que les communes
+IRIS_SIMPLIFY = 0.0002
+IRIS_ROW_GROUP = 2000
+
+
+def build_iris_boundaries(source, path=None):
+    """Convertit le fichier national CONTOURS-IRIS (IGN) en GeoParquet trié par commune.
+
+    Le tri et des groupes de lignes de taille modérée permettent de lire les IRIS
+    d'une seule commune sans charger le fichier (filtre poussé sur les statistiques
+    de chaque groupe).
+    """
+    gdf = gpd.read_file(source)
+    gdf = gdf.rename(columns={k: v for k, v in IRIS_COLUMNS.items() if k in gdf.columns})
+    missing = {"code", "nom", "commune"} - set(gdf.columns)
+    if missing:
+        raise SystemExit(f"Colonnes absentes du fichier IRIS : {', '.join(sorted(missing))}")
+    gdf = gdf[["code", "nom", "commune", "geometry"]].to_crs(epsg=4326)
+    gdf["geometry"] = gdf.geometry.simplify(IRIS_SIMPLIFY, preserve_topology=True)
+    gdf = gdf.sort_values(["commune", "code"]).reset_index(drop=True)
+    path = path or boundaries_path("iris")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    gdf.to_parquet(tmp, row_group_size=IRIS_ROW_GROUP)
+    os.replace(tmp, path)
+    print(f"{len(gdf)} IRIS ({gdf['commune'].nunique()} communes) écrits dans {path}")
+    return path
+
+
+@telemetry.cache_data(show_spinner=False)
+def get_iris_of_commune(commune_code):
+    """IRIS d'une commune (contours simplifiés, population, densité) ou None si non découpée / non disponible."""
+    path = boundaries_path("iris")
+    if not os.path.exists(path):
+        return None
+    try:
+        gdf = gpd.read_parquet(path, filters=[("commune", "==", str(commune_code))])
+    except Exception as e:
+        telemetry.record_error(f"get_iris_of_commune error: {e}")
+        return None
+    # Commune non découpée : un seul « IRIS » confondu avec la commune
+    if len(gdf) < 2:
+        return None
+    gdf = gdf.reset_index(drop=True)
+    gdf["area_km2"] = area_km2(gdf)
+    population = get_iris_population(tuple(gdf["code"]))
+    if population is not None:
+        gdf["population"] = gdf["code"].map(population)
+        gdf["densite"] = gdf["population"] / gdf["area_km2"]
+    return gdf
+
+
+class SpatialIndex:
+    """STRtree sur des polygones (codes et noms alignés sur les géométries)."""
+
+    def __init__(self, gdf):
+        gdf = gdf.to_crs(epsg=4326).reset_index(drop=True)
+        self.codes = gdf["code"].astype(str).to_numpy()
+        self.names = gdf["nom"].astype(str).to_numpy() if "nom" in gdf.columns else self.codes
+        self.geometries = gdf.geometry.to_numpy()
+        # Géométries préparées : les tests point-dans-polygone répétés sont beaucoup plus rapides
+        shapely.prepare(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+
+    @classmethod
+    def load(cls, level="communes", path=None):
+        """Index sur les contours stockés localement (None si le fichier n'existe pas)."""
+        path = path or boundaries_path(level)
+        if not os.path.exists(path):
+            return None
+        return cls(gpd.read_parquet(path))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def locate(self, lon, lat, nearest=True, max_distance=NEAREST_MAX_DISTANCE):
+        """Indice du polygone contenant chaque point (-1 si aucun), vectorisé par blocs."""
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        result = np.full(len(lon), -1, dtype=np.int64)
+        for start in range(0, len(lon), CHUNK_SIZE):
+            x, y = lon[start:start + CHUNK_SIZE], lat[start:start + CHUNK_SIZE]
+            valid = np.flatnonzero(~(np.isnan(x) | np.isnan(y)))
+            if valid.size == 0:
+                continue
+            points = shapely.points(x[valid], y[valid])
+            point_idx, geom_idx = self.tree.query(points, predicate="within")
+            found = np.full(len(valid), -1, dtype=np.int64)
+            # Un point sur une limite commune peut appartenir à deux contours : on garde le premier
+            order = np.argsort(point_idx, kind="stable")
+            first = np.unique(point_idx[order], return_index=True)[1]
+            found[point_idx[order][first]] = geom_idx[order][first]
+            if nearest:
+                missing = np.flatnonzero(found < 0)
+                if missing.size:
+                    near_point, near_geom = self.tree.query_nearest(
+                        points[missing], max_distance=max_distance, all_matches=False)
+                    found[missing[near_point]] = near_geom
+            result[start + valid] = found
+        return result
+
+    def locate_codes(self, lon, lat, **kwargs):
+        """Codes des territoires contenant chaque point (None si aucun)."""
+        idx = self.locate(lon, lat, **kwargs)
+        codes = self.codes[np.maximum(idx, 0)].astype(object)
+        codes[idx < 0] = None
+        return codes
+
+    def lookup(self, lon, lat):
+        """Territoire contenant un point : {'code', 'nom'} ou None."""
+        idx = self.locate([lon], [lat])[0]
+        if idx < 0:
+            return None
+        return {"code": self.codes[idx], "nom": self.names[idx]}
+
+
+@telemetry.cache_resource(show_spinner=False)
+def get_spatial_index(level="communes"):
+    """Index spatial partagé entre les sessions (None tant que les contours n'ont pas été construits)."""
+    return SpatialIndex.load(level)
+
+
+# --- GÉOCODAGE (Base Adresse Nationale) ---
+
+def geocode_address(query):
+    """Géocode une adresse libre : (lon, lat, libellé, code commune) ou None."""
+    try:
+        r = get_http_session().get(f"{BAN_URL}/search/", params={"q": query, "limit": 1}, timeout=10)
+        if r.status_code == 200:
+            features = r.json().get("features", [])
+            if features:
+                lon, lat = features[0]["geometry"]["coordinates"]
+                props = features[0].get("properties", {})
+                return lon, lat, props.get("label", query), props.get("citycode")
+    except Exception as e:
+        telemetry.record_error(f"geocode_address error: {e}")
+    return None
+
+
+def locate_place(query):
+    """Localise une adresse ou des coordonnées « latitude, longitude » et retourne la commune.
+
+    Retourne {'libelle', 'lon', 'lat', 'code', 'nom', 'iris', 'nom_iris'} ou None.
+    """
+    match = re.fullmatch(r"\s*(-?\d+(?:\.\d+)?)\s*[,; ]\s*(-?\d+(?:\.\d+)?)\s*", query)
+    if match:
+        lat, lon = float(match.group(1)), float(match.group(2))
+        label, citycode = f"{lat:.5f}, {lon:.5f}", None
+    else:
+        geocoded = geocode_address(query)
+        if geocoded is None:
+            return None
+        lon, lat, label, citycode = geocoded
+    index = get_spatial_index("communes")
+    commune = index.lookup(lon, lat) if index is not None else None
+    if commune is None and citycode:
+        # Repli sans contours locaux : code commune renvoyé par la BAN
+        commune = {"code": citycode, "nom": ""}
+    if commune is None:
+        return None
+    iris_index = get_spatial_index("iris")
+    iris = iris_index.lookup(lon, lat) if iris_index is not None else None
+    return {"libelle": label, "lon": lon, "lat": lat, **commune,
+            "iris": iris["code"] if iris else None, "nom_iris": iris["nom"] if iris else None}
+
+
+def geocode_csv_ban(df, address_cols, postcode_col=None, city_col=None):
+    """Géocodage en masse via le service CSV de la BAN ; ajoute latitude / longitude / score."""
+    out = []
+    for start in range(0, len(df), BAN_BATCH_ROWS):
+        part = df.iloc[start:start + BAN_BATCH_ROWS]
+        payload = part[address_cols + [c for c in (postcode_col, city_col) if c]].copy()
+        payload.insert(0, "_ligne", np.arange(start, start + len(part)))
+        data = [("columns", c) for c in address_cols]
+        if postcode_col:
+            data.append(("postcode", postcode_col))
+        if city_col:
+            data.append(("columns", city_col))
+        r = get_http_session().post(f"{BAN_URL}/search/csv/", data=data,
+                          files={"data": ("adresses.csv", payload.to_csv(index=False).encode("utf-8"))},
+                          timeout=600)
+        r.raise_for_status()
+        result = pd.read_csv(io.StringIO(r.content.decode("utf-8")), dtype=str)
+        out.append(result[["_ligne", "latitude", "longitude", "result_score", "result_label"]])
+        print(f"BAN : {start + len(part)}/{len(df)} adresses géocodées")
+    geo = pd.concat(out, ignore_index=True)
+    geo["_ligne"] = geo["_ligne"].astype(int)
+    geo = geo.set_index("_ligne").reindex(np.arange(len(df)))
+    df = df.reset_index(drop=True)
+    df["latitude"] = pd.to_numeric(geo["latitude"].values, errors="coerce")
+    df["longitude"] = pd.to_numeric(geo["longitude"].values, errors="coerce")
+    df["geocodage_score"] = pd.to_numeric(geo["result_score"].values, errors="coerce")
+    df["geocodage_libelle"] = geo["result_label"].values
+    return df
+
+
+def join_indicators(df, code_col="code_commune", indicators=None):
+    """Ajoute à chaque ligne les indicateurs communaux du cube et les rattachements administratifs."""
+    hierarchy = get_hierarchy()
+    codes = df[code_col].tolist()
+    if hierarchy is not None:
+        position = {c: i for i, c in enumerate(hierarchy.codes)}
+        idx = np.array([position.get(c, -1) if c else -1 for c in codes], dtype=np.int64)
+        for level, column in (("intercommunalites", "code_epci"), ("departements", "code_departement"),
+                              ("regions", "code_region")):
+            group_codes, group_ids = hierarchy.groups(level)
+            parent = group_ids[np.maximum(idx, 0)]
+            values = group_codes[np.maximum(parent, 0)].astype(object)
+            values[(idx < 0) | (parent < 0)] = None
+            df[column] = values
+    cube = get_cube()
+    if cube is not None:
+        for name in indicators or cube.indicators:
+            df[name] = cube.slice(name, [c or "" for c in codes])
+    return df
+
+
+def geocode_file(input_csv, output_csv, lat=None, lon=None, address=None, postcode=None, city=None,
+                 sep=None, index=None):
+    """Rattache chaque ligne d'un fichier client à sa commune puis y joint les indicateurs."""
+    t0 = time.perf_counter()
+    df = pd.read_csv(input_csv, sep=sep, engine="python" if sep is None else "c", dtype=str)
+    if lat and lon:
+        df["latitude"] = pd.to_numeric(df[lat].str.replace(",", "."), errors="coerce")
+        df["longitude"] = pd.to_numeric(df[lon].str.replace(",", "."), errors="coerce")
+    elif address:
+        df = geocode_csv_ban(df, address.split(","), postcode, city)
+    else:
+        raise SystemExit("Indiquer --lat/--lon ou --address.")
+    index = index or SpatialIndex.load("communes")
+    if index is None:
+        raise SystemExit("Contours absents : lancer d'abord 'python spatial_index.py build'.")
+    t1 = time.perf_counter()
+    df["code_commune"] = index.locate_codes(df["longitude"].to_numpy(), df["latitude"].to_numpy())
+    t2 = time.perf_counter()
+    df = join_indicators(df)
+    df.to_csv(output_csv, index=False)
+    located = df["code_commune"].notna().sum()
+    print(f"{located}/{len(df)} lignes rattachées à une commune "
+          f"(recherche spatiale : {t2 - t1:.2f} s, total : {time.perf_counter() - t0:.1f} s) -> {output_csv}")
+    return df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index spatial des communes et géocodage en masse.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="Construit le fichier local des contours communaux")
+    build.add_argument("--departements", nargs="*")
+    build.add_argument("--level", default="communes", choices=["communes", "iris"])
+    build.add_argument("--source", help="Fichier IGN : couche COMMUNE d'ADMIN EXPRESS, ou CONTOURS-IRIS (niveau iris)")
+    build.add_argument("--layer", help="Couche du fichier source (GeoPackage à plusieurs couches)")
+    geo = sub.add_parser("geocode", help="Rattache un fichier CSV aux communes et joint les indicateurs")
+    geo.add_argument("input_csv")
+    geo.add_argument("output_csv")
+    geo.add_argument("--lat", help="Colonne latitude")
+    geo.add_argument("--lon", help="Colonne longitude")
+    geo.add_argument("--address", help="Colonne(s) d'adresse, séparées par des virgules")
+    geo.add_argument("--postcode", help="Colonne code postal")
+    geo.add_argument("--city", help="Colonne commune")
+    geo.add_argument("--sep", help="Séparateur (détecté par défaut)")
+    args = parser.parse_args()
+    if args.command == "build" and args.level == "iris":
+        if not args.source:
+            parser.error("--source est requis pour le niveau iris")
+        build_iris_boundaries(args.source)
+    elif args.command == "build":
+        build_boundaries(args.departements, source=args.source, layer=args.layer)
+    else:
+        geocode_file(args.input_csv, args.output_csv, args.lat, args.lon, args.address, args.postcode,
+                     args.city, args.sep)
@@ -0,0 +1,221 @@
+"""Synthèses territoriales IA précalculées par lots.
+
+Les synthèses de toutes les communes d'un territoire parent sont générées hors
+ligne puis stockées dans une table SQLite indexée ; l'application et le PDF les
+lisent sans appel au modèle. Chaque résultat est enregistré dès sa réception :
+un traitement interrompu reprend là où il s'était arrêté.
+
+Usage :
+    python syntheses.py 41 --kind departements --workers 8 --llm-concurrency 4
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import assistant
+from assistant import build_ai_context, build_gemini_prompt
+from insee_data import DATA_DIR, fetch_epci_communes, get_communes_of_territory, get_territory_indicators
+from llm_queue import LLMQueue
+import telemetry
+
+DB_PATH = os.getenv("SYNTHESES_DB", os.path.join(DATA_DIR, "syntheses.sqlite"))
+
+# À incrémenter quand la consigne change : les synthèses existantes sont alors régénérées
+PROMPT_VERSION = 1
+SYNTHESIS_QUESTION = (
+    "Rédige une synthèse territoriale de 5 à 7 phrases, sans titre ni liste à puces, destinée à un "
+    "rapport : population et densité, structure par âge, niveau de vie, inégalités et pauvreté."
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS syntheses (
+    code           TEXT NOT NULL,
+    kind           TEXT NOT NULL,
+    parent_code    TEXT,
+    nom            TEXT,
+    snapshot       TEXT,
+    snapshot_hash  TEXT,
+    prompt_version INTEGER,
+    synthesis      TEXT,
+    status         TEXT NOT NULL,
+    error          TEXT,
+    duration_s     REAL,
+    updated_at     TEXT,
+    PRIMARY KEY (code, kind)
+);
+CREATE INDEX IF NOT EXISTS idx_syntheses_parent ON syntheses (parent_code, status);
+"""
+
+
+def connect(path=DB_PATH):
+    """Ouvre (et initialise si besoin) la base des synthèses."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    con = sqlite3.connect(path, timeout=30)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.executescript(SCHEMA)
+    return con
+
+
+def get_synthesis(code, kind="communes", path=DB_PATH):
+    """Retourne la synthèse précalculée d'un territoire ({'texte', 'date'}) ou None."""
+    if not os.path.exists(path):
+        return None
+    try:
+        con = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=5)
+        try:
+            row = con.execute(
+                "SELECT synthesis, updated_at FROM syntheses WHERE code = ? AND kind = ? AND status = 'done'",
+                (str(code), kind),
+            ).fetchone()
+        finally:
+            con.close()
+    except sqlite3.Error as e:
+        print(f"get_synthesis error: {e}")
+        return None
+    return {"texte": row[0], "date": row[1]} if row else None
+
+
+def _db_mtime(path):
+    """Dernière écriture de la base, fichier WAL compris (les écritures y restent jusqu'au checkpoint)."""
+    return max((os.path.getmtime(p) for p in (path, f"{path}-wal") if os.path.exists(p)), default=None)
+
+
+@telemetry.cache_resource(show_spinner=False, max_entries=1)
+def _synthesis_versions(path, mtime):
+    """(code, kind) -> (version de consigne, date) des synthèses terminées, relu quand la base change."""
+    try:
+        con = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=5)
+        try:
+            rows = con.execute(
+                "SELECT code, kind, prompt_version, updated_at FROM syntheses WHERE status = 'done'").fetchall()
+        finally:
+            con.close()
+    except sqlite3.Error as e:
+        print(f"synthesis_version error: {e}")
+        return {}
+    return {(code, kind): [version, date] for code, kind, version, date in rows}
+
+
+def synthesis_version(code, kind="communes", path=DB_PATH):
+    """Version de la synthèse d'un territoire ([version de consigne, date]) sans lire son texte ; None si absente."""
+    mtime = _db_mtime(path)
+    if mtime is None:
+        return None
+    return _synthesis_versions(path, mtime).get((str(code), kind))
+
+
+def _snapshot_hash(snapshot):
+    payload = json.dumps(snapshot, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def list_child_communes(parent_code, parent_kind):
+    """Communes (code, nom) d'un département ou d'un EPCI."""
+    if parent_kind in ("EPCI", "intercommunalites"):
+        return [(c["code"], c["nom"]) for c in fetch_epci_communes(parent_code) if c.get("code")]
+    gdf = get_communes_of_territory(parent_code, parent_kind)
+    if gdf is None:
+        return []
+    return sorted(zip(gdf["code"], gdf["nom"]))
+
+
+def build_snapshot(code):
+    """Instantané des données d'une commune tel qu'envoyé au modèle."""
+    return build_ai_context(code, "communes", get_territory_indicators(code, "communes"))
+
+
+def _load_state(con, parent_code):
+    rows = con.execute(
+        "SELECT code, status, snapshot, prompt_version FROM syntheses WHERE parent_code = ? AND kind = 'communes'",
+        (parent_code,),
+    ).fetchall()
+    return {code: (status, snapshot, version) for code, status, snapshot, version in rows}
+
+
+def _save(con, code, parent_code, nom, snapshot, status, synthesis=None, error=None, duration=None):
+    con.execute(
+        """INSERT INTO syntheses (code, kind, parent_code, nom, snapshot, snapshot_hash, prompt_version,
+                                  synthesis, status, error, duration_s, updated_at)
+           VALUES (?, 'communes', ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+           ON CONFLICT (code, kind) DO UPDATE SET
+               parent_code = excluded.parent_code, nom = excluded.nom, snapshot = excluded.snapshot,
+               snapshot_hash = excluded.snapshot_hash, prompt_version = excluded.prompt_version,
+               synthesis = excluded.synthesis, status = excluded.status, error = excluded.error,
+               duration_s = excluded.duration_s, updated_at = excluded.updated_at""",
+        (code, parent_code, nom, json.dumps(snapshot, ensure_ascii=False, default=str),
+         _snapshot_hash(snapshot), PROMPT_VERSION, synthesis, status, error, duration,
+         datetime.datetime.now().isoformat(timespec="seconds")),
+    )
+    con.commit()
+
+
+def run_batch(parent_code, parent_kind="departements", workers=8, llm_concurrency=4,
+              limit=None, refresh=False, path=DB_PATH):
+    """Génère les synthèses manquantes pour toutes les communes d'un territoire parent."""
+    if not assistant.model_configured():
+        raise SystemExit("Aucun modèle configuré (GEMINI_API_KEY ou LLM_FAKE=1).")
+
+    con = connect(path)
+    state = _load_state(con, parent_code)
+    communes = list_child_communes(parent_code, parent_kind)
+    todo = [(code, nom) for code, nom in communes
+            if refresh or state.get(code, (None, None, None))[0] != "done"
+            or state[code][2] != PROMPT_VERSION]
+    if limit:
+        todo = todo[:limit]
+    print(f"{len(communes)} communes, {len(communes) - len(todo)} déjà traitées, {len(todo)} à générer.")
+
+    # File dédiée au lot : la concurrence vers le modèle est bornée indépendamment du nombre de workers
+    llm_queue = LLMQueue(concurrency=llm_concurrency, max_pending=workers, max_pending_per_user=workers)
+
+    def _process(code, nom):
+        """Instantané (réutilisé s'il a déjà été enregistré) puis génération ; l'erreur éventuelle est renvoyée."""
+        t0 = time.perf_counter()
+        previous = state.get(code)
+        snapshot = {}
+        try:
+            if previous and previous[1] and not refresh:
+                snapshot = json.loads(previous[1])
+            if not snapshot:
+                snapshot = build_snapshot(code)
+            prompt = build_gemini_prompt(SYNTHESIS_QUESTION, snapshot, nom)
+            response = llm_queue.call("batch", assistant.get_model().generate_content, prompt)
+            return snapshot, response.text.strip(), None, time.perf_counter() - t0
+        except Exception as e:
+            return snapshot, None, e, time.perf_counter() - t0
+
+    done = failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_process, code, nom): (code, nom) for code, nom in todo}
+        for i, future in enumerate(as_completed(futures), 1):
+            code, nom = futures[future]
+            snapshot, text, error, duration = future.result()
+            # Point de reprise : chaque résultat est enregistré immédiatement
+            if error is None:
+                _save(con, code, parent_code, nom, snapshot, "done", synthesis=text, duration=duration)
+                done += 1
+                print(f"[{i}/{len(todo)}] {code} {nom} : ok ({duration:.1f} s)")
+            else:
+                _save(con, code, parent_code, nom, snapshot, "error", error=str(error), duration=duration)
+                failed += 1
+                print(f"[{i}/{len(todo)}] {code} {nom} : échec ({error})")
+    con.close()
+    print(f"Terminé : {done} synthèses générées, {failed} échecs. File LLM : {llm_queue.metrics()}")
+    return done, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Génère les synthèses IA des communes d'un territoire parent.")
+    parser.add_argument("parent_code", help="Code du département ou SIREN de l'EPCI")
+    parser.add_argument("--kind", default="departements", choices=["departements", "intercommunalites"])
+    parser.add_argument("--workers", type=int, default=8, help="Nombre de communes traitées en parallèle")
+    parser.add_argument("--llm-concurrency", type=int, default=4, help="Appels simultanés au modèle")
+    parser.add_argument("--limit", type=int, help="Nombre maximal de communes à traiter")
+    parser.add_argument("--refresh", action="store_true", help="Régénère tout, données comprises")
+    args = parser.parse_args()
+    run_batch(args.parent_code, args.kind, args.workers, args.llm_concurrency, args.limit, args.refresh)
@@ -0,0 +1,520 @@
+"""Instrumentation des chemins chauds : spans horodatés regroupés par rerun Streamlit.
+
+Un span couvre une étape (requête HTTP, appel pynsee, opération géométrique,
+sérialisation folium, étape du PDF, appel Gemini) et porte ses attributs :
+hôte et statut HTTP, taille de la réponse, cache hit / miss, nombre d'entités...
+Les spans d'un rerun (ou du rerun partiel d'une section, voir `fragment`) forment
+une trace, affichée en cascade dans le panneau d'administration de l'application
+et exportée selon la configuration :
+    - TELEMETRY_LOG : fichier JSON lines, une trace par ligne au format OTLP/JSON
+      (lisible par le récepteur « otlpjsonfile » du collecteur OpenTelemetry) ;
+    - TELEMETRY_OTEL=1 : SDK OpenTelemetry, exporteur OTLP configuré par les
+      variables OTEL_EXPORTER_OTLP_* (paquets opentelemetry-sdk et
+      opentelemetry-exporter-otlp) ;
+    - TELEMETRY_PROMETHEUS_PORT : histogrammes Prometheus des durées et tailles
+      par catégorie et étape (paquet prometheus_client), servis sur ce port.
+
+Hors trace (traitements hors ligne, threads de fond), un span ne coûte que
+deux lectures de contextvar et n'est pas conservé (il alimente seulement
+Prometheus s'il est activé).
+"""
+import contextvars
+import functools
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+TELEMETRY_LOG = os.getenv("TELEMETRY_LOG")
+TELEMETRY_OTEL = os.getenv("TELEMETRY_OTEL") == "1"
+PROMETHEUS_PORT = os.getenv("TELEMETRY_PROMETHEUS_PORT")
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "dossier-insee")
+# Panneau de performance de l'application : affiché à tous si TELEMETRY_PANEL=1, sinon
+# seulement avec ?admin=<jeton> quand TELEMETRY_PANEL_TOKEN (variable ou secret) est défini
+ADMIN_PANEL = os.getenv("TELEMETRY_PANEL") == "1"
+# Borne par trace : un rerun anormal (boucle de requêtes) ne fait pas grossir la mémoire
+MAX_SPANS = 5000
+
+# Catégories de span -> couleur du panneau
+CATEGORIES = {
+    "app": "#17becf", "cache": "#9e9e9e", "http": "#1f77b4", "pynsee": "#ff7f0e",
+    "geometry": "#2ca02c", "render": "#9467bd", "pdf": "#8c564b", "llm": "#e377c2",
+}
+
+_trace = contextvars.ContextVar("telemetry_trace", default=None)
+_span = contextvars.ContextVar("telemetry_span", default=None)
+
+
+def _admin_token():
+    token = os.getenv("TELEMETRY_PANEL_TOKEN")
+    if token:
+        return token
+    try:
+        return st.secrets.get("TELEMETRY_PANEL_TOKEN")
+    except Exception:
+        return None
+
+
+def admin_panel_allowed(query_token=None):
+    """Vrai si le panneau de performance (internes de l'application) peut être affiché.
+
+    Sans TELEMETRY_PANEL=1, le paramètre d'URL doit reproduire le jeton configuré ;
+    sans jeton configuré, le panneau n'est jamais ouvert par l'URL.
+    """
+    if ADMIN_PANEL:
+        return True
+    token = _admin_token()
+    return bool(token and query_token) and hmac.compare_digest(str(query_token).encode(), str(token).encode())
+
+
+class Span:
+    """Étape mesurée : nom, catégorie, bornes (perf_counter), attributs, erreur éventuelle."""
+
+    __slots__ = ("name", "category", "span_id", "parent_id", "start", "end", "attributes", "error")
+
+    def __init__(self, name, category, parent_id=None, attributes=None):
+        self.name = name
+        self.category = category
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.start = time.perf_counter()
+        self.end = None
+        self.attributes = attributes or {}
+        self.error = None
+
+    @property
+    def duration(self):
+        return (self.end or time.perf_counter()) - self.start
+
+
+class Trace:
+    """Spans d'un rerun (ou d'un traitement), dans l'ordre de fin."""
+
+    def __init__(self, name):
+        self.name = name
+        self.trace_id = secrets.token_hex(16)
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        self.end = None
+        self.spans = []
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            if len(self.spans) < MAX_SPANS:
+                self.spans.append(span)
+            else:
+                self.dropped += 1
+
+    @property
+    def duration(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    def waterfall(self):
+        """Lignes de la cascade (ordre de début) : profondeur, décalage et durée en ms, attributs."""
+        spans = sorted(self.spans, key=lambda s: s.start)
+        depth = {}
+        rows = []
+        for s in spans:
+            depth[s.span_id] = depth.get(s.parent_id, -1) + 1
+            rows.append({
+                "étape": "  " * depth[s.span_id] + s.name,
+                "catégorie": s.category,
+                "début_ms": round((s.start - self.start) * 1000, 1),
+                "fin_ms": round(((s.end or s.start) - self.start) * 1000, 1),
+                "durée_ms": round(s.duration * 1000, 1),
+                "cache": s.attributes.get("cache", ""),
+                "octets": s.attributes.get("bytes"),
+                "erreur": s.error or "",
+                "attributs": ", ".join(f"{k}={v}" for k, v in s.attributes.items() if k not in ("cache", "bytes")),
+            })
+        return rows
+
+    def summary(self):
+        """Par catégorie : nombre de spans, temps cumulé (s), octets reçus et hits de cache."""
+        out = {}
+        for s in self.spans:
+            entry = out.setdefault(s.category, {"spans": 0, "secondes": 0.0, "octets": 0, "hits": 0, "misses": 0})
+            entry["spans"] += 1
+            entry["secondes"] += s.duration
+            entry["octets"] += s.attributes.get("bytes") or 0
+            if s.attributes.get("cache") == "hit":
+                entry["hits"] += 1
+            elif s.attributes.get("cache") == "miss":
+                entry["misses"] += 1
+        return out
+
+
+def start_trace(name="rerun"):
+    """Ouvre une trace pour le contexte courant (le thread du rerun) ; les spans suivants s'y rattachent."""
+    trace = Trace(name)
+    _trace.set(trace)
+    _span.set(None)
+    return trace
+
+
+def current_trace():
+    return _trace.get()
+
+
+def end_trace(trace):
+    """Clôt la trace et l'exporte (fichier OTLP/JSON, SDK OpenTelemetry)."""
+    if trace is None or trace.end is not None:
+        return
+    trace.end = time.perf_counter()
+    if _trace.get() is trace:
+        _trace.set(None)
+    if TELEMETRY_LOG:
+        _export_jsonl(trace)
+    if TELEMETRY_OTEL:
+        _export_otel(trace)
+
+
+@contextmanager
+def span(name, category, **attributes):
+    """Mesure le bloc ; une exception est notée sur le span puis propagée."""
+    parent = _span.get()
+    s = Span(name, category, parent.span_id if parent is not None else None, attributes)
+    token = _span.set(s)
+    try:
+        yield s
+    except Exception as e:
+        s.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        s.end = time.perf_counter()
+        try:
+            _span.reset(token)
+        except ValueError:
+            # Générateur repris dans un autre contexte (réponse en streaming)
+            _span.set(parent)
+        _finish(s)
+
+
+def annotate(**attributes):
+    """Ajoute des attributs au span courant (sans effet hors span)."""
+    s = _span.get()
+    if s is not None:
+        s.attributes.update(attributes)
+
+
+def record_error(message):
+    """Journalise une erreur récupérée (print) et la note sur le span courant."""
+    print(message)
+    s = _span.get()
+    if s is not None:
+        s.error = message
+
+
+def traced(category, name=None):
+    """Décorateur : un span par appel de la fonction."""
+    def decorate(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(label, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def _traced_cache(st_decorator, func, kwargs, spans_on_hit=True):
+    if not spans_on_hit:
+        # Ressource partagée : seule la construction (rare, coûteuse) est mesurée
+        @functools.wraps(func)
+        def build(*args, **kw):
+            with span(func.__name__, "cache", cache="miss"):
+                return func(*args, **kw)
+        return st_decorator(**kwargs)(build)
+
+    @functools.wraps(func)
+    def compute(*args, **kw):
+        # Exécuté seulement quand le cache n'a pas la valeur
+        annotate(cache="miss")
+        return func(*args, **kw)
+
+    cached = st_decorator(**kwargs)(compute)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kw):
+        with span(func.__name__, "cache", cache="hit"):
+            return cached(*args, **kw)
+
+    wrapper.clear = cached.clear
+    return wrapper
+
+
+def cache_data(func=None, **kwargs):
+    """st.cache_data avec un span par appel, marqué cache=hit ou cache=miss.
+
+    S'emploie comme st.cache_data (avec ou sans arguments) ; `__wrapped__`
+    donne la fonction d'origine, hors cache.
+    """
+    if func is None:
+        return lambda f: _traced_cache(st.cache_data, f, kwargs)
+    return _traced_cache(st.cache_data, func, kwargs)
+
+
+def cache_resource(func=None, **kwargs):
+    """st.cache_resource dont la construction est mesurée (les accès, quasi gratuits, ne créent pas de span)."""
+    if func is None:
+        return lambda f: _traced_cache(st.cache_resource, f, kwargs, spans_on_hit=False)
+    return _traced_cache(st.cache_resource, func, kwargs, spans_on_hit=False)
+
+
+def fragment(func=None, **kwargs):
+    """st.fragment : une interaction dans la section ne réexécute qu'elle, pas toute la page.
+
+    Pendant un rerun complet, la section s'inscrit dans la trace du rerun ; un rerun
+    partiel ouvre sa propre trace (« fragment:<nom> »), exportée comme les autres et
+    conservée par session (la dernière de chaque section, voir `fragment_traces`).
+    S'emploie comme st.fragment, avec ou sans arguments (run_every...).
+    """
+    if func is None:
+        return lambda f: fragment(f, **kwargs)
+
+    @st.fragment(**kwargs)
+    @functools.wraps(func)
+    def section(*args, **kwargs):
+        ctx = get_script_run_ctx()
+        if ctx is None or not ctx.fragment_ids_this_run:
+            return func(*args, **kwargs)
+        trace = start_trace(f"fragment:{func.__name__}")
+        try:
+            return func(*args, **kwargs)
+        finally:
+            end_trace(trace)
+            st.session_state.setdefault("_fragment_traces", {})[func.__name__] = trace
+    return section
+
+
+def fragment_traces():
+    """Dernière trace de rerun partiel de chaque section de la session (nom -> Trace)."""
+    return st.session_state.get("_fragment_traces", {})
+
+
+# --- Instrumentation automatique (requests, pynsee) ---------------------------
+
+_instrumented = False
+_instrument_lock = threading.Lock()
+
+
+def instrument():
+    """Enveloppe requests (toutes les requêtes HTTP, par hôte) ; idempotent.
+
+    pynsee, importé à la demande, est enveloppé par `instrument_pynsee` au premier usage.
+    """
+    global _instrumented
+    with _instrument_lock:
+        if _instrumented:
+            return
+        _instrumented = True
+        _instrument_requests()
+
+
+_pynsee_instrumented = False
+
+
+def instrument_pynsee():
+    """Enveloppe pynsee.get_local_data / get_population ; idempotent."""
+    global _pynsee_instrumented
+    if _pynsee_instrumented:
+        return
+    with _instrument_lock:
+        if not _pynsee_instrumented:
+            _instrument_pynsee()
+            _pynsee_instrumented = True
+
+
+def _instrument_requests():
+    import requests
+
+    original = requests.sessions.Session.request
+
+    @functools.wraps(original)
+    def request(session, method, url, *args, **kwargs):
+        host = urlsplit(str(url)).netloc
+        with span(f"{str(method).upper()} {host}", "http", host=host, path=urlsplit(str(url)).path) as s:
+            response = original(session, method, url, *args, **kwargs)
+            size = response.headers.get("Content-Length") if kwargs.get("stream") else len(response.content)
+            s.attributes.update(status=response.status_code, bytes=int(size or 0))
+            return response
+
+    requests.sessions.Session.request = request
+
+
+def _instrument_pynsee():
+    try:
+        import pynsee
+    except ImportError:
+        return
+
+    def wrap(name, original):
+        @functools.wraps(original)
+        def call(*args, **kwargs):
+            attributes = {k: kwargs[k] for k in ("dataset_version", "variables", "nivgeo") if k in kwargs}
+            if kwargs.get("geocodes") is not None:
+                attributes["geocodes"] = len(kwargs["geocodes"])
+            with span(f"pynsee.{name}", "pynsee", **attributes) as s:
+                result = original(*args, **kwargs)
+                if result is not None and hasattr(result, "__len__"):
+                    s.attributes["rows"] = len(result)
+                return result
+        return call
+
+    for name in ("get_local_data", "get_population"):
+        if hasattr(pynsee, name):
+            setattr(pynsee, name, wrap(name, getattr(pynsee, name)))
+
+
+# --- Exports ------------------------------------------------------------------
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def _prometheus():
+    """Métriques Prometheus (créées et servies au premier span) ; False si indisponibles."""
+    global _metrics
+    if _metrics is not None:
+        return _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            try:
+                import prometheus_client as prom
+
+                _metrics = {
+                    "duration": prom.Histogram("insee_span_duration_seconds", "Durée des étapes instrumentées",
+                                               ["category", "name"]),
+                    "bytes": prom.Counter("insee_span_bytes", "Octets reçus par étape", ["category", "name"]),
+                    "cache": prom.Counter("insee_cache_lookups", "Appels des fonctions en cache", ["name", "result"]),
+                    "errors": prom.Counter("insee_span_errors", "Étapes en erreur", ["category", "name"]),
+                }
+                prom.start_http_server(int(PROMETHEUS_PORT))
+            except (ImportError, OSError, ValueError) as e:
+                print(f"Prometheus indisponible : {e}")
+                _metrics = False
+    return _metrics
+
+
+def _finish(s):
+    trace = _trace.get()
+    if trace is not None:
+        trace.add(s)
+    if PROMETHEUS_PORT:
+        metrics = _prometheus()
+        if metrics:
+            metrics["duration"].labels(s.category, s.name).observe(s.duration)
+            if s.attributes.get("bytes"):
+                metrics["bytes"].labels(s.category, s.name).inc(s.attributes["bytes"])
+            if "cache" in s.attributes:
+                metrics["cache"].labels(s.name, s.attributes["cache"]).inc()
+            if s.error:
+                metrics["errors"].labels(s.category, s.name).inc()
+
+
+def _nanos(trace, t):
+    return int((trace.wall_start + (t - trace.start)) * 1e9)
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otlp_json(trace):
+    """Trace au format OTLP/JSON (ExportTraceServiceRequest), avec un span racine pour le rerun."""
+    root_id = secrets.token_hex(8)
+    spans = [{
+        "traceId": trace.trace_id, "spanId": root_id, "name": trace.name, "kind": 1,
+        "startTimeUnixNano": str(_nanos(trace, trace.start)), "endTimeUnixNano": str(_nanos(trace, trace.end)),
+        "attributes": [{"key": "spans.dropped", "value": _otlp_value(trace.dropped)}],
+    }]
+    for s in trace.spans:
+        attributes = [{"key": "category", "value": _otlp_value(s.category)}]
+        attributes += [{"key": k, "value": _otlp_value(v)} for k, v in s.attributes.items() if v is not None]
+        spans.append({
+            "traceId": trace.trace_id, "spanId": s.span_id, "parentSpanId": s.parent_id or root_id,
+            "name": s.name, "kind": 3 if s.category == "http" else 1,
+            "startTimeUnixNano": str(_nanos(trace, s.start)), "endTimeUnixNano": str(_nanos(trace, s.end)),
+            "attributes": attributes,
+            "status": {"code": 2, "message": s.error} if s.error else {"code": 0},
+        })
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": _otlp_value(SERVICE_NAME)}]},
+        "scopeSpans": [{"scope": {"name": "telemetry"}, "spans": spans}],
+    }]}
+
+
+_log_lock = threading.Lock()
+
+
+def _export_jsonl(trace):
+    try:
+        line = json.dumps(otlp_json(trace), ensure_ascii=False)
+        with _log_lock, open(TELEMETRY_LOG, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    except (OSError, TypeError, ValueError) as e:
+        print(f"telemetry export error: {e}")
+
+
+_tracer = None
+
+
+def _otel_tracer():
+    """Traceur OpenTelemetry (fournisseur OTLP installé au premier export) ; False si le SDK manque."""
+    global _tracer
+    if _tracer is None:
+        try:
+            from opentelemetry import trace as otel
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+            provider = TracerProvider(resource=Resource.create({"service.name": SERVICE_NAME}))
+            provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+            otel.set_tracer_provider(provider)
+            _tracer = otel.get_tracer("telemetry")
+        except ImportError as e:
+            print(f"OpenTelemetry indisponible : {e}")
+            _tracer = False
+    return _tracer
+
+
+def _export_otel(trace):
+    tracer = _otel_tracer()
+    if not tracer:
+        return
+    from opentelemetry import trace as otel
+    from opentelemetry.trace import Status, StatusCode
+
+    root = tracer.start_span(trace.name, start_time=_nanos(trace, trace.start))
+    opened = {None: root}
+    for s in sorted(trace.spans, key=lambda x: x.start):
+        parent = opened.get(s.parent_id, root)
+        attributes = {"category": s.category}
+        attributes.update({k: v if isinstance(v, (bool, int, float)) else str(v)
+                           for k, v in s.attributes.items() if v is not None})
+        otel_span = tracer.start_span(s.name, context=otel.set_span_in_context(parent),
+                                      start_time=_nanos(trace, s.start), attributes=attributes)
+        if s.error:
+            otel_span.set_status(Status(StatusCode.ERROR, s.error))
+        opened[s.span_id] = otel_span
+    for s in trace.spans:
+        opened[s.span_id].end(end_time=_nanos(trace, s.end))
+    root.end(end_time=_nanos(trace, trace.end))
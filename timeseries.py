@@ -0,0 +1,308 @@
+"""Séries temporelles des indicateurs : plusieurs millésimes RP et FILOSOFI dans un même cube.
+
+Chaque indicateur est stocké dans son propre tableau (communes × millésimes,
+float32) : la série d'un territoire ou la carte d'une année ne lit qu'un seul
+fichier, projeté en mémoire, quel que soit le nombre d'années comparées. Les
+communes suivent la géographie du référentiel local (un seul millésime du COG) :
+chaque millésime est harmonisé à son chargement (fusions, rétablissements, voir
+cog.py). Quand le référentiel change de millésime du COG, les séries existantes
+sont reportées sur la nouvelle géographie de la même façon (somme pour un stock,
+moyenne pondérée par la population du millésime pour un taux).
+
+La mise à jour est incrémentale : seuls les couples (indicateur, millésime)
+absents du stock sont demandés à l'API.
+
+Disposition sur disque :
+    <TIMESERIES_DIR>/index.json     codes communes, millésimes chargés par indicateur
+    <TIMESERIES_DIR>/<fichier>.npy  valeurs d'un indicateur (communes × années)
+
+Usage (cron) :
+    python timeseries.py --years 2016 2017 2018 2019 2020 --workers 4
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from aggregation import SUM, aggregate, rule_for
+from cog import RATE, STOCK
+from insee_data import (COG_YEAR, DATA_DIR, INDICATORS_CONFIG, VINTAGES, age_components, get_cog_transition,
+                        get_hierarchy, harmonized_values)
+import telemetry
+
+TIMESERIES_DIR = os.getenv("TIMESERIES_DIR", os.path.join(DATA_DIR, "timeseries"))
+
+AGE_INDICATORS = ("Population municipale", "Indice de jeunesse")
+# Composantes (cf. aggregation.RULES) chargées avec chaque millésime
+COMPONENTS = ["_population", "_jeunes", "_ages"]
+# Indicateurs calculés localement (surface) : pas de série
+EXCLUDED = ("Densité de population (hab/km²)", "Population municipale (femme)", "Population municipale (homme)")
+
+
+def series_indicators():
+    """Indicateurs suivis dans le temps (ceux qui existent dans chaque millésime pynsee)."""
+    names = [i for group in INDICATORS_CONFIG.values() for i in group if i not in EXCLUDED]
+    return list(dict.fromkeys(names)) + COMPONENTS
+
+
+def _file_name(indicator, years):
+    """Nom de fichier propre à un état de la série : un lecteur ouvert garde des fichiers cohérents."""
+    key = f"{indicator}|{','.join(map(str, years))}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:12] + ".npy"
+
+
+class TimeSeriesStore:
+    """Stock des séries : un tableau projeté en mémoire par indicateur."""
+
+    def __init__(self, path):
+        with open(os.path.join(path, "index.json"), encoding="utf-8") as f:
+            index = json.load(f)
+        self.path = path
+        self.updated_at = index.get("updated_at")
+        self.codes = index["codes"]
+        self._position = {c: i for i, c in enumerate(self.codes)}
+        self._series = index["series"]
+        self._arrays = {name: np.load(os.path.join(path, meta["file"]), mmap_mode="r")
+                        for name, meta in self._series.items()}
+
+    @property
+    def indicators(self):
+        return [name for name in self._series if not name.startswith("_")]
+
+    def years(self, indicator):
+        return self._series.get(indicator, {}).get("years", [])
+
+    def matrix(self, indicator, codes):
+        """Valeurs (codes × années de l'indicateur), NaN pour une commune inconnue."""
+        years = self.years(indicator)
+        idx = np.fromiter((self._position.get(str(c), -1) for c in codes), dtype=np.int64, count=len(codes))
+        if not years:
+            return np.full((len(codes), 0), np.nan)
+        values = np.asarray(self._arrays[indicator][np.maximum(idx, 0)], dtype=np.float64)
+        values[idx < 0] = np.nan
+        return values
+
+    def territory_series(self, indicator, codes):
+        """Série agrégée d'un ensemble de communes : pd.Series indexée par année."""
+        codes = list(codes)
+        years = self.years(indicator)
+        if not years:
+            return pd.Series(dtype=float)
+        mode, operands = rule_for(indicator)
+        columns = list(dict.fromkeys([indicator, *operands, "_population"]))
+        columns = [c for c in columns if c in self._series]
+        matrices = {c: self.matrix(c, codes) for c in columns}
+        out = {}
+        for year in years:
+            rows = []
+            for c in columns:
+                c_years = self.years(c)
+                rows.append(matrices[c][:, c_years.index(year)] if year in c_years else np.full(len(codes), np.nan))
+            aggregated, _ = aggregate(columns, np.vstack(rows), np.zeros(len(codes), dtype=np.int64), 1)
+            out[year] = float(aggregated[0, 0])
+        return pd.Series(out, name=indicator).dropna()
+
+    def change(self, indicator, codes, start, end, relative=False):
+        """Évolution par commune entre deux millésimes (différence, ou variation en % si `relative`)."""
+        years = self.years(indicator)
+        values = self.matrix(indicator, codes)
+        first, last = values[:, years.index(start)], values[:, years.index(end)]
+        if not relative:
+            return last - first
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(first != 0, (last - first) / np.abs(first) * 100, np.nan)
+
+
+@telemetry.cache_resource(show_spinner=False, max_entries=1)
+def _open_timeseries(path, version):
+    try:
+        return TimeSeriesStore(path)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"get_timeseries error: {e}")
+        return None
+
+
+def get_timeseries():
+    """Stock des séries partagé entre les sessions (None tant qu'il n'a pas été construit).
+
+    L'index est remplacé atomiquement à chaque mise à jour : sa date de modification
+    sert de version, et le stock est rouvert sans redémarrage dès qu'elle change.
+    """
+    try:
+        version = os.stat(os.path.join(TIMESERIES_DIR, "index.json")).st_mtime_ns
+    except OSError:
+        return None
+    return _open_timeseries(TIMESERIES_DIR, version)
+
+
+def fetch_vintage(codes, year, names):
+    """Valeurs d'un millésime pour une liste de communes du référentiel : {indicateur: tableau}."""
+    out = {}
+    age_names = [n for n in names if n in AGE_INDICATORS or n in COMPONENTS]
+    if age_names:
+        total, young, old = age_components(codes, VINTAGES[year][0])
+        if total is not None:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                derived = {"_population": total, "Population municipale": total, "_jeunes": young, "_ages": old,
+                           "Indice de jeunesse": np.where(old > 0, young / old, np.nan)}
+            out.update({n: derived[n] for n in age_names})
+    for name in names:
+        if name in out or name in age_names:
+            continue
+        # Appel direct (hors cache Streamlit) : le stock est lui-même le cache
+        series = harmonized_values(codes, name, vintage=year, cache=False)
+        if series is not None:
+            out[name] = series.reindex(codes).to_numpy(dtype=np.float64)
+    return out
+
+
+def _save_atomic(path, array):
+    tmp = f"{path}.tmp.npy"
+    np.save(tmp, array)
+    os.replace(tmp, path)
+
+
+def _realign(previous, directory, codes):
+    """Séries du stock précédent reportées sur les communes `codes` : {indicateur: (années, valeurs)}."""
+    old_codes = [str(c) for c in previous["codes"]]
+    old_year = previous.get("cog_year")
+    transition = None
+    if old_codes != codes:
+        transition = get_cog_transition(old_year) if old_year and old_year < COG_YEAR else None
+        if transition is None:
+            print(f"Géographie du stock ({old_year or 'inconnue'}) non harmonisable vers le COG {COG_YEAR} : "
+                  "réalignement par code (valeurs des communes fusionnées perdues).")
+    series = {name: (list(meta["years"]), np.load(os.path.join(directory, meta["file"])))
+              for name, meta in previous["series"].items()}
+    if old_codes == codes:
+        return series
+
+    stored = {}
+    position = {c: i for i, c in enumerate(codes)}
+    idx = np.array([position.get(c, -1) for c in old_codes], dtype=np.int64)
+    population_years, population = series.get("_population", ([], None))
+    for name, (years, old) in series.items():
+        values = np.full((len(codes), old.shape[1]), np.nan, dtype=np.float32)
+        if transition is None:
+            values[idx[idx >= 0]] = old[idx >= 0]
+        else:
+            mode = STOCK if rule_for(name)[0] == SUM else RATE
+            for j, year in enumerate(years):
+                weights = None
+                if mode == RATE and year in population_years:
+                    # Poids des communes regroupées : leur population du même millésime
+                    weights = pd.Series(population[:, population_years.index(year)], index=old_codes)
+                column = transition.harmonize(pd.Series(old[:, j], index=old_codes), mode, weights)
+                values[:, j] = column.reindex(codes).to_numpy(dtype=np.float32)
+        stored[name] = (years, values)
+    return stored
+
+
+def update_timeseries(years, indicators=None, directory=TIMESERIES_DIR, workers=4, departements=None):
+    """Ajoute au stock les millésimes manquants ; retourne les couples (indicateur, année) chargés.
+
+    Un millésime chargé pour quelques départements (`departements`) serait tenu pour
+    complet dans le stock servi : il n'est écrit que hors de TIMESERIES_DIR.
+    """
+    if departements and os.path.abspath(directory) == os.path.abspath(TIMESERIES_DIR):
+        raise SystemExit("Stock partiel (--departements) : indiquer un répertoire --output distinct de "
+                         f"celui du stock servi ({TIMESERIES_DIR}).")
+    hierarchy = get_hierarchy()
+    if hierarchy is None:
+        raise SystemExit("Référentiel communal indisponible : mise à jour impossible.")
+    unknown = [y for y in years if y not in VINTAGES]
+    if unknown:
+        raise SystemExit(f"Millésimes inconnus : {unknown} (disponibles : {sorted(VINTAGES)})")
+    names = indicators or series_indicators()
+    codes = hierarchy.codes.tolist()
+    position = {c: i for i, c in enumerate(codes)}
+
+    os.makedirs(directory, exist_ok=True)
+    index_path = os.path.join(directory, "index.json")
+    index = {"codes": codes, "cog_year": COG_YEAR, "series": {}}
+    stored = {}
+    if os.path.exists(index_path):
+        with open(index_path, encoding="utf-8") as f:
+            previous = json.load(f)
+        # Report sur la géographie courante du référentiel
+        stored = _realign(previous, directory, codes)
+
+    missing = {year: [n for n in names if year not in stored.get(n, ([], None))[0]] for year in years}
+    missing = {year: todo for year, todo in missing.items() if todo}
+    if not missing:
+        print("Stock à jour : aucun millésime manquant.")
+        return []
+    print("À charger : " + ", ".join(f"{year} ({len(todo)} indicateurs)" for year, todo in missing.items()))
+
+    dep_codes = [d for d in (departements or hierarchy.groups("departements")[0]) if d]
+    fetched = {(name, year): np.full(len(codes), np.nan, dtype=np.float32)
+               for year, todo in missing.items() for name in todo}
+
+    def _process(dep):
+        dep_communes = hierarchy.communes_of(dep, "departements")
+        return dep_communes, {year: fetch_vintage(dep_communes, year, todo) for year, todo in missing.items()}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_process, d): d for d in dep_codes}
+        for i, future in enumerate(as_completed(futures), 1):
+            dep = futures[future]
+            try:
+                dep_communes, by_year = future.result()
+            except Exception as e:
+                print(f"[{i}/{len(dep_codes)}] {dep} : échec ({e})")
+                continue
+            rows = [position[c] for c in dep_communes]
+            for year, values in by_year.items():
+                for name, array in values.items():
+                    fetched[(name, year)][rows] = array
+            print(f"[{i}/{len(dep_codes)}] {dep} : {len(dep_communes)} communes")
+
+    loaded, empty = [], []
+    for (name, year), values in fetched.items():
+        # Millésime indisponible pour cet indicateur : il sera redemandé à la prochaine mise à jour
+        if np.isnan(values).all():
+            empty.append(f"{name} ({year})")
+            continue
+        series_years, matrix = stored.get(name, ([], np.empty((len(codes), 0), dtype=np.float32)))
+        order = sorted(series_years + [year])
+        merged = np.full((len(codes), len(order)), np.nan, dtype=np.float32)
+        for j, y in enumerate(series_years):
+            merged[:, order.index(y)] = matrix[:, j]
+        merged[:, order.index(year)] = values
+        stored[name] = (order, merged)
+        loaded.append((name, year))
+
+    for name, (series_years, matrix) in stored.items():
+        file_name = _file_name(name, series_years)
+        _save_atomic(os.path.join(directory, file_name), np.ascontiguousarray(matrix, dtype=np.float32))
+        index["series"][name] = {"file": file_name, "years": series_years}
+    index["updated_at"] = datetime.datetime.now().isoformat(timespec="seconds")
+    tmp = f"{index_path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(tmp, index_path)
+    referenced = {meta["file"] for meta in index["series"].values()}
+    for name in os.listdir(directory):
+        if name.endswith(".npy") and name not in referenced:
+            os.remove(os.path.join(directory, name))
+    if empty:
+        print(f"{len(empty)} séries sans valeur, redemandées à la prochaine mise à jour : {', '.join(empty[:5])}…")
+    print(f"{len(loaded)} séries (indicateur × millésime) ajoutées dans {directory}.")
+    return loaded
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Met à jour le stock des séries temporelles d'indicateurs.")
+    parser.add_argument("--years", type=int, nargs="+", default=sorted(VINTAGES))
+    parser.add_argument("--indicators", nargs="*", help="Limiter à quelques indicateurs")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--departements", nargs="*",
+                        help="Limiter à quelques départements (tests ; exige --output hors du stock servi)")
+    parser.add_argument("--output", default=TIMESERIES_DIR)
+    args = parser.parse_args()
+    update_timeseries(args.years, args.indicators, args.output, args.workers, args.departements)